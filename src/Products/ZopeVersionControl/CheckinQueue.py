@@ -0,0 +1,335 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+import logging
+import os
+import threading
+import time
+import weakref
+
+import transaction
+from AccessControl import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+from Acquisition import aq_base
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Persistence import Persistent
+from ZODB.POSException import ConflictError
+from ZODB.utils import z64
+
+
+logger = logging.getLogger('Products.ZopeVersionControl')
+
+# A key that the jobs of a queue are kept after, which sorts before the
+# key of any job. Removing jobs from a short queue then never removes
+# the first key of its bucket nor empties it, changes that BTrees do not
+# merge with concurrent ones.
+_FIRST = ()
+
+
+class CheckinJob(Persistent):
+    """A CheckinJob is the checkin of a resource in a checkin queue. It
+       is written once, by the transaction of the checkin, so that its
+       serial tells which transaction that was."""
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.queued = time.time()
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def openAtCheckin(self):
+        """Return a historical connection that sees the database as it
+           was when the checkin was committed, or None if it has not been
+           committed yet."""
+        if self._p_jar is None or self._p_serial == z64:
+            return None
+        return self.resource._p_jar.db().open(at=self._p_serial)
+
+
+InitializeClass(CheckinJob)
+
+
+class CheckinQueue(Persistent):
+    """A CheckinQueue holds the checkins whose versions wait for their
+       states to be saved, by the (history_id, version_id) of the
+       versions. Jobs are added by checkins and removed by workers at the
+       same time; they are kept in a BTree and counted with a Length, so
+       that transactions that add and remove different jobs are merged
+       instead of conflicting, and a checkin does not rewrite the whole
+       queue."""
+
+    def __init__(self):
+        self._jobs = OOBTree({_FIRST: None})
+        self._depth = Length()
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def add(self, key, resource):
+        """Queue the checkin of a resource."""
+        if key not in self._jobs:
+            self._depth.change(1)
+        self._jobs[key] = CheckinJob(resource)
+
+    @security.private
+    def remove(self, key):
+        """Remove a job from the queue."""
+        del self._jobs[key]
+        self._depth.change(-1)
+
+    @security.private
+    def get(self, key):
+        """Return the CheckinJob of a key, or None."""
+        return self._jobs.get(key)
+
+    @security.private
+    def keys(self):
+        """Return the keys of the jobs, oldest first."""
+        jobs = self._jobs
+        return sorted(jobs.keys(_FIRST, excludemin=True),
+                      key=lambda key: jobs[key].queued)
+
+    @security.private
+    def getLag(self):
+        """Return the number of seconds that the oldest job has waited."""
+        if not len(self):
+            return 0.0
+        jobs = self._jobs.values(_FIRST, excludemin=True)
+        return time.time() - min(job.queued for job in jobs)
+
+    def __len__(self):
+        return self._depth()
+
+
+InitializeClass(CheckinQueue)
+
+
+class CheckinWorker:
+    """A CheckinWorker saves the states of the versions in the checkin
+       queue of a repository, in a thread with its own connection to the
+       database of the repository.
+
+       The state of each version is copied from the state that the
+       resource had when its checkin was committed, read through a
+       historical connection, so that later changes to the resource do
+       not leak into the version. Jobs that fail are retried on the next
+       passes, up to max_attempts times, and stay in the queue after
+       that."""
+
+    def __init__(self, repository, interval=1.0, max_attempts=3):
+        self.db = repository._p_jar.db()
+        self.oid = repository._p_oid
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.processed = 0
+        self.conflicts = 0
+        self.failed = 0
+        self.last_error = None
+        self._failures = {}
+        self._failures_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def start(self):
+        """Start the thread of the worker."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='ZVC-checkin',
+                                        daemon=True)
+        self._thread.start()
+        _workers.add(self)
+
+    @security.private
+    def stop(self, timeout=None):
+        """Stop the thread of the worker once it has finished the job it
+           is working on."""
+        _workers.discard(self)
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        thread.join(timeout)
+        self._thread = None
+
+    @security.private
+    def notify(self):
+        """Wake the worker up to look at the queue now."""
+        self._wake.set()
+
+    @security.private
+    def processQueue(self):
+        """Save the states of the versions in the queue, each in its own
+           transaction, and return the number of versions saved."""
+        with self._lock:
+            tm = transaction.TransactionManager()
+            conn = self.db.open(tm)
+            try:
+                return self._processQueue(tm, conn)
+            finally:
+                tm.abort()
+                conn.close()
+
+    @security.private
+    def getCounters(self):
+        """Return a mapping with the counters of the worker. 'failing'
+           lists the (history_id, version_id) of the jobs that have failed
+           max_attempts times."""
+        with self._failures_lock:
+            failures = list(self._failures.items())
+        return {
+            'processed': self.processed,
+            'conflicts': self.conflicts,
+            'failed': self.failed,
+            'last_error': self.last_error,
+            'failing': sorted(key for key, count in failures
+                              if count >= self.max_attempts),
+        }
+
+    @security.private
+    def getStatistics(self):
+        """Return a mapping with the depth and lag of the queue, as given
+           by Repository.getCheckinQueueStatistics, and the counters of
+           the worker."""
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        try:
+            stats = conn.get(self.oid).getCheckinQueueStatistics()
+        finally:
+            tm.abort()
+            conn.close()
+        stats.update(self.getCounters())
+        return stats
+
+    def _processQueue(self, tm, conn):
+        count = 0
+        for key in conn.get(self.oid).listQueuedCheckins():
+            if self._stopping:
+                break
+            if self._failures.get(key, 0) >= self.max_attempts:
+                continue
+            try:
+                tm.begin()
+                conn.get(self.oid).completeCheckin(*key)
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+                self.conflicts += 1
+            except Exception as error:
+                tm.abort()
+                self.failed += 1
+                with self._failures_lock:
+                    self._failures[key] = self._failures.get(key, 0) + 1
+                self.last_error = (key, '%s: %s' % (
+                    error.__class__.__name__, error))
+                logger.exception('Saving version %s of history %s failed',
+                                 key[1], key[0])
+            else:
+                with self._failures_lock:
+                    self._failures.pop(key, None)
+                self.processed += 1
+                count += 1
+        return count
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.processQueue()
+            except Exception:
+                logger.exception('Processing the checkin queue failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+InitializeClass(CheckinWorker)
+
+
+# The running workers of this process, which are woken up when a
+# checkin is queued.
+_workers = weakref.WeakSet()
+
+
+def getWorkers(repository):
+    """Return the running workers of this process that save the states
+       of the versions of a repository."""
+    jar = aq_base(repository)._p_jar
+    if jar is None:
+        return []
+    db = jar.db()
+    return [worker for worker in list(_workers)
+            if worker.db is db and worker.oid == repository._p_oid]
+
+
+def startWorkers(db, paths, interval=1.0):
+    """Start a worker for each of the repositories at the given paths of
+       the Zope application of a database, and return the workers.
+       Paths that do not lead to a repository are logged and skipped, and
+       so are repositories that already have a worker in this process."""
+    tm = transaction.TransactionManager()
+    conn = db.open(tm)
+    workers = []
+    try:
+        app = conn.root()['Application']
+        for path in paths:
+            repository = app.unrestrictedTraverse(path, None)
+            if getattr(aq_base(repository), 'completeCheckin', None) is None:
+                logger.warning('No repository at %s to start a checkin '
+                               'worker for', path)
+                continue
+            if getWorkers(repository):
+                continue
+            worker = CheckinWorker(repository, interval)
+            worker.start()
+            workers.append(worker)
+    finally:
+        tm.abort()
+        conn.close()
+    return workers
+
+
+def startConfiguredWorkers(event):
+    """Start the workers of the repositories whose paths are listed in
+       the ZVC_CHECKIN_WORKERS environment variable, once Zope has opened
+       its database. The workers poll their queue every
+       ZVC_CHECKIN_INTERVAL seconds (1 by default) and are woken up when
+       a checkin of this process is queued."""
+    paths = os.environ.get('ZVC_CHECKIN_WORKERS', '').split()
+    if paths:
+        interval = float(os.environ.get('ZVC_CHECKIN_INTERVAL', 1.0))
+        startWorkers(event.database, paths, interval)
+
+
+def addNotifyHook(txn):
+    """Have the running workers of this process woken up once a
+       transaction has been committed. The hook is added once per
+       transaction, however many checkins it queues."""
+    for hook, args, kws in txn.getAfterCommitHooks():
+        if hook is notifyWorkers:
+            return
+    txn.addAfterCommitHook(notifyWorkers)
+
+
+def notifyWorkers(status=True):
+    """Wake up the running workers of this process. This is called after
+       a transaction that queued a checkin has been committed."""
+    if status:
+        for worker in list(_workers):
+            worker.notify()
@@ -0,0 +1,123 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+from AccessControl import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Persistence import Persistent
+from ZODB.POSException import ConflictError
+
+
+class ContentStore(Persistent):
+    """A ContentStore holds the serialized states of persistent subobjects
+       of versions, keyed by a hash of the serialized state, so that
+       identical subobject states are stored only once. Records are
+       reference counted: a record is referenced by the versions and the
+       other records whose states refer to it, and is removed when the
+       last reference is released.
+
+       Each record has a RefCount of its own, so that checkins that share
+       a record only change its counter, and concurrent checkins in any
+       histories do not conflict on the store."""
+
+    def __init__(self):
+        self._records = OOBTree()
+        self._refcounts = OOBTree()
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def add(self, key, data, children=()):
+        """Add a record if it is not stored yet, and return true if it
+           was added. Adding a record adds a reference to each of the
+           records named in children. The new record itself is
+           unreferenced until incref() is called."""
+        if key in self._records:
+            return False
+        for child in children:
+            self.incref(child)
+        self._records[key] = ContentRecord(data, children)
+        self._refcounts[key] = RefCount()
+        return True
+
+    @security.private
+    def get(self, key):
+        """Return the serialized state stored under the given key."""
+        return self._records[key].data
+
+    @security.private
+    def getRecord(self, key):
+        """Return the record stored under the given key."""
+        return self._records[key]
+
+    @security.private
+    def incref(self, key):
+        """Add a reference to the record stored under the given key."""
+        self._refcounts[key].change(1)
+
+    @security.private
+    def decref(self, key):
+        """Release a reference to the record stored under the given key,
+           removing the record when it is no longer referenced."""
+        keys = [key]
+        while keys:
+            key = keys.pop()
+            refcount = self._refcounts[key]
+            refcount.change(-1)
+            if refcount() > 0:
+                continue
+            record = self._records[key]
+            del self._records[key]
+            del self._refcounts[key]
+            keys.extend(record.children)
+
+    @security.private
+    def getRefCount(self, key):
+        refcount = self._refcounts.get(key)
+        if refcount is None:
+            return 0
+        return refcount()
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+
+InitializeClass(ContentStore)
+
+
+class ContentRecord(Persistent):
+    """A ContentRecord holds the serialized state of a subobject and the
+       keys of the records that the state refers to."""
+
+    def __init__(self, data, children=()):
+        self.data = data
+        self.children = tuple(children)
+
+
+InitializeClass(ContentRecord)
+
+
+class RefCount(Length):
+    """The reference count of a content store record. Concurrent changes
+       are added up, as by Length, unless one of them released the last
+       reference and so removed the record: a checkin that shares the
+       record at the same time must then be retried."""
+
+    def _p_resolveConflict(self, old, committed, new):
+        if old > 0 and (committed <= 0 or new <= 0):
+            raise ConflictError
+        return committed + new - old
@@ -12,34 +12,81 @@
 ##############################################################################
 
 import time
+from random import randint
 
 from AccessControl import ClassSecurityInfo
 from AccessControl.class_init import InitializeClass
 from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
 from Persistence import Persistent
 
+from .Utility import VersionControlError
+from .Utility import _connectionNumber
 from .Utility import _findUserId
 
 
 MAX32 = int(2**31 - 1)
 
+# The number of slots that the connections of the processes of a cluster
+# take keys of newest-first mappings with. Connections with different
+# slots can add entries to the same mapping at the same time.
+KEY_SLOTS = 64
+
+# The slot of the first connection of this process. It is random, so
+# that two processes take the same slots with a chance of 1/KEY_SLOTS.
+_first_slot = randint(0, KEY_SLOTS - 1)
+
+
+def _getSlot(conn):
+    # Return the slot of a connection: connections of one process take
+    # consecutive slots.
+    if conn is None:
+        return 0
+    return (_first_slot + _connectionNumber(conn)) % KEY_SLOTS
+
+
+def nextKey(mapping):
+    """Return the key of a new entry of a newest-first mapping, which is
+       below the smallest key in use. Each connection takes a slot, and
+       the key is that many keys below the one below the smallest key,
+       so that transactions that add entries at the same time use
+       different keys, and their changes to the mapping are merged
+       instead of conflicting.
+
+       A mapping holds at least 2**32 / KEY_SLOTS entries, and 2**32
+       entries if they are all added through slot 0. Raise
+       VersionControlError when the keys run out."""
+    if not mapping:
+        return MAX32
+    key = mapping.minKey() - 1 - _getSlot(mapping._p_jar)
+    if key < -MAX32 - 1:
+        raise VersionControlError(
+            'There are no keys left for new entries.'
+        )
+    return key
+
 
 class EventLog(Persistent):
     """An EventLog encapsulates a collection of log entries."""
 
     def __init__(self):
         self._data = IOBTree()
+        self._length = Length()
+
+    # The number of entries, so that len() does not load every bucket of
+    # the log. Logs created before it was kept count their entries on
+    # their next append.
+    _length = None
 
     security = ClassSecurityInfo()
 
     @security.private
     def addEntry(self, entry):
         """Add a new log entry."""
-        if len(self._data):
-            key = self._data.minKey() - 1
-        else:
-            key = MAX32
-        self._data[key] = entry
+        if self._length is None:
+            self._length = Length(len(self._data))
+        self._data[nextKey(self._data)] = entry
+        self._length.change(1)
 
     @security.private
     def getEntries(self):
@@ -47,10 +94,12 @@ class EventLog(Persistent):
         return self._data.values()
 
     def __len__(self):
-        return len(self._data)
+        if self._length is None:
+            return len(self._data)
+        return self._length()
 
     def __nonzero__(self):
-        return len(self._data) > 0
+        return len(self) > 0
 
 
 InitializeClass(EventLog)
@@ -67,6 +116,7 @@ class LogEntry(Persistent):
     ACTION_CHECKIN = 1
     ACTION_UNCHECKOUT = 2
     ACTION_UPDATE = 3
+    ACTION_CHECKIN_UNCHANGED = 4
 
     def __init__(self, version_id, action, path=None, message=''):
         self.timestamp = time.time()
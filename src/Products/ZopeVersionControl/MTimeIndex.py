@@ -0,0 +1,233 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+import threading
+import weakref
+from collections import OrderedDict
+
+from AccessControl import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+from ZODB.TimeStamp import TimeStamp
+from ZODB.utils import p64
+from ZODB.utils import u64
+
+from .Utility import _scanModificationTime
+
+
+class MTimeIndex:
+    """An MTimeIndex records the latest modification time of the
+       non-versioned subtree of each version-controlled resource of a
+       database, so that checking whether a resource has changed does
+       not need to load every record of the subtree each time.
+
+       The index is kept up to date at transaction boundaries by reading
+       the transactions committed since it was last used from the
+       storage, so that it sees the commits of every thread and of every
+       client of the storage. A commit that changes a record of a
+       subtree moves the modification time of the resource forward and
+       marks its entry as incomplete, as the commit may also have added
+       records to the subtree. An incomplete entry still shows that a
+       resource has changed after a given time; otherwise the subtree
+       is walked again."""
+
+    def __init__(self, max_entries=1000, max_transactions=1000):
+        self.max_entries = max_entries
+        self.max_transactions = max_transactions
+        self.last_tid = None
+        self._entries = OrderedDict()
+        self._owners = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.transactions = 0
+        self.records = 0
+        self.bytes = 0
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def getModificationTime(self, object, newer_than=None, max_depth=None,
+                            max_records=None, stats=None, workers=None,
+                            cache=None):
+        """Return the last modification time of a version-controlled
+           object, as computed by Utility._findModificationTime with the
+           same arguments. If the time is later than newer_than, any
+           time that is later than newer_than may be returned instead."""
+        conn = object._p_jar
+        oid = object._p_oid
+        tid = _viewTid(conn)
+        current = False
+        if tid is not None:
+            current = self._sync(conn.db().storage, tid)
+            with self._lock:
+                # Another thread may have moved the index past the view
+                # of our connection since.
+                current = current and self.last_tid == tid
+                entry = current and self._entries.get(oid)
+                if entry and (entry[1] or newer_than is not None and
+                              entry[0] > newer_than):
+                    self._entries.move_to_end(oid)
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+        walk = {}
+        mtime, oids, complete = _scanModificationTime(
+            object, newer_than, max_depth, max_records, walk, workers,
+            cache)
+        if stats is not None:
+            stats['records'] = stats.get('records', 0) + walk['records']
+            stats['bytes'] = stats.get('bytes', 0) + walk['bytes']
+            stats['complete'] = complete
+        with self._lock:
+            self.records += walk['records']
+            self.bytes += walk['bytes']
+            # Another thread may have moved the index past the view of
+            # our connection while we walked the subtree.
+            if current and mtime is not None and self.last_tid == tid:
+                self._record(oid, mtime, oids, complete)
+        return mtime
+
+    @security.private
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self.last_tid = None
+            self.hits = self.misses = self.transactions = 0
+            self.records = self.bytes = 0
+
+    @security.private
+    def getStatistics(self):
+        """Return a mapping with the counters and the current size of
+           the index."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'transactions': self.transactions,
+                    'records': self.records,
+                    'bytes': self.bytes,
+                    'entries': len(self._entries)}
+
+    def _sync(self, storage, tid):
+        # Bring the index up to the given transaction and return true,
+        # or return false if the index has already seen later ones. The
+        # storage is read without holding the lock, so that other threads
+        # can use the index meanwhile.
+        with self._lock:
+            start = self.last_tid
+            if start is None or tid == start:
+                self.last_tid = tid
+                return True
+            if tid < start:
+                return False
+        txns = []
+        try:
+            iterator = storage.iterator(p64(u64(start) + 1), tid)
+            try:
+                for count, txn in enumerate(iterator):
+                    if count == self.max_transactions:
+                        raise ValueError('Too many transactions to read.')
+                    txns.append((txn.tid, [record.oid for record in txn]))
+            finally:
+                close = getattr(iterator, 'close', None)
+                if close is not None:
+                    close()
+        except Exception:
+            # The storage cannot be iterated, or we are too far behind:
+            # start again from the current transaction.
+            txns = None
+        with self._lock:
+            if self.last_tid != start:
+                # Another thread has moved the index while we read.
+                return self.last_tid == tid
+            if txns is None:
+                self._entries.clear()
+                self._owners.clear()
+            else:
+                for txn_tid, oids in txns:
+                    self._note(txn_tid, oids)
+            self.last_tid = tid
+        return True
+
+    def _note(self, tid, oids):
+        self.transactions += 1
+        mtime = TimeStamp(tid).timeTime()
+        for oid in oids:
+            for owner, counts in self._owners.get(oid, {}).items():
+                entry = self._entries[owner]
+                if counts and mtime > entry[0]:
+                    entry[0] = mtime
+                entry[1] = False
+
+    def _record(self, oid, mtime, oids, complete):
+        self._forget(oid)
+        self._entries[oid] = [mtime, complete, oids]
+        for member, counts in oids.items():
+            self._owners.setdefault(member, {})[oid] = counts
+        while len(self._entries) > self.max_entries:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, oid):
+        entry = self._entries.pop(oid, None)
+        if entry is None:
+            return
+        for member in entry[2]:
+            owners = self._owners[member]
+            del owners[oid]
+            if not owners:
+                del self._owners[member]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+InitializeClass(MTimeIndex)
+
+
+def _viewTid(conn):
+    # Return the id of the last transaction seen by a connection, or
+    # None if the connection is not in a transaction.
+    if conn is None:
+        return None
+    start = getattr(conn._storage, '_start', None)
+    if start is None:
+        return None
+    return p64(u64(start) - 1)
+
+
+# The indexes of this process, by database.
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def getMTimeIndex(db):
+    """Return the modification time index of a database."""
+    with _indexes_lock:
+        index = _indexes.get(db)
+        if index is None:
+            index = _indexes[db] = MTimeIndex()
+        return index
+
+
+def findModificationTime(object, newer_than=None, max_depth=None,
+                         max_records=None, stats=None, workers=None,
+                         cache=None):
+    """Return the last modification time of a version-controlled object
+       using the index of its database. See
+       MTimeIndex.getModificationTime."""
+    conn = object._p_jar
+    if conn is None:
+        return None
+    return getMTimeIndex(conn.db()).getModificationTime(
+        object, newer_than, max_depth, max_records, stats, workers, cache)
@@ -0,0 +1,67 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+from AccessControl import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+from Persistence import Persistent
+
+
+class NameSet(Persistent):
+    """A NameSet holds the names of the labels or activities used in a
+       repository. Names are only ever added, and transactions that add
+       names at the same time, even the same name, are merged instead of
+       conflicting.
+
+       The names are kept in the record of the set, which is written
+       whole each time a name is added. That suits the tens or hundreds
+       of labels and activities of a repository, but not a repository
+       that adds a new label with every checkin; a BTree of names would
+       then be smaller to write, although it conflicts when two
+       transactions add the same name."""
+
+    def __init__(self, names=()):
+        self._names = frozenset(names)
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def add(self, name):
+        """Add a name to the set."""
+        if name not in self._names:
+            self._names = self._names | {name}
+
+    @security.private
+    def keys(self):
+        """Return a sorted sequence of the names in the set."""
+        return sorted(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Keep the names added by either transaction. Should names ever
+        # be removed, a name removed by either one stays removed.
+        old_names = old['_names']
+        committed_names = committed['_names']
+        new_names = new['_names']
+        removed = ((old_names - committed_names) |
+                   (old_names - new_names))
+        state = dict(new)
+        state['_names'] = (committed_names | new_names) - removed
+        return state
+
+
+InitializeClass(NameSet)
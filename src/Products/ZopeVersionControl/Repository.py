@@ -12,27 +12,45 @@
 ##############################################################################
 
 import time
-from random import randint
+from zlib import crc32
 
+import transaction
 from AccessControl import ClassSecurityInfo
 from AccessControl.class_init import InitializeClass
 from Acquisition import Implicit
+from Acquisition import aq_base
 from Acquisition import aq_inner
 from Acquisition import aq_parent
-from BTrees.OIBTree import OIBTree
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 from DateTime.DateTime import DateTime
 from Persistence import Persistent
+from ZODB.POSException import ConflictError
+from ZODB.POSException import POSKeyError
 
-from . import Utility
+from .CheckinQueue import CheckinQueue
+from .CheckinQueue import addNotifyHook
+from .CheckinQueue import logger
+from .ContentStore import ContentStore
 from .EventLog import LogEntry
+from .historyids import HistoryIdAllocator
+from .historyids import getHistoryIdPrefix
+from .historyids import isRandomHistoryId
+from .MTimeIndex import findModificationTime
+from .NameSet import NameSet
 from .nonversioned import getNonVersionedData
+from .nonversioned import listNonVersionedObjects
 from .nonversioned import restoreNonVersionedData
+from .StateCache import stateCache
 from .Utility import VersionControlError
 from .Utility import VersionInfo
 from .Utility import _findPath
+from .Utility import _nameRange
 from .Utility import isAVersionableResource
 from .Utility import use_vc_permission
+from .Version import SPOOL_THRESHOLD
+from .Version import codecs
+from .Version import fingerprintGraph
 from .ZopeVersionHistory import ZopeVersionHistory
 
 
@@ -43,32 +61,453 @@ class Repository(Implicit, Persistent):
     def __init__(self):
         # These keep track of symbolic label and branch names that
         # have been used to ensure that they don't collide.
-        self._branches = OIBTree()
-        self._branches['mainline'] = 1
-        self._labels = OIBTree()
+        self._branches = NameSet(['mainline'])
+        self._labels = NameSet()
+        self._label_index = OOBTree()
+        self._branch_index = OOTreeSet()
 
         self._histories = OOBTree()
         self._created = time.time()
 
+    # The storage policy for new versions. With 'full' storage each
+    # version holds an independent copy of the state of the resource.
+    # With 'pickle' storage each version holds the serialized state of
+    # the resource, which is produced once at checkin and only loaded
+    # when the state of the version is needed. With 'delta' storage a
+    # version holds a binary delta against the serialized state of its
+    # predecessor, and a full serialized state (a keyframe) is stored
+    # every keyframe_interval versions.
+    version_storage = 'full'
+    keyframe_interval = 10
+
+    # When deduplicate is true, versions are stored serialized and the
+    # states of their persistent subobjects are kept in a content store
+    # shared by all histories, so that identical states are stored once.
+    deduplicate = False
+    _content = None
+
+    # The codec ('none', 'zlib' or 'lzma') that serialized version states
+    # of at least compression_threshold bytes are compressed with. Setting
+    # a codec implies that versions are stored serialized.
+    compression = 'none'
+    compression_threshold = 1024
+
+    # When record_fingerprints is true, versions record hashes of the
+    # state of the resource and of its attributes and items, which make
+    # comparing versions cheap. When skip_unchanged is true, versions
+    # record them too, and a checkin that does not change the resource
+    # only adds a log entry instead of creating a new version.
+    record_fingerprints = False
+    skip_unchanged = False
+
+    # Copies of version states are made through a pickle stream that is
+    # spooled to a temporary file when it grows beyond spool_threshold
+    # bytes, which bounds the memory needed to copy very large objects.
+    spool_threshold = SPOOL_THRESHOLD
+
+    # The attributes of a resource that are captured as the metadata of
+    # each new version when their values are small, so that listings of
+    # versions do not need to load the states of the versions.
+    metadata_attributes = ('title', 'content_type', 'size')
+
+    # The budget of the walk of the subobjects of a resource that finds
+    # whether it has changed: the walk goes at most walk_max_depth
+    # references deep and loads at most walk_max_records records, and
+    # changes beyond that are not seen. None means no limit.
+    walk_max_depth = None
+    walk_max_records = None
+
+    # The number of threads that load the records of the walk at once,
+    # for storages that fetch each record over the network. None (or
+    # zero) loads them one after another.
+    walk_workers = None
+
+    # The allocator of ordered history ids, and the mapping of the random
+    # ids of old histories to the ids they were given by
+    # migrateHistoryIds().
+    _id_allocator = None
+    _history_aliases = None
+
+    # The names of the databases, mounted in the multi-database of the
+    # database of the repository, that new version histories are placed
+    # in, and the policy that picks one of them for each history. With
+    # the 'hash' policy histories are spread over all the databases by
+    # their ids; with the 'last' policy they all go to the last one, so
+    # that a database that has grown large enough is closed to new
+    # histories by adding another one. When shard_payloads_only is true,
+    # histories stay in the database of the repository and only their
+    # versions are placed in the database picked for them.
+    history_databases = ()
+    shard_policy = 'hash'
+    shard_payloads_only = False
+
+    # When async_checkin is true, a checkin links the new version into
+    # its history and queues a job, and the state of the version is
+    # saved later by a CheckinWorker, from the state the resource had
+    # when the checkin was committed.
+    async_checkin = False
+    _checkin_queue = None
+
+    # The histories that carry each label and branch: _label_index maps
+    # (label, history_id) to the id of the labeled version, and
+    # _branch_index holds the (branch_id, history_id) of the histories
+    # that have a branch other than the mainline, so that the histories
+    # of a name are a range of keys. The keys of different histories
+    # are distinct, so concurrent transactions that use a name do not
+    # conflict. Repositories created before the indexes existed get them
+    # from rebuildNameIndexes().
+    _label_index = None
+    _branch_index = None
+
     security = ClassSecurityInfo()
 
+    @security.private
+    def setVersionStorage(self, storage, keyframe_interval=None,
+                          deduplicate=None):
+        """Internal: set the storage policy for new versions. Existing
+           versions keep the format they were stored with."""
+        if storage not in ('full', 'pickle', 'delta'):
+            raise VersionControlError(
+                'Unknown version storage: %s' % storage
+            )
+        if keyframe_interval is not None:
+            if keyframe_interval < 1:
+                raise VersionControlError(
+                    'The keyframe interval must be a positive number.'
+                )
+            self.keyframe_interval = keyframe_interval
+        if deduplicate is not None:
+            self.deduplicate = bool(deduplicate)
+        self.version_storage = storage
+
+    @security.private
+    def setCompression(self, codec, threshold=None):
+        """Internal: set the codec that new serialized version states are
+           compressed with. Existing versions are not recompressed."""
+        if codec != 'none' and codec not in codecs:
+            raise VersionControlError(
+                'Unknown compression codec: %s' % codec
+            )
+        if threshold is not None:
+            self.compression_threshold = max(int(threshold), 0)
+        self.compression = codec
+
+    @security.private
+    def setSkipUnchanged(self, skip_unchanged):
+        """Internal: set whether checkins that do not change a resource
+           are skipped."""
+        self.skip_unchanged = bool(skip_unchanged)
+
+    @security.private
+    def setRecordFingerprints(self, record_fingerprints):
+        """Internal: set whether new versions record the hashes of their
+           state."""
+        self.record_fingerprints = bool(record_fingerprints)
+
+    @security.private
+    def setSpoolThreshold(self, threshold):
+        """Internal: set the size in bytes above which the pickle stream
+           of a state copy is spooled to a temporary file."""
+        if threshold < 0:
+            raise VersionControlError(
+                'The spool threshold must not be negative.'
+            )
+        self.spool_threshold = int(threshold)
+
+    @security.private
+    def setMetadataAttributes(self, names):
+        """Internal: set the attributes captured as version metadata."""
+        self.metadata_attributes = tuple(names)
+
+    @security.private
+    def setWalkBudget(self, max_depth=None, max_records=None):
+        """Internal: limit the depth and the number of records of the
+           walk that finds whether a resource has changed."""
+        for value in (max_depth, max_records):
+            if value is not None and value < 0:
+                raise VersionControlError(
+                    'The walk budget must not be negative.'
+                )
+        self.walk_max_depth = max_depth
+        self.walk_max_records = max_records
+
+    @security.private
+    def setWalkWorkers(self, workers):
+        """Internal: set the number of threads that load the records of
+           the walk that finds whether a resource has changed."""
+        if workers is not None and workers < 0:
+            raise VersionControlError(
+                'The number of walk workers must not be negative.'
+            )
+        self.walk_workers = workers
+
+    @security.private
+    def setHistoryDatabases(self, names, policy=None, payloads_only=None):
+        """Internal: set the databases that new version histories, or
+           only their versions, are placed in. Existing histories stay
+           where they are."""
+        if policy is not None and policy not in ('hash', 'last'):
+            raise VersionControlError(
+                'Unknown shard policy: %s' % policy
+            )
+        names = tuple(names)
+        jar = self._p_jar
+        if jar is not None:
+            databases = jar.db().databases
+            for name in names:
+                if name not in databases:
+                    raise VersionControlError(
+                        'Unknown database: %s' % name
+                    )
+        if policy is not None:
+            self.shard_policy = policy
+        if payloads_only is not None:
+            self.shard_payloads_only = bool(payloads_only)
+        self.history_databases = names
+
+    @security.private
+    def setAsyncCheckin(self, async_checkin):
+        """Internal: set whether the states of new versions are saved in
+           the background. Checkins already queued are not affected."""
+        self.async_checkin = bool(async_checkin)
+
+    @security.private
+    def listQueuedCheckins(self):
+        """Internal: return the (history_id, version_id) of the versions
+           whose states wait in the checkin queue."""
+        if self._checkin_queue is None:
+            return []
+        return self._checkin_queue.keys()
+
+    @security.private
+    def getCheckinQueueStatistics(self):
+        """Internal: return a mapping with the number of jobs in the
+           checkin queue ('depth') and the number of seconds that the
+           oldest one has waited ('lag')."""
+        queue = self._checkin_queue
+        if queue is None:
+            return {'depth': 0, 'lag': 0.0}
+        return {'depth': len(queue), 'lag': queue.getLag()}
+
+    @security.private
+    def completeCheckin(self, history_id, version_id):
+        """Internal: save the state of a version whose checkin waits in
+           the checkin queue, and remove it from the queue."""
+        key = (history_id, version_id)
+        queue = self._checkin_queue
+        job = queue.get(key) if queue is not None else None
+        history = self.getVersionHistory(history_id)
+        version = history.getVersionById(version_id)
+        if version._pending:
+            if job is None:
+                raise VersionControlError(
+                    'The state of version %s of %s is not queued.' % (
+                        version_id, history_id)
+                )
+            if version.prev is not None:
+                # Deltas and shared blobs need the state of the
+                # predecessor.
+                history.getVersionById(version.prev).ensureState()
+            resource = job.resource
+            conn = job.openAtCheckin()
+            if conn is None:
+                # The checkin has not been committed yet: the resource
+                # still has the state it was checked in with.
+                history.saveVersionState(version, resource)
+            else:
+                savepoint = self._p_jar.transaction_manager.savepoint()
+                try:
+                    history.saveVersionState(version,
+                                             conn.get(resource._p_oid))
+                except POSKeyError:
+                    # The database has been packed since the checkin.
+                    # Save the current state rather than leave the
+                    # version without one.
+                    savepoint.rollback()
+                    logger.warning(
+                        'The checked in state of version %s of %s has '
+                        'been packed away; saving the current state of '
+                        'the resource instead.', version_id, history_id)
+                    history.saveVersionState(version, resource)
+                finally:
+                    conn.close()
+        if job is not None:
+            queue.remove(key)
+
+    def _queueCheckin(self, object, history_id, version_id):
+        if self._checkin_queue is None:
+            self._checkin_queue = CheckinQueue()
+        self._checkin_queue.add((history_id, version_id), object)
+        jar = object._p_jar
+        if jar is not None:
+            addNotifyHook(jar.transaction_manager.get())
+
+    @security.private
+    def getHistoryDatabase(self, history_id):
+        """Internal: return the name of the database that the version
+           history of the given id is placed in when it is created, or
+           None for the database of the repository."""
+        names = self.history_databases
+        if not names:
+            return None
+        if self.shard_policy == 'last':
+            return names[-1]
+        return names[crc32(history_id.encode('utf-8')) % len(names)]
+
+    @security.private
+    def placeVersion(self, history, version):
+        """Internal: place a new version of a history in the database
+           picked for the history, if only versions are placed there."""
+        if self.shard_payloads_only:
+            self._placeInDatabase(
+                version, self.getHistoryDatabase(history.getId()))
+
+    def _placeInDatabase(self, object, name):
+        # Add a new persistent object to the connection of the named
+        # database, so that it and the new objects that only it refers
+        # to are stored there and referred to across databases.
+        jar = self._p_jar
+        if name is not None and jar is not None:
+            jar.get_connection(name).add(object)
+
+    @security.private
+    def getContentStore(self):
+        """Internal: return the content store shared by the histories."""
+        if self._content is None:
+            self._content = ContentStore()
+        return self._content
+
     @security.private
     def createVersionHistory(self, object):
         """Internal: create a new version history for a resource."""
-        # When one creates the first version in a version history, neither
-        # the version or version history yet have a _p_jar, which causes
-        # copy operations to fail. To work around that, we share our _p_jar.
+        if self._id_allocator is None:
+            self._id_allocator = HistoryIdAllocator()
+        prefix = getHistoryIdPrefix(self._p_jar)
         history_id = None
         while history_id is None or history_id in self._histories:
-            history_id = str(randint(1, 9999999999))
+            history_id = self._id_allocator.allocate(prefix)
         history = ZopeVersionHistory(history_id, object)
+        if not self.shard_payloads_only:
+            self._placeInDatabase(history, self.getHistoryDatabase(history_id))
         self._histories[history_id] = history
         return history.__of__(self)
 
     @security.private
     def getVersionHistory(self, history_id):
         """Internal: return a version history given a version history id."""
-        return self._histories[history_id].__of__(self)
+        history = self._getHistory(history_id)
+        if history is None:
+            raise KeyError(history_id)
+        return history.__of__(self)
+
+    def _getHistory(self, history_id):
+        # Return the history of an id, or of the id it had before
+        # migrateHistoryIds(), or None.
+        history = self._histories.get(history_id)
+        if history is None and self._history_aliases is not None:
+            new_id = self._history_aliases.get(history_id)
+            if new_id is not None:
+                history = self._histories.get(new_id)
+        return history
+
+    @security.private
+    def migrateHistoryIds(self, container=None, savepoint_interval=500):
+        """Internal: give the histories that have random ids (from before
+           ids were allocated in order) new ordered ids. The old ids are
+           kept as aliases of the new ones. If a container is given, the
+           version-controlled objects below it that have not changed
+           since their bookkeeping was saved are updated to the new ids;
+           changed objects keep the alias until the next migration, so
+           that they do not look unchanged. Return the numbers of
+           histories and objects migrated."""
+        if self._id_allocator is None:
+            self._id_allocator = HistoryIdAllocator()
+        if self._history_aliases is None:
+            self._history_aliases = OOBTree()
+        aliases = self._history_aliases
+        prefix = getHistoryIdPrefix(self._p_jar)
+        old_ids = [history_id for history_id in self._histories.keys()
+                   if isRandomHistoryId(history_id)]
+        for count, history_id in enumerate(old_ids, 1):
+            history = self._histories[history_id]
+            new_id = None
+            while new_id is None or new_id in self._histories:
+                new_id = self._id_allocator.allocate(prefix)
+            self._unindexHistory(history)
+            del self._histories[history_id]
+            history.id = new_id
+            self._histories[new_id] = history
+            self._indexHistory(history)
+            aliases[history_id] = new_id
+            stateCache.invalidate(history_id)
+            if not count % savepoint_interval:
+                transaction.savepoint(optimistic=True)
+
+        resources = 0
+        if container is not None:
+            def wanted(object):
+                info = getattr(object, '__vc_info__', None)
+                return (info is not None and info.history_id in aliases and
+                        not self.isResourceChanged(object))
+
+            def update(object, branch):
+                object.__vc_info__.history_id = aliases[
+                    object.__vc_info__.history_id]
+
+            resources = self._walkTree(container, wanted, update,
+                                       savepoint_interval)['processed']
+        return {'histories': len(old_ids), 'resources': resources}
+
+    @security.private
+    def rebuildNameIndexes(self, savepoint_interval=500):
+        """Internal: build the indexes of the histories that carry each
+           label and branch from the histories, replacing any indexes the
+           repository already has. Return the number of histories
+           indexed."""
+        self._label_index = OOBTree()
+        self._branch_index = OOTreeSet()
+        count = 0
+        for count, history in enumerate(self._histories.values(), 1):
+            self._indexHistory(history)
+            if not count % savepoint_interval:
+                transaction.savepoint(optimistic=True)
+        return count
+
+    def _indexHistory(self, history):
+        # Add the labels and branches of a history to the indexes.
+        history_id = history.getId()
+        for label, version_id in history._labels.items():
+            self._indexLabel(label, history_id, version_id)
+        for branch_id in history._branches.keys():
+            self._indexBranch(branch_id, history_id)
+
+    def _unindexHistory(self, history):
+        # Remove the labels and branches of a history from the indexes.
+        history_id = history.getId()
+        if self._label_index is not None:
+            for label in history._labels.keys():
+                self._label_index.pop((label, history_id), None)
+        if self._branch_index is not None:
+            for branch_id in history._branches.keys():
+                if (branch_id, history_id) in self._branch_index:
+                    self._branch_index.remove((branch_id, history_id))
+
+    def _indexLabel(self, label, history_id, version_id):
+        # Record that a version of a history carries a label.
+        if self._label_index is None:
+            return
+        key = (label, history_id)
+        if self._label_index.get(key) != version_id:
+            self._label_index[key] = version_id
+
+    def _indexBranch(self, branch_id, history_id):
+        # Record that a history has a branch. Every history has the
+        # mainline, which is not indexed.
+        if self._branch_index is None or branch_id == 'mainline':
+            return
+        key = (branch_id, history_id)
+        if key not in self._branch_index:
+            self._branch_index.insert(key)
 
     @security.private
     def replaceState(self, obj, new_state):
@@ -110,8 +549,8 @@ class Repository(Implicit, Persistent):
         info = getattr(object, '__vc_info__', None)
         if info is None:
             return False
-        return info.history_id in self._histories and \
-            self._histories[info.history_id].hasVersionId(info.version_id)
+        history = self._getHistory(info.history_id)
+        return history is not None and history.hasVersionId(info.version_id)
 
     @security.public
     def isResourceUpToDate(self, object, require_branch=0):
@@ -128,16 +567,56 @@ class Repository(Implicit, Persistent):
                 return 0
         return history.isLatestVersion(info.version_id, branch)
 
+    @security.public
+    def areResourcesUpToDate(self, objects, require_branch=0):
+        # Return a list of isResourceUpToDate() of each of the given
+        # resources, in the same order, looking up each history and branch
+        # once.
+        latest = {}
+        result = []
+        for object in objects:
+            info = self.getVersionInfo(object)
+            branch = 'mainline'
+            if info.sticky:
+                if info.sticky[0] == 'B':
+                    branch = info.sticky[1]
+                elif require_branch:
+                    result.append(0)
+                    continue
+            key = (info.history_id, branch)
+            if key not in latest:
+                history = self.getVersionHistory(info.history_id)
+                latest[key] = history.getLatestVersionId(branch)
+            result.append(info.version_id == latest[key])
+        return result
+
     @security.public
     def isResourceChanged(self, object):
         # Return true if the state of a resource has changed in a transaction
         # *after* the version bookkeeping was saved. Note that this method is
         # not appropriate for detecting changes within a transaction!
+        return self._isResourceChanged(object)
+
+    @security.public
+    def areResourcesChanged(self, objects):
+        # Return a list of isResourceChanged() of each of the given
+        # resources, in the same order. The walks of the resources load
+        # each record once, as resources often share subobjects.
+        caches = {}
+        result = []
+        for object in objects:
+            cache = caches.setdefault(id(object._p_jar), {})
+            result.append(self._isResourceChanged(object, cache))
+        return result
+
+    def _isResourceChanged(self, object, cache=None):
         info = self.getVersionInfo(object)
         itime = getattr(info, '_p_mtime', None)
         if itime is None:
             return 0
-        mtime = Utility._findModificationTime(object)
+        mtime = findModificationTime(object, itime, self.walk_max_depth,
+                                     self.walk_max_records,
+                                     workers=self.walk_workers, cache=cache)
         if mtime is None:
             return 0
         return mtime > itime
@@ -165,20 +644,17 @@ class Repository(Implicit, Persistent):
         # Need to check the parent to see if the container of the object
         # being put under version control is itself a version-controlled
         # object. If so, we need to use the branch id of the container.
-        branch = 'mainline'
-        parent = aq_parent(aq_inner(object))
-        p_info = getattr(parent, '__vc_info__', None)
-        if p_info is not None:
-            sticky = p_info.sticky
-            if sticky and sticky[0] == 'B':
-                branch = sticky[1]
+        branch = _branchOf(aq_parent(aq_inner(object)))
+        return self._applyVersionControl(object, branch, message)
 
+    def _applyVersionControl(self, object, branch, message):
         # Create a new version history and initial version object.
         history = self.createVersionHistory(object)
         version = history.createVersion(object, branch)
 
         history_id = history.getId()
         version_id = version.getId()
+        self._indexBranch(branch, history_id)
 
         # Add bookkeeping information to the version controlled object.
         info = VersionInfo(history_id, version_id, VersionInfo.CHECKED_IN)
@@ -194,6 +670,89 @@ class Repository(Implicit, Persistent):
                             )
         return object
 
+    @security.protected(use_vc_permission)
+    def applyVersionControlTree(self, container, message=None,
+                                savepoint_interval=500):
+        # Put a container and all versionable objects below it that are
+        # not yet under version control under version control, and return
+        # a summary of the work done (see _walkTree).
+        def wanted(object):
+            return (self.isAVersionableResource(object) and
+                    not self.isUnderVersionControl(object))
+
+        def apply(object, branch):
+            self._applyVersionControl(object, branch, message)
+
+        return self._walkTree(container, wanted, apply, savepoint_interval)
+
+    @security.protected(use_vc_permission)
+    def checkoutTree(self, container, savepoint_interval=500):
+        # Check out a container and all checked in objects below it, and
+        # return a summary of the work done (see _walkTree).
+        def wanted(object):
+            info = getattr(object, '__vc_info__', None)
+            return info is not None and info.status == info.CHECKED_IN
+
+        def checkout(object, branch):
+            self.checkoutResource(object)
+
+        return self._walkTree(container, wanted, checkout,
+                              savepoint_interval)
+
+    @security.protected(use_vc_permission)
+    def checkinTree(self, container, message='', savepoint_interval=500):
+        # Check in a container and all checked out objects below it, and
+        # return a summary of the work done (see _walkTree).
+        def wanted(object):
+            info = getattr(object, '__vc_info__', None)
+            return info is not None and info.status == info.CHECKED_OUT
+
+        def checkin(object, branch):
+            self.checkinResource(object, message)
+
+        return self._walkTree(container, wanted, checkin, savepoint_interval)
+
+    def _walkTree(self, container, wanted, action, savepoint_interval):
+        # Walk a container and the objects below it once, parents before
+        # their items, and call action(object, branch) for each object for
+        # which wanted(object) is true, where branch is the branch of the
+        # version-controlled parent of the object. A savepoint is taken
+        # every savepoint_interval actions to bound the memory used. The
+        # summary returned counts the objects processed and skipped, and
+        # lists the (path, message) of each object that failed. Conflict
+        # errors are raised, as they make the whole transaction fail.
+        jar = container._p_jar
+        repository = aq_base(self)
+        summary = {'processed': 0, 'skipped': 0, 'errors': []}
+        pending = 0
+        stack = [(container, _branchOf(aq_parent(aq_inner(container))))]
+        while stack:
+            object, branch = stack.pop()
+            if aq_base(object) is repository:
+                continue
+            try:
+                if not wanted(object):
+                    summary['skipped'] += 1
+                else:
+                    action(object, branch)
+                    summary['processed'] += 1
+                    pending += 1
+            except ConflictError:
+                raise
+            except Exception as error:
+                summary['errors'].append((_findPath(object),
+                                          _errorMessage(error)))
+            if pending >= savepoint_interval:
+                transaction.savepoint(optimistic=True)
+                if jar is not None:
+                    jar.cacheGC()
+                pending = 0
+            if getattr(aq_base(object), 'objectValues', None) is not None:
+                branch = _branchOf(object)
+                stack.extend((item, branch)
+                             for item in reversed(object.objectValues()))
+        return summary
+
     @security.protected(use_vc_permission)
     def checkoutResource(self, object):
         info = self.getVersionInfo(object)
@@ -256,7 +815,28 @@ class Repository(Implicit, Persistent):
         if info.sticky is not None and info.sticky[0] == 'B':
             branch = info.sticky[1]
 
-        version = history.createVersion(object, branch)
+        fingerprints = None
+        if self.skip_unchanged:
+            fingerprints = fingerprintGraph(aq_base(object),
+                                            listNonVersionedObjects(object))
+            version = history.getVersionById(info.version_id)
+            if version.getFingerprint() == fingerprints[0]:
+                # The resource is up to date, so the version it was
+                # checked out from is the latest and can stand in for it.
+                history.addLogEntry(info.version_id,
+                                    LogEntry.ACTION_CHECKIN_UNCHANGED,
+                                    ob_path,
+                                    message
+                                    )
+                newinfo = info.clone()
+                newinfo.status = newinfo.CHECKED_IN
+                object.__vc_info__ = newinfo
+                return object
+
+        version = history.createVersion(object, branch, fingerprints,
+                                        deferred=self.async_checkin)
+        if self.async_checkin:
+            self._queueCheckin(object, history.getId(), version.getId())
 
         # Save an audit record of the action being performed.
         history.addLogEntry(version.getId(),
@@ -311,7 +891,16 @@ class Repository(Implicit, Persistent):
             )
 
         history = self.getVersionHistory(info.history_id)
-        version = None
+        version_id, sticky = self._selectVersionId(history, info, selector)
+        return self._updateResource(object, info, history, version_id,
+                                    sticky)
+
+    def _selectVersionId(self, history, info, selector):
+        # Return the id of the version of a history that a resource is
+        # updated to by the given selector, or None if the resource keeps
+        # its version, and the sticky tag of the resource after the update.
+        # Versions are found by id, so that they are not loaded.
+        version_id = None
         sticky = info.sticky
 
         if not selector:
@@ -323,29 +912,29 @@ class Repository(Implicit, Persistent):
             if sticky and sticky[0] == 'L':
                 # A label sticky tag, so update to that label (since it is
                 # possible, but unlikely, that the label has been moved).
-                version = history.getVersionByLabel(sticky[1])
+                version_id = history.getVersionIdByLabel(sticky[1])
             elif sticky and sticky[0] == 'B':
                 # A branch sticky tag. Update to latest version on branch.
-                version = history.getLatestVersion(selector)
+                version_id = history.getLatestVersionId(selector)
             else:
                 # Update to mainline, forgetting any date or version id
                 # sticky tag that was previously associated with the object.
-                version = history.getLatestVersion('mainline')
+                version_id = history.getLatestVersionId('mainline')
                 sticky = None
         else:
             # If the selector is non-null, we find the version specified
             # and update the sticky tag. Later we'll check the version we
             # found and decide whether we really need to update the object.
             if isinstance(selector, str) and history.hasVersionId(selector):
-                version = history.getVersionById(selector)
+                version_id = selector
                 sticky = ('V', selector)
 
             elif isinstance(selector, str) and selector in self._labels:
-                version = history.getVersionByLabel(selector)
+                version_id = history.getVersionIdByLabel(selector)
                 sticky = ('L', selector)
 
             elif isinstance(selector, str) and selector in self._branches:
-                version = history.getLatestVersion(selector)
+                version_id = history.getLatestVersionId(selector)
                 if selector == 'mainline':
                     sticky = None
                 else:
@@ -363,13 +952,16 @@ class Repository(Implicit, Persistent):
                     # Fix!
                     branch = history.findBranchId(info.version_id)
                     version = history.getVersionByDate(branch, timestamp)
+                    version_id = version and version.getId()
+        return version_id, sticky
 
+    def _updateResource(self, object, info, history, version_id, sticky):
         # If the state of the resource really needs to be changed, do the
         # update and make a log entry for the update.
-        version_id = version and version.getId() or info.version_id
+        version_id = version_id or info.version_id
         new_object = object
-        if version and (version_id != info.version_id):
-            new_object = version.copyState()
+        if version_id != info.version_id:
+            new_object = history.getVersionById(version_id).copyState()
             new_object = self.replaceState(object, new_object)
 
             history.addLogEntry(version_id,
@@ -386,6 +978,61 @@ class Repository(Implicit, Persistent):
         new_object.__vc_info__ = newinfo
         return new_object
 
+    @security.protected(use_vc_permission)
+    def updateTreeToSelector(self, container, selector,
+                             savepoint_interval=500, progress=None):
+        # Update a container and all checked in objects below it to the
+        # versions named by a selector, as updateResource() does, and
+        # return a summary of the work done. The versions are looked up
+        # for all objects first, without loading their states, and objects
+        # that are already at their version are skipped. The others are
+        # updated with a savepoint and a minimized cache every
+        # savepoint_interval objects, after which progress(done, total)
+        # is called if given.
+        targets = []
+
+        def wanted(object):
+            info = getattr(aq_base(object), '__vc_info__', None)
+            return info is not None and info.status == info.CHECKED_IN
+
+        def select(object, branch):
+            info = object.__vc_info__
+            history = self.getVersionHistory(info.history_id)
+            version_id, sticky = self._selectVersionId(history, info,
+                                                       selector)
+            if (version_id or info.version_id) != info.version_id or \
+                    sticky != info.sticky:
+                targets.append((_findPath(object), version_id, sticky))
+
+        walk = self._walkTree(container, wanted, select, savepoint_interval)
+        summary = {'updated': 0, 'retagged': 0,
+                   'skipped': walk['processed'] - len(targets),
+                   'errors': walk['errors']}
+        jar = container._p_jar
+        for done, (path, version_id, sticky) in enumerate(targets, 1):
+            try:
+                object = container.unrestrictedTraverse(path)
+                info = self.getVersionInfo(object)
+                history = self.getVersionHistory(info.history_id)
+                self._updateResource(object, info, history, version_id,
+                                     sticky)
+            except ConflictError:
+                raise
+            except Exception as error:
+                summary['errors'].append((path, _errorMessage(error)))
+            else:
+                if (version_id or info.version_id) != info.version_id:
+                    summary['updated'] += 1
+                else:
+                    summary['retagged'] += 1
+            if not done % savepoint_interval or done == len(targets):
+                transaction.savepoint(optimistic=True)
+                if jar is not None:
+                    jar.cacheMinimize()
+                if progress is not None:
+                    progress(done, len(targets))
+        return summary
+
     @security.protected(use_vc_permission)
     def labelResource(self, object, label, force=0):
         info = self.getVersionInfo(object)
@@ -399,11 +1046,11 @@ class Repository(Implicit, Persistent):
             raise VersionControlError(
                 'The label value given is already in use as an activity id.'
             )
-        if label not in self._labels:
-            self._labels[label] = 1
+        self._addName('_labels', label)
 
         history = self.getVersionHistory(info.history_id)
         history.labelVersion(info.version_id, label, force)
+        self._indexLabel(label, history.getId(), info.version_id)
         return object
 
     @security.protected(use_vc_permission)
@@ -426,8 +1073,7 @@ class Repository(Implicit, Persistent):
                 'The value given is already in use as a version label.'
             )
 
-        if branch_id not in self._branches:
-            self._branches[branch_id] = 1
+        self._addName('_branches', branch_id)
 
         history = self.getVersionHistory(info.history_id)
 
@@ -437,8 +1083,20 @@ class Repository(Implicit, Persistent):
             )
 
         history.createBranch(branch_id, info.version_id)
+        self._indexBranch(branch_id, history.getId())
         return object
 
+    def _addName(self, attr, name):
+        # Add a label or activity id to the names in use. Repositories
+        # created before names were kept in a NameSet get one now.
+        names = getattr(self, attr)
+        if name in names:
+            return
+        if not isinstance(names, NameSet):
+            names = NameSet(names.keys())
+            setattr(self, attr, names)
+        names.add(name)
+
     @security.protected(use_vc_permission)
     def getVersionOfResource(self, history_id, selector):
         history = self.getVersionHistory(history_id)
@@ -490,11 +1148,73 @@ class Repository(Implicit, Persistent):
         history = self.getVersionHistory(info.history_id)
         return history.getLabels()
 
+    @security.protected(use_vc_permission)
+    def getLabelsForHistory(self, object):
+        info = self.getVersionInfo(object)
+        history = self.getVersionHistory(info.history_id)
+        return list(history.getLabels())
+
+    @security.protected(use_vc_permission)
+    def getLabelsForVersion(self, object, version_id=None):
+        # Return the labels of the given version of the history of the
+        # object, or of the version that the object is at.
+        info = self.getVersionInfo(object)
+        history = self.getVersionHistory(info.history_id)
+        return history.getLabelsForVersion(version_id or info.version_id)
+
     @security.protected(use_vc_permission)
     def getLogEntries(self, object):
         info = self.getVersionInfo(object)
         history = self.getVersionHistory(info.history_id)
         return history.getLogEntries()
 
+    @security.protected(use_vc_permission)
+    def getLabeledVersions(self, label, min=None, max=None):
+        # Return the (history_id, version_id) of the versions that carry
+        # the given label, in the order of their history ids. If min or
+        # max are given, only histories with ids in that range are
+        # included.
+        if self._label_index is None:
+            # The repository has not been indexed yet: look at every
+            # history.
+            return [(history.getId(), history._labels[label])
+                    for history in self._histories.values(min, max)
+                    if label in history._labels]
+        return [(history_id, version_id) for (name, history_id), version_id
+                in self._label_index.items(*_nameRange(label, min, max))]
+
+    @security.protected(use_vc_permission)
+    def getBranchHistoryIds(self, branch_id, min=None, max=None):
+        # Return the ids of the version histories that have the given
+        # branch, in order. If min or max are given, only ids in that
+        # range are included.
+        if branch_id == 'mainline':
+            return list(self._histories.keys(min, max))
+        if self._branch_index is None:
+            return [history.getId()
+                    for history in self._histories.values(min, max)
+                    if branch_id in history._branches]
+        return [history_id for name, history_id
+                in self._branch_index.keys(*_nameRange(branch_id, min, max))]
+
 
 InitializeClass(Repository)
+
+
+def _branchOf(parent):
+    # Return the branch that new versions of the items of a container are
+    # created on: the branch that the container is updated to, if it is
+    # under version control, or the mainline.
+    info = getattr(parent, '__vc_info__', None)
+    if info is not None and info.sticky and info.sticky[0] == 'B':
+        return info.sticky[1]
+    return 'mainline'
+
+
+def _errorMessage(error):
+    # Return the message recorded for an object that a tree operation
+    # failed on, naming the kind of error unless it is a
+    # VersionControlError.
+    if isinstance(error, VersionControlError):
+        return str(error)
+    return '%s: %s' % (error.__class__.__name__, error)
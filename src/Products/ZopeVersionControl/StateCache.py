@@ -0,0 +1,132 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+import threading
+from collections import OrderedDict
+
+from AccessControl import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+
+
+class StateCache:
+    """A StateCache holds snapshots of the states of versions, so that
+       a version that is copied often is loaded from the database only
+       once per process. The cache is keyed by (history_id, version_id)
+       and least recently used snapshots are evicted when the number of
+       entries or the total size of the snapshots exceeds its limits.
+
+       Each entry records the oid and serial of the version that the
+       snapshot was taken from, so that a version of another database,
+       or a version that has been changed, is never served a stale
+       snapshot."""
+
+    def __init__(self, max_entries=100, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    security = ClassSecurityInfo()
+
+    @security.private
+    def get(self, key, oid, serial):
+        """Return the snapshot cached for the given key, oid and serial,
+           or None if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[:2] != (oid, serial):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    @security.private
+    def set(self, key, oid, serial, snapshot):
+        """Cache the snapshot of a version, evicting the least recently
+           used snapshots as needed. A snapshot that is larger than the
+           cache is not cached."""
+        with self._lock:
+            self._remove(key)
+            if snapshot.size > self.max_bytes or self.max_entries < 1:
+                return
+            self._entries[key] = (oid, serial, snapshot)
+            self._bytes += snapshot.size
+            self._evict()
+
+    @security.private
+    def invalidate(self, history_id, version_id=None):
+        """Remove the snapshot of a version, or of all versions of a
+           version history if no version id is given."""
+        with self._lock:
+            if version_id is not None:
+                self._remove((history_id, version_id))
+                return
+            for key in list(self._entries):
+                if key[0] == history_id:
+                    self._remove(key)
+
+    @security.private
+    def clear(self):
+        """Remove all snapshots and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    @security.private
+    def setLimits(self, max_entries=None, max_bytes=None):
+        """Change the maximum number of entries or bytes of the cache."""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    @security.private
+    def getStatistics(self):
+        """Return a mapping with the counters and the current size of
+           the cache."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2].size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self._bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[2].size
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+InitializeClass(StateCache)
+
+
+# The cache of version states of this process.
+stateCache = StateCache()
@@ -11,8 +11,16 @@
 #
 ##############################################################################
 
+import atexit
 import os
+import threading
 import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pickletools import genops
+from pickletools import markobject
 
 from AccessControl import getSecurityManager
 from AccessControl.class_init import InitializeClass
@@ -26,6 +34,10 @@ _dtmldir = os.path.join(package_home(globals()), 'dtml')
 
 use_vc_permission = 'Use version control'
 
+# The number of records that _findModificationTime asks the storage to
+# prefetch at once.
+PREFETCH_BATCH = 100
+
 
 def isAVersionableResource(obj):
     """ True if an object is versionable.
@@ -112,45 +124,286 @@ def _findPath(object):
     return '/'.join(path)
 
 
-def _findModificationTime(object):
+# The numbers of the open database connections of this process.
+_connection_numbers = weakref.WeakKeyDictionary()
+_connection_numbers_lock = threading.Lock()
+
+
+def _connectionNumber(conn):
+    # Return the number of a database connection in this process: the
+    # smallest number that no other live connection has, so that the
+    # numbers stay as small as the connection pools.
+    with _connection_numbers_lock:
+        number = _connection_numbers.get(conn)
+        if number is None:
+            used = set(_connection_numbers.values())
+            number = 0
+            while number in used:
+                number += 1
+            _connection_numbers[conn] = number
+        return number
+
+
+def _nameRange(name, min=None, max=None):
+    # Return the arguments to the keys() of an index of (name, id) keys
+    # that select the keys of the given name with ids from min to max.
+    low = (name,) if min is None else (name, min)
+    if max is None:
+        # Only the keys of this name sort before the next possible name.
+        return low, (name + '\0',), False, True
+    return low, (name, max), False, False
+
+
+def _findModificationTime(object, newer_than=None, max_depth=None,
+                          max_records=None, stats=None, workers=None,
+                          cache=None):
     """Find the last modification time for a version-controlled object.
        The modification time reflects the latest modification time of
        the object or any of its persistent subobjects that are not
        themselves version-controlled objects. Note that this will
-       return None if the object has no modification time."""
+       return None if the object has no modification time.
+
+       The walk of the subobjects stops as soon as a time later than
+       newer_than is found, and does not go further than max_depth
+       references from the object or load more than max_records
+       records; the time returned is then the latest time found so far.
+       If stats is a mapping, the numbers of records and bytes loaded
+       are added to its 'records' and 'bytes' keys, and its 'complete'
+       key tells whether all subobjects were walked.
+
+       If workers is given, each batch of records is loaded by that
+       many threads at once, which helps with storages that have to
+       fetch each record over the network. The result is the same as
+       with a serial walk.
+
+       If cache is a mapping, what the walk needs of each record it
+       loads is kept in it, and records already in it are not loaded
+       again. Walks of objects of the same connection may share a
+       cache for as long as the connection does not see new
+       transactions."""
+    return _scanModificationTime(
+        object, newer_than, max_depth, max_records, stats, workers,
+        cache)[0]
+
+
+def _scanModificationTime(object, newer_than=None, max_depth=None,
+                          max_records=None, stats=None, workers=None,
+                          cache=None):
+    """Return a tuple (mtime, oids, complete) of the last modification
+       time of a version-controlled object, as computed by
+       _findModificationTime, a mapping from the oid of each record that
+       was visited to whether its modification time counts, and whether
+       all subobjects were walked. The mtime is None (and the mapping is
+       empty) if the object has no modification time."""
 
     mtime = getattr(object, '_p_mtime', None)
     if mtime is None:
-        return None
+        if stats is not None:
+            stats.setdefault('records', 0)
+            stats.setdefault('bytes', 0)
+            stats['complete'] = True
+        return None, {}, True
 
     latest = mtime
     conn = object._p_jar
+    if workers and getattr(conn._storage, '_start', None) is not None:
+        loads = _parallelLoads(conn, workers)
+    else:
+        loads = _serialLoads(conn)
+    queue = deque([(object._p_oid, 0)])
+    visited = {}
+    if cache is None:
+        cache = {}
+    records = size = 0
+    stopped = newer_than is not None and latest > newer_than
+    truncated = False
+
+    while queue and not stopped:
+        batch = []
+        while queue and len(batch) < PREFETCH_BATCH:
+            oid, depth = queue.popleft()
+            if oid not in visited:
+                visited[oid] = False
+                batch.append((oid, depth))
+
+        results = iter(loads([oid for oid, depth in batch
+                              if oid not in cache]))
+        for oid, depth in batch:
+            if oid in cache:
+                entry = cache[oid]
+            else:
+                if max_records is not None and records >= max_records:
+                    stopped = True
+                    break
+                record = next(results)
+                if record is None:
+                    entry = None  # invalid reference!
+                else:
+                    p, serial = record
+                    records += 1
+                    size += len(p)
+                    references, versioned = _scanRecord(p)
+                    entry = (serial, not versioned, references)
+                cache[oid] = entry
+            if entry is None:
+                continue
+            serial, counts, references = entry
+            if not depth:
+                visited[oid] = True
+            elif counts:
+                visited[oid] = True
+                mtime = TimeStamp(serial).timeTime()
+                if mtime > latest:
+                    latest = mtime
+                    if newer_than is not None and latest > newer_than:
+                        stopped = True
+                        break
+            if max_depth is not None and depth >= max_depth:
+                truncated = truncated or bool(references)
+                continue
+            queue.extend((ref, depth + 1) for ref in references)
+
+    complete = not (queue or stopped or truncated)
+    if stats is not None:
+        stats['records'] = stats.get('records', 0) + records
+        stats['bytes'] = stats.get('bytes', 0) + size
+        stats['complete'] = complete
+    return latest, visited, complete
+
+
+def _scanRecord(p):
+    """Return a tuple (references, versioned) of the oids referenced by
+       a database record and whether the record is the state of a
+       version-controlled object, that is whether its state has a
+       __vc_info__ attribute."""
+    return referencesf(p), _VC_INFO in p and _hasVersionInfo(p)
+
+
+_VC_INFO = b'__vc_info__'
+_MARK = object()
+
+
+def _hasVersionInfo(p):
+    """Return true if the state pickle of a database record sets the
+       __vc_info__ key of its top-level dict, whatever the protocol of
+       the pickle. The pickle is scanned opcode by opcode, keeping track
+       of the string values on the stack and in the memo only."""
+    stream = BytesIO(p)
+    for op in genops(stream):
+        pass  # Skip the class of the record.
+    stack = []
+    memo = {}
+    for opcode, arg, pos in genops(stream):
+        name = opcode.name
+        if name in ('SETITEM', 'SETITEMS'):
+            if name == 'SETITEMS':
+                mark = len(stack) - 1 - stack[::-1].index(_MARK)
+                items = stack[mark + 1:]
+                del stack[mark:]
+            else:
+                items = stack[-2:]
+                del stack[-2:]
+            # The state dict (or the dict of a (dict, slots) state) is
+            # the only object on the stack when its items are set.
+            if ('__vc_info__' in items[::2] and
+                    all(item is _MARK for item in stack[:-1])):
+                return True
+            continue
+        if name == 'MEMOIZE':
+            memo[len(memo)] = stack[-1]
+            continue
+        if name in ('PUT', 'BINPUT', 'LONG_BINPUT'):
+            memo[arg] = stack[-1]
+            continue
+        before = opcode.stack_before
+        if markobject in before:
+            mark = len(stack) - 1 - stack[::-1].index(_MARK)
+            del stack[mark - before.index(markobject):]
+        elif before:
+            del stack[-len(before):]
+        for kind in opcode.stack_after:
+            if kind is markobject:
+                stack.append(_MARK)
+            elif name in ('GET', 'BINGET', 'LONG_BINGET'):
+                stack.append(memo.get(arg))
+            elif isinstance(arg, str):
+                stack.append(arg)
+            else:
+                stack.append(None)
+    return False
+
+
+def _serialLoads(conn):
+    # Return a function that loads a batch of records one by one, after
+    # asking the storage to fetch them all at once (a no-op for storages
+    # without prefetching).
     load = conn._storage.load
-    refs = referencesf
 
-    oids = [object._p_oid]
-    done_oids = set()
-    done = done_oids.__contains__
-    first = 1
+    def loads(oids):
+        if len(oids) > 1:
+            conn.prefetch(oids)
+        for oid in oids:
+            try:
+                yield load(oid)
+            except Exception:
+                yield None
 
-    while oids:
-        oid = oids[0]
-        del oids[0]
-        if done(oid):
-            continue
-        done_oids.add(oid)
+    return loads
+
+
+def _parallelLoads(conn, workers):
+    # Return a function that loads a batch of records in a pool of
+    # threads. The records are loaded from the storage of the database
+    # as of the last transaction seen by the connection, as its MVCC
+    # adapter does, since the adapter itself need not be thread-safe.
+    loadBefore = conn.db().storage.loadBefore
+    start = conn._storage._start
+
+    def load(oid):
         try:
-            p, serial = load(oid)
+            record = loadBefore(oid, start)
         except Exception:
-            pass  # invalid reference!
-        else:
-            if first is not None:
-                first = None
-            else:
-                if p.find(b'U\x0b__vc_info__') == -1:
-                    mtime = TimeStamp(serial).timeTime()
-                    if mtime > latest:
-                        latest = mtime
-            refs(p, oids)
-
-    return latest
+            return None
+        return record and record[:2]
+
+    def loads(oids):
+        while True:
+            try:
+                return _getLoadPool(workers).map(load, oids)
+            except RuntimeError:
+                # Another thread replaced the pool meanwhile.
+                continue
+
+    return loads
+
+
+# The shared loading pool and its number of threads.
+_load_pool = None
+_load_workers = 0
+_load_pool_lock = threading.Lock()
+
+
+def _getLoadPool(workers):
+    # Return the shared pool of loading threads, replacing it if it was
+    # made for another number of threads. Loads already handed to the old
+    # pool are still done.
+    global _load_pool, _load_workers
+    with _load_pool_lock:
+        pool = _load_pool
+        if pool is None or _load_workers != workers:
+            if pool is not None:
+                pool.shutdown(wait=False)
+            pool = _load_pool = ThreadPoolExecutor(
+                workers, thread_name_prefix='ZVC-load')
+            _load_workers = workers
+        return pool
+
+
+@atexit.register
+def _shutdownLoadPool():
+    # Stop the threads of the shared loading pool.
+    global _load_pool
+    with _load_pool_lock:
+        pool, _load_pool = _load_pool, None
+    if pool is not None:
+        pool.shutdown()
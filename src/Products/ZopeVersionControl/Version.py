@@ -11,28 +11,71 @@
 #
 ##############################################################################
 
+import os
+import pickle
+import shutil
 import time
+import zlib
+from hashlib import sha256
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 
 from AccessControl import ClassSecurityInfo
 from AccessControl.class_init import InitializeClass
 from Acquisition import Implicit
 from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from BTrees.OOBTree import OOBTree
 from OFS.SimpleItem import SimpleItem
 from Persistence import Persistent
+from persistent import Persistent as PersistentBase
+from ZODB._compat import HIGHEST_PROTOCOL
 from ZODB._compat import Pickler
 from ZODB._compat import Unpickler
+from ZODB.blob import Blob
+from ZODB.blob import BlobError
+from ZODB.POSException import ConflictError
+from ZODB.POSException import POSKeyError
+from ZODB.utils import mktemp
+from ZODB.utils import z64
 
+from .delta import MAX_INSERT
+from .delta import applyDelta
+from .delta import computeDelta
 from .nonversioned import listNonVersionedObjects
 from .nonversioned import removeNonVersionedData
+from .StateCache import stateCache
+from .Utility import VersionInfo
 
 
-def cloneByPickle(obj, ignore_list=()):
-    """Makes a copy of a ZODB object, loading ghosts as needed.
+try:
+    import lzma
+except ModuleNotFoundError:
+    # Python may be built without lzma support.
+    lzma = None
+# Immutable strings at least this long are handed to a clone by reference
+# instead of being copied through the pickle stream. File and Image data
+# is kept in chunks of this size.
+LARGE_VALUE = 1 << 16
 
-    Ignores specified objects along the way, replacing them with None
-    in the copy.
-    """
+# Snapshots whose pickle stream grows beyond this many bytes are spooled
+# to a temporary file, unless the repository sets spool_threshold.
+SPOOL_THRESHOLD = 1 << 24
+
+# Attribute values of these types, and strings of at most METADATA_SIZE
+# characters or bytes, are captured as the metadata of a version.
+_simpleTypes = (str, bytes, int, float, bool, type(None))
+METADATA_SIZE = 1024
+
+# The codecs that serialized version states can be compressed with, as
+# a mapping of codec name to (compress, decompress) functions.
+codecs = {'zlib': (zlib.compress, zlib.decompress)}
+if lzma is not None:
+    codecs['lzma'] = (lzma.compress, lzma.decompress)
+
+
+def _ignoringPersistentId(ignore_list):
     ignore_dict = {}
     for o in ignore_list:
         ignore_dict[id(o)] = o
@@ -44,24 +87,687 @@ def cloneByPickle(obj, ignore_list=()):
             ob._p_changed = 0
         return None
 
-    def persistent_load(ref):
-        assert ref == 'ignored'
-        # Return a placeholder object that will be replaced by
-        # removeNonVersionedData().
-        placeholder = SimpleItem()
-        placeholder.id = "ignored_subobject"
-        return placeholder
+    return persistent_id
+
+
+def _placeholderLoad(ref):
+    assert ref == 'ignored'
+    # Return a placeholder object that will be replaced by
+    # removeNonVersionedData().
+    placeholder = SimpleItem()
+    placeholder.id = "ignored_subobject"
+    return placeholder
+
+
+def _committedBlobFile(blob):
+    """Return the name of the committed file of a blob, or None if the
+       blob has no committed file or has uncommitted changes."""
+    if blob._p_changed is None:
+        blob._p_activate()
+    try:
+        return blob.committed()
+    except (BlobError, POSKeyError):
+        return None
+
+
+def copyBlob(blob, candidates=()):
+    """Return a blob with the same data as the given blob.
+
+    A blob in candidates that shares the committed file of the given
+    blob is returned as it is. Otherwise a new blob is made that is a
+    hard link to the committed file, so that the data is not copied.
+    The data of a blob with uncommitted changes is copied.
+    """
+    filename = _committedBlobFile(blob)
+    if filename is not None:
+        for candidate in candidates:
+            other = _committedBlobFile(candidate)
+            if other is not None and os.path.samefile(filename, other):
+                return candidate
+        storage = blob._p_jar.db()._storage
+        link = mktemp(dir=storage.temporaryDirectory(), prefix='BUC')
+        os.remove(link)
+        try:
+            os.link(filename, link)
+        except OSError:
+            # The file system does not support hard links.
+            pass
+        else:
+            res = Blob()
+            res.consumeFile(link)
+            return res
+    res = Blob()
+    with blob.open('r') as source, res.open('w') as target:
+        shutil.copyfileobj(source, target)
+    return res
+
+
+def serializeState(obj, ignore_list=(), blobs=None):
+    """Returns the pickled state of a ZODB object, loading ghosts as needed.
+
+    Objects in the ignore list are written as references that
+    deserializeState() replaces with placeholders. Blobs are written as
+    references to their position in the blobs list, which they are
+    appended to.
+
+    Like ZODB and takeSnapshot(), the state of each persistent subobject
+    is pickled on its own, after the state of the object, so long chains
+    of subobjects (such as the data chunks of a large File) are
+    serialized without recursion. The object itself comes first in the
+    stream, so that its top-level state can be read on its own.
+    """
+    if blobs is None:
+        blobs = []
+    ignore_dict = {}
+    for o in ignore_list:
+        ignore_dict[id(o)] = o
+    refs = {}
+    originals = []
+
+    def persistent_id(ob):
+        if id(ob) in ignore_dict:
+            return 'ignored'
+        if ob is obj or not isinstance(ob, PersistentBase):
+            if getattr(ob, '_p_changed', 0) is None:
+                ob._p_changed = 0
+            return None
+        ref = refs.get(id(ob))
+        if ref is not None:
+            return ref
+        if isinstance(ob, Blob):
+            ref = refs[id(ob)] = ('blob', len(blobs))
+            blobs.append(ob)
+            return ref
+        args = ()
+        if hasattr(ob, '__getnewargs__'):
+            args = ob.__getnewargs__()
+        ref = refs[id(ob)] = ('p', len(originals), ob.__class__, args)
+        originals.append(ob)
+        return ref
 
     stream = BytesIO()
-    p = Pickler(stream, 1)
+    p = Pickler(stream, HIGHEST_PROTOCOL)
     p.persistent_id = persistent_id
     p.dump(obj)
-    stream.seek(0)
+    # Pickling a state may find more subobjects, extending originals.
+    index = 0
+    while index < len(originals):
+        ob = originals[index]
+        if ob._p_changed is None:
+            ob._p_changed = 0
+        p.dump(ob.__getstate__())
+        index += 1
+    return stream.getvalue()
+
+
+def deserializeState(data, store=None, blobs=(), copy_blobs=True):
+    """Returns a new object graph from a state made by serializeState()
+       or serializeContent().
+
+    The content store is needed to load the subobject states that a
+    state made by serializeContent() refers to. The blobs are those
+    that the state refers to; the new object graph gets copies of them,
+    or the blobs themselves if copy_blobs is false.
+    """
+    memo = {}
+    copies = {}
+    pending = []
+    setters = []
+
+    def persistent_load(ref):
+        if ref == 'ignored':
+            return _placeholderLoad(ref)
+        if ref[0] == 'p':
+            tag, index, klass, args = ref
+            ob = copies.get(index)
+            if ob is None:
+                ob = copies[index] = klass.__new__(klass, *args)
+            return ob
+        # The same reference always means the same subobject within a
+        # state, so shared subobjects stay shared in the copy.
+        name = ref[:2] + ref[4:]
+        ob = memo.get(name)
+        if ob is None:
+            if ref[0] == 'blob':
+                ob = blobs[ref[1]]
+                if copy_blobs:
+                    ob = copyBlob(ob)
+            else:
+                tag, key, klass, args = ref[:4]
+                ob = klass.__new__(klass, *args)
+                pending.append((ob, key))
+            memo[name] = ob
+        return ob
+
+    stream = BytesIO(data)
     u = Unpickler(stream)
     u.persistent_load = persistent_load
+    res = u.load()
+    # The states of the subobjects follow the object, in the order of
+    # their references.
+    states = []
+    while stream.tell() < len(data):
+        states.append(u.load())
+    for index, state in enumerate(states):
+        setters.append((copies[index], state))
+    # The states of content store records are loaded one at a time, as
+    # loading one may refer to more.
+    while pending:
+        ob, key = pending.pop()
+        u = Unpickler(BytesIO(store.get(key)))
+        u.persistent_load = persistent_load
+        setters.append((ob, u.load()))
+    # Set the states of the leaves first, as their containers may look
+    # at them when their own state is set.
+    for ob, state in reversed(setters):
+        ob.__setstate__(state)
+    return res
+
+
+def _loadTopLevel(data):
+    """Returns the object unpickled from a serialized state, with None
+       in place of the subobjects that the state refers to by reference.
+       The states of the subobjects that follow it are not read.
+    """
+    u = Unpickler(BytesIO(data))
+    u.persistent_load = lambda ref: None
     return u.load()
 
 
+def captureMetadata(obj, names):
+    """Returns a mapping of those of the named attributes of an object
+       that have small immutable values."""
+    metadata = {}
+    base = aq_base(obj)
+    if getattr(base, '_p_changed', 0) is None:
+        base._p_activate()
+    for name in names:
+        value = base.__dict__.get(name)
+        if value is None or not isinstance(value, _simpleTypes):
+            continue
+        if isinstance(value, (str, bytes)) and len(value) > METADATA_SIZE:
+            continue
+        metadata[name] = value
+    return metadata
+
+
+class _NullWriter:
+    """A file-like object that drops what is written to it."""
+
+    def write(self, data):
+        pass
+
+
+def serializeContent(obj, ignore_list=(), blobs=None):
+    """Returns the pickled state of a ZODB object with the state of each
+    persistent subobject pickled separately and referred to by a hash of
+    that state and its class. Blobs are handled as by serializeState().
+
+    Returns a tuple of the state, the keys of the subobject states that
+    it refers to and a list of (key, state, children) records for all of
+    the subobjects, children first. Returns None if the subobjects refer
+    to each other in a cycle, which content addressing cannot represent.
+
+    The graph of subobjects is walked without recursion, so long chains
+    of subobjects (such as the data chunks of a large File) can be
+    serialized: the subobjects are found first, and then pickled with
+    the keys of their children, leaves first.
+    """
+    if blobs is None:
+        blobs = []
+    ignore_dict = {}
+    for o in ignore_list:
+        ignore_dict[id(o)] = o
+    nodes = [obj]
+    indexes = {id(obj): 0}
+    blob_pids = {}
+    pids = {}
+
+    def makePersistentId(root, children):
+        def persistent_id(ob):
+            if getattr(ob, '_p_changed', 0) is None:
+                ob._p_changed = 0
+            if ob is root:
+                return None
+            if id(ob) in ignore_dict:
+                return 'ignored'
+            if isinstance(ob, Blob):
+                # The position of the blob is stored rather than its
+                # data, so a shared subobject state refers to the blob
+                # of whichever version is loaded.
+                pid = blob_pids.get(id(ob))
+                if pid is None:
+                    pid = blob_pids[id(ob)] = ('blob', len(blobs))
+                    blobs.append(ob)
+                return pid
+            if not isinstance(ob, PersistentBase) or \
+                    isinstance(ob, VersionInfo):
+                # Bookkeeping information differs from version to
+                # version, so there is nothing to gain from sharing it.
+                return None
+            index = indexes.get(id(ob))
+            if index is None:
+                index = indexes[id(ob)] = len(nodes)
+                nodes.append(ob)
+            children.append(index)
+            # Until the children have been pickled, their position is
+            # enough to find them.
+            return pids.get(index, index)
+        return persistent_id
+
+    def dump(index, stream):
+        node = nodes[index]
+        children = []
+        p = Pickler(stream, HIGHEST_PROTOCOL)
+        p.persistent_id = makePersistentId(node, children)
+        if index:
+            p.dump(node.__getstate__())
+        else:
+            p.dump(node)
+        return children
+
+    # Find the subobjects and the children of each of them.
+    graph = []
+    index = 0
+    while index < len(nodes):
+        graph.append(tuple(dict.fromkeys(dump(index, _NullWriter()))))
+        index += 1
+
+    # Pickle the subobjects, children before the subobjects that refer
+    # to them. A child that is still on the stack is a cycle.
+    records = []
+    keys = {}
+    seen = {}
+    done = [False] * len(nodes)
+    active = [False] * len(nodes)
+    stack = [0]
+    while stack:
+        index = stack[-1]
+        if not active[index]:
+            active[index] = True
+            for child in graph[index]:
+                if active[child] and not done[child]:
+                    return None
+                if not active[child]:
+                    stack.append(child)
+            continue
+        stack.pop()
+        if done[index]:
+            continue
+        done[index] = True
+        if not index:
+            break
+        stream = BytesIO()
+        dump(index, stream)
+        data = stream.getvalue()
+        node = nodes[index]
+        key = sha256(data).hexdigest()
+        # Distinct subobjects with the same state must not become one
+        # shared object when the state is loaded again.
+        n = seen.get(key, 0)
+        seen[key] = n + 1
+        args = ()
+        if hasattr(node, '__getnewargs__'):
+            args = node.__getnewargs__()
+        pids[index] = ('content', key, node.__class__, args, n)
+        keys[index] = key
+        records.append((key, data, tuple(
+            dict.fromkeys(keys[child] for child in graph[index]))))
+    stream = BytesIO()
+    dump(0, stream)
+    refs = tuple(dict.fromkeys(keys[child] for child in graph[0]))
+    return stream.getvalue(), refs, records
+
+
+class _HashWriter:
+    """A file-like object that hashes what is written to it."""
+
+    def __init__(self, prefix=b''):
+        self.digest = sha256(prefix)
+
+    def write(self, data):
+        self.digest.update(data)
+
+
+def fingerprintGraph(obj, ignore_list=()):
+    """Returns hashes of the state of a ZODB object, loading ghosts as
+       needed: a hash of the whole state, a mapping of attribute names to
+       hashes of the attribute values, and a mapping of the ids of the
+       items of the object (the subobjects of a folder) to their hashes.
+
+    The hash of a value covers the value and the hashes of the persistent
+    subobjects it refers to, so equal states have equal hashes however
+    their subobjects are stored, and attribute order does not count.
+    Version control bookkeeping, the attributes named in __vc_ignore__
+    and the objects in the ignore list are left out; objects in the
+    ignore list that are not attributes only count as placeholders.
+    Blobs are hashed by their data.
+    """
+    ignore_dict = {}
+    for o in ignore_list:
+        ignore_dict[id(o)] = o
+    omit = ('__vc_info__',) + tuple(getattr(obj, '__vc_ignore__', ()))
+    # The graph has a node for each persistent object and for each
+    # attribute of obj. Attribute nodes are kept in attribute_nodes.
+    nodes = [obj]
+    indexes = {id(obj): 0}
+    attribute_nodes = {}
+    root_state = {}
+    digests = []
+    children = []
+
+    def makePersistentId(refs):
+        # References to subobjects are replaced by their position in the
+        # list of children of the node being hashed.
+        def persistent_id(ob):
+            if id(ob) in ignore_dict:
+                return 'ignored'
+            if not isinstance(ob, PersistentBase):
+                if getattr(ob, '_p_changed', 0) is None:
+                    ob._p_changed = 0
+                return None
+            index = indexes.get(id(ob))
+            if index is None:
+                index = indexes[id(ob)] = len(nodes)
+                nodes.append(ob)
+            return refs.setdefault(index, len(refs))
+        return persistent_id
+
+    def hashPickle(value, refs, prefix=b''):
+        # Hash the pickle as it is written rather than keep it around.
+        writer = _HashWriter(prefix)
+        p = pickle.Pickler(writer, 5)
+        p.persistent_id = makePersistentId(refs)
+        p.dump(value)
+        return writer.digest
+
+    index = 0
+    while index < len(nodes):
+        node = nodes[index]
+        refs = {}
+        if 0 < index <= len(attribute_nodes):
+            digests.append(hashPickle((node, root_state[node]), refs))
+        elif isinstance(node, Blob):
+            writer = _HashWriter(b'blob:')
+            with node.open('r') as f:
+                for chunk in iter(lambda: f.read(LARGE_VALUE), b''):
+                    writer.write(chunk)
+            digests.append(writer.digest)
+        else:
+            if getattr(node, '_p_changed', 0) is None:
+                node._p_changed = 0
+            state = node.__getstate__()
+            if node is obj and isinstance(state, dict):
+                root_state = _versionedState(state, omit, ignore_dict)
+                # Hash each attribute on its own. The attribute nodes
+                # come right after obj.
+                for name in sorted(root_state):
+                    refs[len(nodes)] = len(refs)
+                    attribute_nodes[name] = len(nodes)
+                    nodes.append(name)
+                digests.append(hashPickle(node.__class__, {}))
+            else:
+                if isinstance(state, dict):
+                    try:
+                        state = sorted(state.items())
+                    except TypeError:
+                        # The keys cannot be ordered, so keep them as
+                        # they are.
+                        pass
+                digests.append(hashPickle((node.__class__, state), refs))
+        children.append(tuple(refs))
+        index += 1
+
+    # Hash the subobjects before the nodes that refer to them. A
+    # reference back to a node that is still being hashed (a cycle) is
+    # hashed as a marker.
+    fingerprints = [None] * len(nodes)
+    active = set()
+    stack = [0]
+    while stack:
+        index = stack[-1]
+        if index not in active:
+            active.add(index)
+            stack.extend(child for child in children[index]
+                         if fingerprints[child] is None and
+                         child not in active)
+            continue
+        stack.pop()
+        if fingerprints[index] is not None:
+            continue
+        digest = digests[index]
+        for child in children[index]:
+            digest.update(fingerprints[child] or b'cycle')
+        fingerprints[index] = digest.digest()
+
+    attributes = {name: fingerprints[index].hex()
+                  for name, index in attribute_nodes.items()}
+    items = {}
+    if '_objects' in attributes:
+        for info in root_state['_objects']:
+            if info['id'] in attributes:
+                items[info['id']] = attributes.pop(info['id'])
+    tree = root_state.get('_tree')
+    if '_tree' in attributes and hasattr(tree, 'items'):
+        del attributes['_tree']
+        for key, value in tree.items():
+            index = indexes.get(id(value))
+            if index is not None:
+                items[key] = fingerprints[index].hex()
+    return fingerprints[0].hex(), attributes, items
+
+
+def _versionedState(state, omit, ignore_dict):
+    """Returns the attributes of a state that are version controlled."""
+    state = {name: value for name, value in state.items()
+             if name not in omit and id(value) not in ignore_dict}
+    if '_objects' in state:
+        # The folder entries of non-versioned items do not count either.
+        state['_objects'] = tuple(info for info in state['_objects']
+                                  if info['id'] in state)
+    return state
+
+
+def fingerprintState(obj, ignore_list=()):
+    """Returns a stable hash of the state of a ZODB object, loading
+       ghosts as needed. Objects with equal states have equal hashes;
+       see fingerprintGraph() for what the state includes."""
+    return fingerprintGraph(obj, ignore_list)[0]
+
+
+class Snapshot:
+    """A pickled object graph that independent copies can be loaded
+       from, as made by takeSnapshot(). The pickle stream is a byte
+       string, or a temporary file if the snapshot is spooled. The blobs
+       are those that the graph refers to; when a snapshot is cached,
+       they are replaced by their positions in the blobs of the version.
+       The size counts the pickle stream, the out-of-band buffers and the
+       shared strings; the size given is that of the stream alone."""
+
+    def __init__(self, data, buffers, shared, count, blobs, size):
+        self.data = data
+        self.buffers = buffers
+        self.shared = shared
+        self.count = count
+        self.blobs = blobs
+        self.size = size
+        for value in buffers:
+            self.size += memoryview(value).nbytes
+        for value in shared:
+            self.size += len(value)
+
+    def load(self, blobs=()):
+        """Return a new copy of the object graph. The copy refers to the
+           given blobs in place of the blobs of the snapshot."""
+        copies = {}
+
+        def persistent_load(ref):
+            if ref == 'ignored':
+                return _placeholderLoad(ref)
+            if type(ref) is int:
+                return self.shared[ref]
+            if ref[0] == 'blob':
+                return blobs[ref[1]]
+            tag, index, klass, args = ref
+            copy = copies.get(index)
+            if copy is None:
+                copy = copies[index] = klass.__new__(klass, *args)
+            return copy
+
+        if self.spooled:
+            stream = self.data
+            stream.seek(0)
+        else:
+            stream = BytesIO(self.data)
+        u = pickle.Unpickler(stream, buffers=self.buffers)
+        u.persistent_load = persistent_load
+        res = u.load()
+        states = [u.load() for index in range(self.count)]
+        # Set the states of the leaves first, as their containers may
+        # look at them when their own state is set.
+        for index in range(len(states) - 1, -1, -1):
+            copies[index].__setstate__(states[index])
+        return res
+
+    @property
+    def spooled(self):
+        return not isinstance(self.data, bytes)
+
+    def close(self):
+        """Remove the temporary file of a spooled snapshot."""
+        if self.spooled:
+            self.data.close()
+
+
+def takeSnapshot(obj, ignore_list=(), detach=False, spool=None):
+    """Returns a snapshot of a ZODB object, loading ghosts as needed.
+
+    Objects in the ignore list are replaced by placeholders in copies.
+
+    A snapshot uses pickle protocol 5: large immutable strings are
+    shared with the copies and mutable buffers are passed out-of-band
+    rather than copied through the pickle stream. Unless detach is
+    true, the buffers are those of the object, so the snapshot is only
+    valid while the object does not change.
+
+    If spool is given, a pickle stream of more than spool bytes is
+    written to a temporary file, so that the memory a snapshot takes
+    does not grow with the size of the object. Like ZODB, the state of
+    each persistent subobject is pickled on its own, so long chains of
+    subobjects (such as the data chunks of a large File) are copied
+    without recursion.
+    """
+    ignore_dict = {}
+    for o in ignore_list:
+        ignore_dict[id(o)] = o
+    shared = []
+    refs = {}
+    originals = []
+    blobs = []
+
+    def persistent_id(ob, ignore_dict=ignore_dict):
+        if id(ob) in ignore_dict:
+            return 'ignored'
+        if type(ob) in (bytes, str):
+            if len(ob) >= LARGE_VALUE:
+                shared.append(ob)
+                return len(shared) - 1
+            return None
+        if ob is obj or not isinstance(ob, PersistentBase):
+            if getattr(ob, '_p_changed', 0) is None:
+                ob._p_changed = 0
+            return None
+        ref = refs.get(id(ob))
+        if ref is not None:
+            return ref
+        if isinstance(ob, Blob):
+            ref = refs[id(ob)] = ('blob', len(blobs))
+            blobs.append(ob)
+            return ref
+        args = ()
+        if hasattr(ob, '__getnewargs__'):
+            args = ob.__getnewargs__()
+        ref = refs[id(ob)] = ('p', len(originals), ob.__class__, args)
+        originals.append(ob)
+        return ref
+
+    buffers = []
+    if spool is None:
+        stream = BytesIO()
+    else:
+        stream = SpooledTemporaryFile(max_size=spool)
+    p = pickle.Pickler(stream, 5, buffer_callback=buffers.append)
+    p.persistent_id = persistent_id
+    p.dump(obj)
+    # Pickling a state may find more subobjects, extending originals.
+    index = 0
+    while index < len(originals):
+        ob = originals[index]
+        if ob._p_changed is None:
+            ob._p_changed = 0
+        p.dump(ob.__getstate__())
+        index += 1
+    size = stream.tell()
+    if spool is None:
+        data = stream.getvalue()
+    elif size <= spool:
+        stream.seek(0)
+        data = stream.read()
+        stream.close()
+    else:
+        data = stream
+    if detach and isinstance(data, bytes):
+        buffers = [bytes(buffer) for buffer in buffers]
+    return Snapshot(data, buffers, tuple(shared), len(originals), blobs,
+                    size)
+
+
+def cloneByPickle(obj, ignore_list=(), blobs=None, candidates=(),
+                  spool=None):
+    """Makes a copy of a ZODB object, loading ghosts as needed.
+
+    Ignores specified objects along the way, replacing them with None
+    in the copy.
+
+    Blobs are copied with copyBlob() and the given candidates, and the
+    blobs of the copy are appended to the blobs list if one is given.
+    The pickle stream is spooled as by takeSnapshot().
+    """
+    snapshot = takeSnapshot(obj, ignore_list, spool=spool)
+    copies = [copyBlob(blob, candidates) for blob in snapshot.blobs]
+    if blobs is not None:
+        blobs.extend(copies)
+    try:
+        return snapshot.load(copies)
+    finally:
+        snapshot.close()
+
+
+class Fingerprints(Persistent):
+    """The hashes of the attributes and items of the state of a version.
+       They are kept apart from the version, so that the version stays
+       small when a large folder is versioned."""
+
+    def __init__(self, attributes, items):
+        self.attributes = attributes
+        self.items = OOBTree(items)
+
+
+InitializeClass(Fingerprints)
+
+
+class Payload(Persistent):
+    """The serialized state or delta of a version. It is kept in a record
+       of its own, so that writing the bookkeeping of the version, as when
+       a successor is added to it, does not write the state again."""
+
+    def __init__(self, data):
+        self.data = data
+
+
+InitializeClass(Payload)
+
+
 class Version(Implicit, Persistent):
     """A Version is a resource that contains a copy of a particular state
        (content and dead properties) of a version-controlled resource.  A
@@ -88,28 +794,379 @@ class Version(Implicit, Persistent):
     def getId(self):
         return self.id
 
+    # The format of the stored state. None means that _data holds an
+    # independent copy of the object graph. 'pickle' means that the
+    # Payload in _payload holds the serialized state, and 'delta' means
+    # that it holds a binary delta against the serialized state of the
+    # predecessor. Delta versions also record how many deltas separate
+    # them from the nearest full (keyframe) state.
+    _format = None
+    _depth = 0
+    _payload = None
+
+    # The keys of the content store records that a serialized state
+    # refers to, when subobject states are deduplicated.
+    _content_refs = ()
+
+    # The name of the codec that a serialized state is compressed with.
+    _codec = None
+
+    # A hash of the state of the resource at checkin and a Fingerprints
+    # object with hashes of its attributes and items, recorded when the
+    # repository records fingerprints or skips unchanged checkins.
+    _fingerprint = None
+    _fingerprints = None
+
+    # A mapping of attribute names to small attribute values of the
+    # resource, captured at checkin for listings of versions.
+    _metadata = None
+
+    # The blobs that the state refers to. A version shares a blob with
+    # its predecessor if the blob did not change in between.
+    _blobs = ()
+
+    # True while the state of the version waits in the checkin queue of
+    # the repository to be saved.
+    _pending = False
+
+    @security.private
+    def ensureState(self):
+        """Save the state of the version now if it is still waiting in
+           the checkin queue of the repository."""
+        if self._pending:
+            history = aq_parent(aq_inner(self))
+            repository = aq_parent(aq_inner(history))
+            repository.completeCheckin(history.getId(), self.getId())
+
     @security.private
     def saveState(self, obj):
         """Save the state of object as the state for this version of
            a version-controlled resource."""
-        self._data = self.stateCopy(obj, self)
+        blobs = []
+        self._data = self.stateCopy(obj, self, blobs)
+        if blobs:
+            self._blobs = tuple(blobs)
+
+    @security.private
+    def saveSerializedState(self, obj, base=None, keyframe_interval=0,
+                            store=None):
+        """Save the serialized state of object for this version.
+
+        If a base version with a serialized state is given, the state
+        is stored as a delta against it unless the delta chain has
+        reached keyframe_interval or the delta would not save space.
+        If a content store is given, the states of persistent subobjects
+        are stored in it once and referred to by the version.
+
+        Return the size the serialized state and subobject states would
+        take if stored independently, and the size of the subobject
+        states added to the content store.
+        """
+        ignore = listNonVersionedObjects(obj)
+        blobs = []
+        data = None
+        logical = added = 0
+        if store is not None:
+            result = serializeContent(aq_base(obj), ignore, blobs)
+            if result is not None:
+                data, refs, records = result
+                for key, record, children in records:
+                    logical += len(record)
+                    if store.add(key, record, children):
+                        added += len(record)
+                for key in refs:
+                    store.incref(key)
+                self._content_refs = refs
+        if data is None:
+            del blobs[:]
+            data = serializeState(aq_base(obj), ignore, blobs)
+        logical += len(data)
+        if blobs:
+            candidates = self.getPredecessorBlobs()
+            self._blobs = tuple(copyBlob(blob, candidates) for blob in blobs)
+        if base is not None and base._format is not None:
+            depth = base._depth + 1
+            if depth < keyframe_interval:
+                delta = computeDelta(base.getSerializedState(), data,
+                                     limit=min(len(data) // 2, MAX_INSERT))
+                if delta is not None and len(delta) < len(data) // 2:
+                    self._payload = Payload(delta)
+                    self._format = 'delta'
+                    self._depth = depth
+                    return logical, added
+        self._payload = Payload(data)
+        self._format = 'pickle'
+        return logical, added
+
+    @security.private
+    def getSerializedState(self):
+        """Return the serialized state of the version."""
+        self.ensureState()
+        if self._format is None:
+            data = self.__dict__.get('_data')  # Avoid __of__ hooks
+            return serializeState(aq_base(data))
+        # Walk back to the nearest keyframe, then replay the deltas.
+        history = aq_parent(aq_inner(self))
+        chain = []
+        version = self
+        while version._format == 'delta':
+            chain.append(version.getPayload())
+            version = history._versions[version.prev]
+        data = version.getPayload()
+        for delta in reversed(chain):
+            data = applyDelta(data, delta)
+        return data
+
+    @security.private
+    def getStoredPayload(self):
+        """Return the serialized state or delta of the version as it is
+           stored, compressed if the version is compressed."""
+        return self._payload.data
+
+    @security.private
+    def getPayload(self):
+        """Return the uncompressed serialized state or delta of the
+           version."""
+        data = self.getStoredPayload()
+        if self._codec is not None:
+            data = codecs[self._codec][1](data)
+        return data
+
+    @security.private
+    def compressState(self, codec, threshold=0):
+        """Compress the serialized state or delta of the version with the
+           named codec, if it is at least threshold bytes long and the
+           codec makes it smaller. Return the uncompressed and the stored
+           size of the state."""
+        data = self.getStoredPayload()
+        size = len(data)
+        if self._codec is None and codec in codecs and size >= threshold:
+            compressed = codecs[codec][0](data)
+            if len(compressed) < size:
+                self._payload.data = compressed
+                self._codec = codec
+        return size, len(self.getStoredPayload())
+
+    @security.private
+    def getContentStore(self):
+        """Return the content store of the repository of the version, or
+           None if the state of the version does not refer to one."""
+        if not self._content_refs:
+            return None
+        history = aq_parent(aq_inner(self))
+        return aq_parent(aq_inner(history)).getContentStore()
+
+    @security.private
+    def saveFingerprints(self, fingerprints):
+        """Record the hashes of the state of the resource, as returned by
+           fingerprintGraph()."""
+        self._fingerprint, attributes, items = fingerprints
+        self._fingerprints = Fingerprints(attributes, items)
+
+    @security.private
+    def getFingerprint(self):
+        """Return a hash of the state of the version, as made by
+           fingerprintState()."""
+        if self._fingerprint is not None:
+            return self._fingerprint
+        return self.getFingerprints()[0]
+
+    @security.private
+    def getFingerprints(self):
+        """Return the hashes of the state of the version, of its
+           attributes and of its items, as made by fingerprintGraph().
+           The hashes of versions that did not record them are computed
+           from a copy of the state."""
+        if self._fingerprints is not None:
+            return (self._fingerprint, self._fingerprints.attributes,
+                    self._fingerprints.items)
+        self.ensureState()
+        if self._fingerprints is not None:
+            return self.getFingerprints()
+        obj = self.copyState()
+        return fingerprintGraph(obj, listNonVersionedObjects(obj))
+
+    @security.private
+    def getMetadata(self):
+        """Return the attribute values of the resource that were captured
+           when the version was created."""
+        return dict(self._metadata or {})
+
+    @security.private
+    def getTopLevelState(self):
+        """Return the attributes of the stored state of the version
+           without loading the persistent subobjects of the state.
+           Attributes that refer to persistent subobjects are left out.
+
+           Serialized states are read up to the end of the top-level
+           pickle, but the payload is still read, and a delta is still
+           applied to the states of its predecessors. Attributes that are
+           captured as metadata (see getAttributes) are read without
+           touching the payload at all."""
+        self.ensureState()
+        if self._format is None:
+            data = self.__dict__.get('_data')  # Avoid __of__ hooks
+            data = aq_base(data)
+            data._p_activate()
+            state = data.__dict__
+        else:
+            # The states of the subobjects follow the top-level pickle,
+            # or are in the content store, and are not read.
+            state = _loadTopLevel(self.getSerializedState()).__dict__
+        return {name: value for name, value in state.items()
+                if value is not None and
+                not isinstance(value, PersistentBase)}
+
+    @security.private
+    def getAttributes(self, names):
+        """Return a mapping of the given attribute names to the values of
+           the attributes in the state of the version. Attributes that
+           the state lacks or that refer to persistent subobjects are
+           left out. Captured metadata is used when it has all of the
+           attributes, so that the state is not loaded at all."""
+        metadata = self._metadata or {}
+        res = {}
+        missing = []
+        for name in names:
+            if name in metadata:
+                res[name] = metadata[name]
+            else:
+                missing.append(name)
+        if missing:
+            state = self.getTopLevelState()
+            for name in missing:
+                if name not in state:
+                    continue
+                value = state[name]
+                if not isinstance(value, _simpleTypes):
+                    value = cloneByPickle(value)
+                res[name] = value
+        return res
+
+    @security.private
+    def getPredecessorBlobs(self):
+        """Return the blobs that the state of the predecessor of the
+           version refers to."""
+        if self.prev is None:
+            return ()
+        history = aq_parent(aq_inner(self))
+        if history is None:
+            return ()
+        return history._versions[self.prev]._blobs
+
+    @security.private
+    def getCacheKey(self):
+        """Return the key of the version in the state cache, or None if
+           the version is not cached because it is not committed."""
+        if self._p_jar is None or self._p_serial == z64 or self._p_changed:
+            return None
+        history = aq_parent(aq_inner(self))
+        if history is None:
+            return None
+        return (history.getId(), self.getId())
+
+    @security.private
+    def getSpoolThreshold(self):
+        """Return the size above which snapshots of states are spooled
+           to a temporary file, as set by the repository."""
+        history = aq_parent(aq_inner(self))
+        repository = aq_parent(aq_inner(history))
+        return getattr(repository, 'spool_threshold', SPOOL_THRESHOLD)
+
+    @security.private
+    def getSnapshot(self):
+        """Return a snapshot of the state of the version that refers to
+           the blobs of the version by their position."""
+        self.ensureState()
+        spool = self.getSpoolThreshold()
+        if self._format is None:
+            obj = self.__dict__.get('_data')  # Avoid __of__ hooks
+            ignore = listNonVersionedObjects(obj)
+            snapshot = takeSnapshot(aq_base(obj), ignore, True, spool)
+        else:
+            obj = deserializeState(self.getSerializedState(),
+                                   self.getContentStore(), self._blobs,
+                                   copy_blobs=False)
+            snapshot = takeSnapshot(obj, detach=True, spool=spool)
+        positions = {id(blob): n for n, blob in enumerate(self._blobs)}
+        snapshot.blobs = tuple(positions[id(blob)] for blob in snapshot.blobs)
+        return snapshot
 
     @security.private
     def copyState(self):
-        """Return an independent deep copy of the state of the version."""
-        data = self.__dict__.get('_data')  # Avoid __of__ hooks
-        return self.stateCopy(data, self)
+        """Return an independent deep copy of the state of the version.
+
+        Versions never change, so copies are loaded from a snapshot in
+        the state cache of the process when there is one.
+        """
+        self.ensureState()
+        key = self.getCacheKey()
+        snapshot = None
+        if key is not None:
+            # Versions of different databases may have the same oid.
+            oid = (self._p_jar.db().database_name, self._p_oid)
+            snapshot = stateCache.get(key, oid, self._p_serial)
+        if snapshot is None:
+            snapshot = self.getSnapshot()
+            if key is not None and not snapshot.spooled:
+                stateCache.set(key, oid, self._p_serial, snapshot)
+        blobs = [copyBlob(self._blobs[n]) for n in snapshot.blobs]
+        res = snapshot.load(blobs)
+        if snapshot.spooled:
+            snapshot.close()
+        removeNonVersionedData(res)
+        return res
 
     @security.private
-    def stateCopy(self, obj, container):
+    def stateCopy(self, obj, container, blobs=None):
         """Get a deep copy of the state of an object.
 
-        Breaks any database identity references.
+        Breaks any database identity references. If a list of blobs is
+        given, the copy is saved in this version: it reuses the blobs of
+        the predecessor that did not change and its blobs are appended
+        to the list.
         """
         ignore = listNonVersionedObjects(obj)
-        res = cloneByPickle(aq_base(obj), ignore)
+        candidates = ()
+        if blobs is not None:
+            candidates = self.getPredecessorBlobs()
+        res = cloneByPickle(aq_base(obj), ignore, blobs, candidates,
+                            self.getSpoolThreshold())
         removeNonVersionedData(res)
         return res
 
+    def _p_resolveConflict(self, old, committed, new):
+        # A version is written by the checkin of its successor, which
+        # adds to next, and by the CheckinWorker that saves its state in
+        # the background. Merge writes that change different attributes.
+        committed_names = _changedNames(old, committed)
+        new_names = _changedNames(old, new)
+        if committed_names & new_names:
+            raise ConflictError
+        state = dict(committed)
+        for name in new_names:
+            if name in new:
+                state[name] = new[name]
+            else:
+                state.pop(name, None)
+        return state
+
 
 InitializeClass(Version)
+
+
+def _changedNames(old, new):
+    # Return the names of the attributes that differ between two states.
+    changed = set()
+    for name in set(old) | set(new):
+        if name not in old or name not in new:
+            changed.add(name)
+            continue
+        try:
+            same = old[name] == new[name]
+        except ValueError:
+            # Different references to persistent objects.
+            same = False
+        if not same:
+            changed.add(name)
+    return changed
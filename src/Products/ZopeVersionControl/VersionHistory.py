@@ -16,20 +16,27 @@ import time
 from AccessControl import ClassSecurityInfo
 from AccessControl.class_init import InitializeClass
 from Acquisition import Implicit
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
 from BTrees.IIBTree import IIBTree
 from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 from Persistence import Persistent
 
 from .EventLog import EventLog
 from .EventLog import LogEntry
+from .EventLog import nextKey
+from .nonversioned import listNonVersionedObjects
 from .Utility import VersionControlError
+from .Utility import _nameRange
+from .Version import captureMetadata
+from .Version import fingerprintGraph
 from .ZopeVersion import ZopeVersion
 
 
-MAX32 = int(2**31 - 1)
-
-
 class VersionHistory(Implicit, Persistent):
     """A version history maintains the information about the changes
        to a particular version-controlled resource over time."""
@@ -39,13 +46,20 @@ class VersionHistory(Implicit, Persistent):
         # of the actual version data is looked up there. The _labels
         # mapping maps labels to specific version ids. The _branches map
         # manages BranchInfo objects that maintain branch information.
+        # The _version_labels set holds the (version_id, label) of each
+        # label, so that the labels of a version are a range of keys.
         self._eventLog = EventLog()
         self._versions = OOBTree()
         self._branches = OOBTree()
         self._labels = OOBTree()
+        self._version_labels = OOTreeSet()
         self.createBranch('mainline', None)
         self.id = history_id
 
+    # Histories created before labels were indexed by version get the
+    # index when they are next labeled.
+    _version_labels = None
+
     security = ClassSecurityInfo()
 
     @security.public
@@ -82,8 +96,25 @@ class VersionHistory(Implicit, Persistent):
                     'The label %s is already associated with a version.' % (
                         label
                     ))
+        version_labels = self._version_labels
+        if version_labels is None:
+            version_labels = self._version_labels = OOTreeSet(
+                (id, name) for name, id in self._labels.items())
+        if current is not None:
             del self._labels[label]
+            version_labels.remove((current, label))
         self._labels[label] = version_id
+        version_labels.insert((version_id, label))
+
+    @security.private
+    def getLabelsForVersion(self, version_id):
+        """Return the labels associated with the given version, in
+           order."""
+        if self._version_labels is None:
+            return sorted(label for label, id in self._labels.items()
+                          if id == version_id)
+        return [label for id, label in
+                self._version_labels.keys(*_nameRange(version_id))]
 
     @security.private
     def createBranch(self, branch_id, version_id):
@@ -98,9 +129,15 @@ class VersionHistory(Implicit, Persistent):
         return branch
 
     @security.private
-    def createVersion(self, object, branch_id):
+    def createVersion(self, object, branch_id, fingerprints=None,
+                      deferred=False):
         """Create a new version in the line of descent named by the given
-           branch_id, returning the newly created version object."""
+           branch_id, returning the newly created version object. The
+           fingerprints of the state of the object, as returned by
+           fingerprintGraph(), are recorded if given or if the repository
+           records fingerprints or skips unchanged checkins. If deferred
+           is true, the state of the version is left to be saved later
+           with saveVersionState()."""
         branch = self._branches.get(branch_id)
         if branch is None:
             branch = self.createBranch(branch_id, None)
@@ -129,10 +166,90 @@ class VersionHistory(Implicit, Persistent):
 
         branch.append(version)
         self._versions[version_id] = version
+        version = version.__of__(self)
         # Call saveState() only after version has been linked into the
         # database, ensuring it goes into the correct database.
-        version.saveState(object)
-        return version.__of__(self)
+        repository = aq_parent(aq_inner(self))
+        place = getattr(repository, 'placeVersion', None)
+        if place is not None:
+            place(self, aq_base(version))
+        names = getattr(repository, 'metadata_attributes', ())
+        if names:
+            version._metadata = captureMetadata(object, names)
+        if deferred:
+            if fingerprints is not None:
+                version.saveFingerprints(fingerprints)
+            version._pending = True
+        else:
+            self.saveVersionState(version, object, fingerprints)
+        return version
+
+    @security.private
+    def saveVersionState(self, version, object, fingerprints=None):
+        """Save the state of object as the state of a new version, in the
+           format set by the repository."""
+        repository = aq_parent(aq_inner(self))
+        if fingerprints is None and version._fingerprints is None and (
+                getattr(repository, 'record_fingerprints', False) or
+                getattr(repository, 'skip_unchanged', False)):
+            fingerprints = fingerprintGraph(
+                aq_base(object), listNonVersionedObjects(object))
+        if fingerprints is not None:
+            version.saveFingerprints(fingerprints)
+        storage = getattr(repository, 'version_storage', 'full')
+        deduplicate = getattr(repository, 'deduplicate', False)
+        codec = getattr(repository, 'compression', 'none')
+        if storage in ('pickle', 'delta') or deduplicate or codec != 'none':
+            base = None
+            if storage == 'delta' and version.prev is not None:
+                base = self._versions[version.prev].__of__(self)
+            store = None
+            if deduplicate:
+                store = repository.getContentStore()
+            logical, added = version.saveSerializedState(
+                object, base, repository.keyframe_interval, store)
+            raw, stored = version.compressState(
+                codec, repository.compression_threshold)
+            self._countPayload(raw, stored)
+            self._countContent(logical, stored + added)
+        else:
+            version.saveState(object)
+        version._pending = False
+
+    # Conflict-free counters of the uncompressed and the stored size of
+    # the serialized version states in this history.
+    _raw_size = None
+    _stored_size = None
+
+    def _countPayload(self, raw, stored):
+        if self._raw_size is None:
+            self._raw_size = Length()
+            self._stored_size = Length()
+        self._raw_size.change(raw)
+        self._stored_size.change(stored)
+
+    # Conflict-free counters of the size that the serialized version
+    # states in this history would take without sharing subobject
+    # states, and of the size that they take.
+    _logical_size = None
+    _shared_size = None
+
+    def _countContent(self, logical, stored):
+        if self._logical_size is None:
+            self._logical_size = Length()
+            self._shared_size = Length()
+        self._logical_size.change(logical)
+        self._shared_size.change(stored)
+
+    @security.private
+    def getStorageStatistics(self):
+        """Return a mapping with the total uncompressed and stored size of
+           the serialized version states in this history."""
+        raw = stored = 0
+        if self._raw_size is not None:
+            raw = self._raw_size()
+            stored = self._stored_size()
+        return {'raw_size': raw, 'stored_size': stored}
 
     @security.private
     def hasVersionId(self, version_id):
@@ -145,6 +262,11 @@ class VersionHistory(Implicit, Persistent):
         branch = self._branches[branch_id]
         return version_id == branch.latest()
 
+    @security.private
+    def getLatestVersionId(self, branch_id):
+        """Return the id of the latest version within the given branch."""
+        return self._branches[branch_id].latest()
+
     @security.private
     def getLatestVersion(self, branch_id):
         """Return the latest version object within the given branch, or
@@ -183,6 +305,15 @@ class VersionHistory(Implicit, Persistent):
             return None
         return version.__of__(self)
 
+    @security.private
+    def getVersionIdByLabel(self, label):
+        """Return the id of the version associated with the given label,
+           or None if no version matches the given label."""
+        version_id = self._labels.get(label)
+        if version_id is None or version_id not in self._versions:
+            return None
+        return version_id
+
     @security.private
     def getVersionByDate(self, branch_id, timestamp):
         """Return the last version committed in the given branch on or
@@ -214,6 +345,61 @@ class VersionHistory(Implicit, Persistent):
                 return rootver.__of__(self)
             branch = self._branches[rootver.branch]
 
+    @security.private
+    def getVersionAttributes(self, names, version_ids=None):
+        """Return a mapping of version ids to mappings of the given
+           attribute names to their values in the versions, as returned
+           by Version.getAttributes. All versions are included unless
+           version ids are given."""
+        if version_ids is None:
+            version_ids = self._versions.keys()
+        res = {}
+        for version_id in version_ids:
+            version = self.getVersionById(version_id)
+            res[version_id] = version.getAttributes(names)
+        return res
+
+    @security.private
+    def diffVersions(self, version_id_a, version_id_b):
+        """Return the differences between the states of two versions as
+           a mapping with the keys 'attributes' and 'items'. These map the
+           names of the attributes and the ids of the items (the
+           subobjects of a folder) that differ to 'added', 'removed' or
+           'changed', going from the first version to the second.
+
+           Versions are compared by the hashes that they recorded of their
+           state, so no state is loaded unless a version did not record
+           them."""
+        a = self.getVersionById(version_id_a).getFingerprints()
+        b = self.getVersionById(version_id_b).getFingerprints()
+        if a[0] == b[0]:
+            return {'attributes': {}, 'items': {}}
+        return {'attributes': _diffMappings(a[1], b[1]),
+                'items': _diffMappings(a[2], b[2])}
+
+    @security.private
+    def getDeduplicationStatistics(self):
+        """Return a mapping that reports how much space the serialized
+           versions in this history save by sharing subobject states. The
+           logical size is the size the serialized states would take if
+           stored independently, the stored size counts each version
+           payload and each content store record that a checkin in this
+           history added. The sizes are counted at checkin, so versions
+           stored as full copies are not included."""
+        logical = stored = 0
+        if self._logical_size is not None:
+            logical = self._logical_size()
+            stored = self._shared_size()
+        ratio = 1.0
+        if stored:
+            ratio = logical / stored
+        return {
+            'versions': len(self._versions),
+            'logical_size': logical,
+            'stored_size': stored,
+            'ratio': ratio,
+        }
+
     @security.private
     def getVersionIds(self, branch_id=None):
         """Return a sequence of version ids for the versions in this
@@ -228,6 +414,22 @@ class VersionHistory(Implicit, Persistent):
 InitializeClass(VersionHistory)
 
 
+def _diffMappings(a, b):
+    """Return a mapping of the keys of two mappings of hashes whose hash
+       differs to 'added', 'removed' or 'changed'."""
+    res = {}
+    for key, value in a.items():
+        other = b.get(key)
+        if other is None:
+            res[key] = 'removed'
+        elif other != value:
+            res[key] = 'changed'
+    for key in b.keys():
+        if key not in a:
+            res[key] = 'added'
+    return res
+
+
 class BranchInfo(Implicit, Persistent):
     """A utility class to hold branch (line-of-descent) information. It
        maintains the name of the branch, the version id of the root of
@@ -244,9 +446,15 @@ class BranchInfo(Implicit, Persistent):
         self.date_created = time.time()
         self.m_order = IOBTree()
         self.m_date = IIBTree()
+        self._length = Length()
         self.name = name
         self.root = root
 
+    # The number of versions in m_order, so that len() does not load
+    # every bucket of it. Branches created before it was kept count
+    # their versions on their next append.
+    _length = None
+
     @security.public
     def getId(self):
         """Return the name of the object as string."""
@@ -257,11 +465,11 @@ class BranchInfo(Implicit, Persistent):
         """Append a version to the branch information. Note that this
            does not store the actual version, but metadata about the
            version to support ordering and date lookups."""
-        if len(self.m_order):
-            key = self.m_order.minKey() - 1
-        else:
-            key = MAX32
+        if self._length is None:
+            self._length = Length(len(self.m_order))
+        key = nextKey(self.m_order)
         self.m_order[key] = version.id
+        self._length.change(1)
         timestamp = int(version.date_created / 60.0)
         self.m_date[timestamp] = key
 
@@ -274,12 +482,14 @@ class BranchInfo(Implicit, Persistent):
     def latest(self):
         """Return the version id of the latest version in the branch."""
         mapping = self.m_order
-        if not len(mapping):
+        if not mapping:
             return self.root
-        return mapping[mapping.keys()[0]]
+        return mapping[mapping.minKey()]
 
     def __len__(self):
-        return len(self.m_order)
+        if self._length is None:
+            return len(self.m_order)
+        return self._length()
 
 
 InitializeClass(BranchInfo)
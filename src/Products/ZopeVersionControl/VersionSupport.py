@@ -171,8 +171,8 @@ class VersionSupport(ExtensionClass.Base):
         return self.getRepository().getLabelsForHistory(self)
 
     @security.protected(use_vc_permission)
-    def getLabelsForVersion(self):
-        return self.getRepository().getLabelsForVersion(self)
+    def getLabelsForVersion(self, version_id=None):
+        return self.getRepository().getLabelsForVersion(self, version_id)
 
     @security.protected(use_vc_permission)
     def getLogEntries(self):
@@ -18,7 +18,9 @@ from App.special_dtml import DTMLFile
 from OFS.role import RoleManager
 
 from . import Repository
+from .CheckinQueue import getWorkers
 from .SequenceWrapper import SequenceWrapper
+from .Version import codecs
 
 
 class ZopeRepository(
@@ -57,20 +59,46 @@ class ZopeRepository(
     security.declareProtected(
         'View management screens', 'manage_properties_form'
     )
-    manage_properties_form = DTMLFile('dtml/RepositoryProperties', globals())
+    # Only the codecs that this Python can import are offered.
+    manage_properties_form = DTMLFile(
+        'dtml/RepositoryProperties', globals(),
+        compression_codecs=('none',) + tuple(sorted(codecs))
+    )
 
     @security.protected('Manage repositories')
-    def manage_edit(self, title='', REQUEST=None):
+    def manage_edit(self, title='', version_storage=None,
+                    keyframe_interval=None, deduplicate=None, compression=None,
+                    compression_threshold=None, skip_unchanged=None,
+                    REQUEST=None):
         """Change object properties."""
         self.title = title
+        if version_storage is not None or deduplicate is not None:
+            if keyframe_interval is not None:
+                keyframe_interval = int(keyframe_interval)
+            self.setVersionStorage(version_storage or self.version_storage,
+                                   keyframe_interval, deduplicate)
+        if compression is not None:
+            self.setCompression(compression, compression_threshold)
+        if skip_unchanged is not None:
+            self.setSkipUnchanged(skip_unchanged)
         if REQUEST is not None:
             message = "Saved changes."
             return self.manage_properties_form(
                 self, REQUEST, manage_tabs_message=message
             )
 
+    @security.protected('View management screens')
+    def getCheckinQueueStatus(self):
+        """Return the depth and lag of the checkin queue, as given by
+           getCheckinQueueStatistics, and under 'workers' the counters of
+           the workers of this process that serve the repository."""
+        status = self.getCheckinQueueStatistics()
+        status['workers'] = [worker.getCounters()
+                             for worker in getWorkers(self)]
+        return status
+
     def __getitem__(self, name):
-        history = self._histories.get(name)
+        history = self._getHistory(name)
         if history is not None:
             return history.__of__(self)
         raise KeyError(name)
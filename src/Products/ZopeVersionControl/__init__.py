@@ -13,12 +13,20 @@
 
 from AccessControl.class_init import InitializeClass
 from App.ImageFile import ImageFile
+from zope.component import provideHandler
+from zope.processlifetime import IDatabaseOpenedWithRoot
 
+from . import CheckinQueue
 from . import ZopeRepository
 
 
 def initialize(context):
 
+    # Products are initialized before Zope announces that its database
+    # is open, which starts the configured checkin workers.
+    provideHandler(CheckinQueue.startConfiguredWorkers,
+                   (IDatabaseOpenedWithRoot,))
+
     context.registerClass(
         instance_class=ZopeRepository.ZopeRepository,
         meta_type='Repository',
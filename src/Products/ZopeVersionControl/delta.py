@@ -0,0 +1,157 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Binary deltas between serialized version states.
+
+A delta is a byte string made of instructions that rebuild a target
+string from a source string.  A copy instruction is the opcode ``C``
+followed by a big-endian offset and length into the source; an insert
+instruction is the opcode ``I`` followed by a big-endian length and the
+literal bytes to insert.
+"""
+
+import struct
+
+
+BLOCKSIZE = 64
+
+# The most literal bytes a delta computed for a version may insert. Bytes
+# that are not found in the source are looked up one offset at a time, so
+# this bounds the time spent on states that have changed a lot; they are
+# stored in full instead.
+MAX_INSERT = 1 << 20
+
+_copy = struct.Struct('>cII')
+_insert = struct.Struct('>cI')
+
+
+def _matchLength(a, i, b, j, limit):
+    """Return how many bytes of a starting at i equal b starting at j,
+       comparing no more than limit bytes."""
+    # Gallop forward over equal slices, then binary search the first
+    # differing slice.  This keeps the comparisons in C without copying
+    # more than twice the matched length.
+    lo, step = 0, BLOCKSIZE
+    while lo < limit:
+        hi = min(lo + step, limit)
+        if a[i + lo:i + hi] != b[j + lo:j + hi]:
+            break
+        lo = hi
+        step *= 2
+    else:
+        return lo
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i + lo:i + mid] == b[j + lo:j + mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _commonSuffix(a, b, limit):
+    """Return the length of the common suffix of two byte strings,
+       never reaching further back than limit bytes."""
+    lo, hi = 0, min(len(a), len(b), limit)
+    la, lb = len(a), len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def computeDelta(source, target, blocksize=BLOCKSIZE, limit=None):
+    """Return a delta that transforms source into target, or None if limit
+       is given and the delta would insert more than limit literal bytes.
+       The search gives up as soon as that is known."""
+    if limit is None:
+        limit = len(target)
+    out = []
+    literal = []
+
+    def flush():
+        if literal:
+            data = b''.join(literal)
+            out.append(_insert.pack(b'I', len(data)))
+            out.append(data)
+            del literal[:]
+
+    def copy(offset, length):
+        flush()
+        out.append(_copy.pack(b'C', offset, length))
+
+    common = min(len(source), len(target))
+    prefix = _matchLength(source, 0, target, 0, common)
+    suffix = _commonSuffix(source, target, common - prefix)
+    if prefix:
+        copy(0, prefix)
+
+    # Index the aligned blocks of the source so that moved or
+    # unchanged regions in the middle can be found by lookup.
+    index = {}
+    end = len(source) - suffix
+    for offset in range(prefix, end - blocksize + 1, blocksize):
+        index.setdefault(source[offset:offset + blocksize], offset)
+
+    pos = prefix
+    stop = len(target) - suffix
+    start = pos
+    # The offset past which the pending literal is over the limit.
+    give_up = start + limit
+    lookup = index.get
+    while pos + blocksize <= stop:
+        offset = lookup(target[pos:pos + blocksize])
+        if offset is None:
+            if pos >= give_up:
+                return None
+            pos += 1
+            continue
+        # Extend the match forward as far as the two strings agree.
+        length = blocksize + _matchLength(
+            source, offset + blocksize, target, pos + blocksize,
+            min(end - offset, stop - pos) - blocksize)
+        literal.append(target[start:pos])
+        copy(offset, length)
+        give_up += length
+        pos += length
+        start = pos
+    if stop > give_up:
+        return None
+    literal.append(target[start:stop])
+    if suffix:
+        copy(len(source) - suffix, suffix)
+    flush()
+    return b''.join(out)
+
+
+def applyDelta(source, delta):
+    """Rebuild the target string from the source and a delta."""
+    out = []
+    pos = 0
+    size = len(delta)
+    while pos < size:
+        op = delta[pos:pos + 1]
+        if op == b'C':
+            op, offset, length = _copy.unpack_from(delta, pos)
+            out.append(source[offset:offset + length])
+            pos += _copy.size
+        elif op == b'I':
+            op, length = _insert.unpack_from(delta, pos)
+            pos += _insert.size
+            out.append(delta[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError('Invalid delta opcode at offset %d' % pos)
+    return b''.join(out)
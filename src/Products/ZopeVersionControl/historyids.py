@@ -0,0 +1,122 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Allocation of ordered version history ids.
+
+History ids used to be random numbers, which scatter the insertions into
+the histories of a repository over all the buckets of its BTree. Ids are
+now allocated from counters, so that new histories are added at the end
+of the BTree, and are encoded so that they sort in the order of their
+counter values.
+
+Each node (ZEO client) allocates ids with its own prefix, taken from
+setHistoryIdPrefix() or the ZVC_HISTORY_ID_PREFIX environment variable,
+or else chosen at random when the process starts. Each connection of the
+process adds its number to the prefix, unless the thread has a prefix of
+its own. Ids of different prefixes come from different counters and
+fall into different ranges of the BTree, so that concurrent checkins
+neither conflict on a counter nor on a bucket. A random prefix starts
+new counters each time the process starts.
+"""
+import os
+import random
+import re
+import threading
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Persistence import Persistent
+
+from .Utility import VersionControlError
+from .Utility import _connectionNumber
+
+
+_digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+_valid_prefix = re.compile('^[A-Za-z0-9_]*$').match
+
+
+def encodeCounter(value):
+    """Return a compact string for a positive number. The strings of
+       larger numbers sort after those of smaller ones, and a string is
+       never made only of digits, like the random ids of old histories."""
+    digits = ''
+    while value:
+        value, digit = divmod(value, 36)
+        digits = _digits[digit] + digits
+    # The number of digits comes first, so that longer strings sort last.
+    return chr(ord('a') + len(digits) - 1) + digits
+
+
+def isRandomHistoryId(history_id):
+    """Return true if a history id is a random id of an old history."""
+    return history_id.isdigit()
+
+
+class HistoryIdAllocator(Persistent):
+    """A HistoryIdAllocator allocates ordered history ids from one
+       counter per prefix. The counters resolve concurrent increments,
+       but transactions that allocate from the same counter at once get
+       the same id, so their histories still conflict: getHistoryIdPrefix
+       gives each connection a prefix of its own to avoid that."""
+
+    def __init__(self):
+        self._counters = OOBTree()
+
+    def allocate(self, prefix=''):
+        """Return the next id of the given prefix."""
+        counter = self._counters.get(prefix)
+        if counter is None:
+            counter = self._counters[prefix] = Length()
+        counter.change(1)
+        encoded = encodeCounter(counter())
+        if prefix:
+            return '%s-%s' % (prefix, encoded)
+        return encoded
+
+
+def _randomPrefix():
+    # Return a short prefix that the processes of a cluster most likely
+    # do not share.
+    return ''.join(random.choice(_digits) for n in range(4))
+
+
+_node_prefix = os.environ.get('ZVC_HISTORY_ID_PREFIX') or _randomPrefix()
+_thread = threading.local()
+
+
+def setHistoryIdPrefix(prefix, thread=False):
+    """Set the prefix of the history ids allocated by this process, or
+       by the current thread only if thread is true. A thread prefix of
+       None makes the thread use the prefix of the process again."""
+    global _node_prefix
+    if prefix is not None and not _valid_prefix(prefix):
+        raise VersionControlError(
+            'History id prefixes may only contain letters, digits and '
+            'underscores.'
+        )
+    if thread:
+        _thread.prefix = prefix
+    else:
+        _node_prefix = prefix or ''
+
+
+def getHistoryIdPrefix(conn=None):
+    """Return the prefix of the history ids allocated by this thread
+       through the given connection: the prefix of the thread if it has
+       one, or else the prefix of the process followed by the number of
+       the connection in the process."""
+    prefix = getattr(_thread, 'prefix', None)
+    if prefix is not None:
+        return prefix
+    if conn is None:
+        return _node_prefix
+    return '%s_%d' % (_node_prefix, _connectionNumber(conn))
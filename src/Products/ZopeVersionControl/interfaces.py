@@ -65,6 +65,23 @@ class IVersionControl(Interface):
         Permission: public
         """
 
+    def areResourcesUpToDate(objects, require_branch=0):
+        """
+        Return a list of the results of isResourceUpToDate() for each of
+        the given resources, in the order of the given sequence.
+
+        Permission: public
+        """
+
+    def areResourcesChanged(objects):
+        """
+        Return a list of the results of isResourceChanged() for each of
+        the given resources, in the order of the given sequence. Subobjects
+        shared by several of the resources are loaded only once.
+
+        Permission: public
+        """
+
     def getVersionInfo(object):
         """
         Return the VersionInfo associated with the given object. The
@@ -89,6 +106,38 @@ class IVersionControl(Interface):
         Permission: Use version control
         """
 
+    def applyVersionControlTree(container, message=None,
+                                savepoint_interval=500):
+        """
+        Place the given container and all versionable objects below it
+        that are not yet under version control under version control.
+        The tree is walked once, and a savepoint is taken every
+        savepoint_interval objects to bound the memory used.
+
+        Errors do not stop the walk, except conflict errors, which are
+        raised. A mapping is returned with the number of objects
+        'processed' and 'skipped', and a list of the (path, message)
+        'errors' of objects that could not be processed.
+
+        Permission: Use version control
+        """
+
+    def checkoutTree(container, savepoint_interval=500):
+        """
+        Check out the given container and all checked in objects below it,
+        like applyVersionControlTree().
+
+        Permission: Use version control
+        """
+
+    def checkinTree(container, message='', savepoint_interval=500):
+        """
+        Check in the given container and all checked out objects below it,
+        like applyVersionControlTree().
+
+        Permission: Use version control
+        """
+
     def checkoutResource(object):
         """
         Put the given version-controlled object into the 'checked-out'
@@ -128,6 +177,25 @@ class IVersionControl(Interface):
         Permission: Use version control
         """
 
+    def updateTreeToSelector(container, selector, savepoint_interval=500,
+                             progress=None):
+        """
+        Update the given container and all checked in objects below it
+        to the versions selected by the given selector, as
+        updateResource() does. The versions are selected for all objects
+        before any is updated, and objects that already are at the
+        selected version, with the same sticky tag, are skipped.
+
+        A savepoint is taken and the object cache is minimized every
+        savepoint_interval updates, after which progress(done, total) is
+        called if given. A mapping is returned with the number of objects
+        'updated' to another version, 'retagged' with only a new sticky
+        tag and 'skipped', and a list of the (path, message) 'errors' of
+        objects that could not be updated.
+
+        Permission: Use version control
+        """
+
     def labelResource(object, label, force=None):
         """
         Associate the given resource with a label. If force is true, then
@@ -169,6 +237,27 @@ class IVersionControl(Interface):
         Permission: Use version control
         """
 
+    def getLabelsForHistory(object):
+        """
+        Return a sequence of the (string) labels that have been
+        associated with any version of the version history of the given
+        object.
+
+        Permission: Use version control
+        """
+
+    def getLabelsForVersion(object, version_id=None):
+        """
+        Return a sequence of the (string) labels that have been
+        associated with the given version of the version history of the
+        given object, in order. If no version_id is given, the labels of
+        the version that the object is currently at are returned. The
+        labels are looked up in an index of the history, so that they
+        can be listed for every version of a history cheaply.
+
+        Permission: Use version control
+        """
+
     def getLogEntries(object):
         """
         Return a sequence of LogEntry objects (most recent first) that
@@ -177,6 +266,28 @@ class IVersionControl(Interface):
         Permission: Use version control
         """
 
+    def getLabeledVersions(label, min=None, max=None):
+        """
+        Return a sequence of the (history_id, version_id) of the versions
+        that have been associated with the given label, one for each
+        version history that carries the label, in the order of their
+        history ids. If min or max are given, only the version histories
+        with ids in that range are included. This can be used to list the
+        contents of a release.
+
+        Permission: Use version control
+        """
+
+    def getBranchHistoryIds(branch_id, min=None, max=None):
+        """
+        Return a sequence of the ids of the version histories that have
+        the given branch (activity), in order. Every version history has
+        the 'mainline' branch. If min or max are given, only the ids in
+        that range are included.
+
+        Permission: Use version control
+        """
+
 
 class IVersionInfo(Interface):
     """The IVersionInfo interface provides access to version control
@@ -216,7 +327,8 @@ class ILogEntry(Interface):
 
          action - an enumerated value indicating the action that was taken.
          This value is one of the LogEntry class constants ACTION_CHECKOUT,
-         ACTION_CHECKIN, ACTION_UNCHECKOUT, ACTION_UPDATE.
+         ACTION_CHECKIN, ACTION_UNCHECKOUT, ACTION_UPDATE,
+         ACTION_CHECKIN_UNCHANGED.
 
          message - a string message provided by the user at the time of the
          action. This string may be empty.
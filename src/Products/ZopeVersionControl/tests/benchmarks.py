@@ -0,0 +1,683 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Benchmarks for the ZVC machinery.
+
+These are not run as part of the test suite. Run them with:
+
+  python -m Products.ZopeVersionControl.tests.benchmarks <name> [options]
+
+Use --help to list the available benchmarks.
+"""
+import argparse
+import time
+import tracemalloc
+from io import BytesIO
+
+import transaction
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+MB = 1024 * 1024
+
+benchmarks = {}
+
+
+def benchmark(func):
+    benchmarks[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+class Fixture:
+    """The test fixture of common_setUp, outside of a test case."""
+
+    def __enter__(self):
+        common_setUp(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        common_tearDown(self)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def peak(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def legacyCloneByPickle(obj, ignore_list=()):
+    """cloneByPickle() as it was before protocol 5 cloning."""
+    from ZODB._compat import Pickler
+    from ZODB._compat import Unpickler
+
+    from ..Version import _ignoringPersistentId
+    from ..Version import _placeholderLoad
+    stream = BytesIO()
+    p = Pickler(stream, 1)
+    p.persistent_id = _ignoringPersistentId(ignore_list)
+    p.dump(obj)
+    stream.seek(0)
+    u = Unpickler(stream)
+    u.persistent_load = _placeholderLoad
+    return u.load()
+
+
+def addFile(fixture, id, size):
+    from OFS.Image import manage_addFile
+    data = bytes(range(256)) * (size // 256)
+    manage_addFile(fixture.folder2, id, BytesIO(data))
+    transaction.commit()
+    return getattr(fixture.folder2, id)
+
+
+def checkinCycle(repository, obj):
+    repository.checkoutResource(obj)
+    obj.title = 'changed %s' % time.time()
+    repository.checkinResource(obj, '')
+    transaction.commit()
+
+
+def updateCycle(repository, obj, selector):
+    repository.updateResource(obj, selector)
+    transaction.commit()
+
+
+@benchmark
+def bench_clone(args):
+    """Checkin and update of File objects with protocol 1 and protocol 5
+       cloning (version_storage = 'full')."""
+    from .. import Version
+    current = Version.cloneByPickle
+    print('%8s %-10s %12s %12s %12s' % (
+        'size', 'cloning', 'checkin s', 'update s', 'peak MB'))
+    for size in args.sizes:
+        for name, clone in (('protocol 1', legacyCloneByPickle),
+                            ('protocol 5', current)):
+            Version.cloneByPickle = clone
+            try:
+                with Fixture() as f:
+                    obj = addFile(f, 'file', size * MB)
+                    f.repository.applyVersionControl(obj)
+                    transaction.commit()
+                    checkin = timed(checkinCycle, f.repository, obj)
+                    update = timed(updateCycle, f.repository, obj, '1')
+                    updateCycle(f.repository, obj, None)
+                    memory = peak(checkinCycle, f.repository, obj)
+            except RecursionError:
+                # Long Pdata chains are pickled recursively.
+                print('%6dMB %-10s %12s' % (size, name, 'RecursionError'))
+                continue
+            finally:
+                Version.cloneByPickle = current
+            print('%6dMB %-10s %12.3f %12.3f %12.1f' % (
+                size, name, checkin, update, memory / MB))
+
+
+@benchmark
+def bench_cache(args):
+    """Repeated getVersionOfResource() of a File version with and without
+       the state cache."""
+    from ..StateCache import stateCache
+    limit = stateCache.max_entries
+    print('%8s %-10s %12s' % ('size', 'cache', 'copy ms'))
+    for size in args.sizes:
+        for name, entries in (('off', 0), ('on', limit)):
+            stateCache.setLimits(max_entries=entries)
+            try:
+                with Fixture() as f:
+                    obj = addFile(f, 'file', size * MB)
+                    f.repository.applyVersionControl(obj)
+                    transaction.commit()
+                    info = f.repository.getVersionInfo(obj)
+                    copy = f.repository.getVersionOfResource
+                    copy(info.history_id, '1')
+                    elapsed = timed(
+                        lambda: [copy(info.history_id, '1')
+                                 for n in range(10)])
+            finally:
+                stateCache.setLimits(max_entries=limit)
+            print('%6dMB %-10s %12.1f' % (size, name, elapsed * 100))
+
+
+@benchmark
+def bench_diff(args):
+    """diffVersions() of a folder of 1000 * size items with one changed
+       item, with and without recorded fingerprints."""
+    from OFS.DTMLDocument import addDTMLDocument
+    print('%8s %-10s %12s' % ('items', 'recorded', 'diff ms'))
+    for size in args.sizes:
+        for record in (False, True):
+            with Fixture() as f:
+                f.repository.setRecordFingerprints(record)
+                folder = f.folder2
+                for n in range(size * 1000):
+                    addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+                    getattr(folder, 'item%d' % n).__non_versionable__ = 1
+                transaction.commit()
+                f.repository.applyVersionControl(folder)
+                f.repository.checkoutResource(folder)
+                folder.item0.manage_edit('changed', '')
+                f.repository.checkinResource(folder, '')
+                transaction.commit()
+                info = f.repository.getVersionInfo(folder)
+                history = f.repository.getVersionHistory(info.history_id)
+                f.connection.cacheMinimize()
+                elapsed = timed(history.diffVersions, '1', '2')
+            print('%8d %-10s %12.1f' % (size * 1000, record, elapsed * 1000))
+
+
+@benchmark
+def bench_changed(args):
+    """Repeated isResourceChanged() of a folder of 1000 * size items,
+       with and without the modification time index."""
+    from OFS.DTMLDocument import addDTMLDocument
+
+    from .. import Repository
+    from ..Utility import _findModificationTime
+    current = Repository.findModificationTime
+    print('%8s %-10s %12s' % ('items', 'index', 'check ms'))
+    for size in args.sizes:
+        for name, find in (
+                ('off', lambda obj, newer_than=None:
+                    _findModificationTime(obj)),
+                ('on', current)):
+            Repository.findModificationTime = find
+            try:
+                with Fixture() as f:
+                    folder = f.folder2
+                    for n in range(size * 1000):
+                        addDTMLDocument(
+                            folder, 'item%d' % n, file='text %d' % n)
+                    transaction.commit()
+                    f.repository.applyVersionControl(folder)
+                    transaction.commit()
+                    f.repository.isResourceChanged(folder)
+                    elapsed = timed(
+                        lambda: [f.repository.isResourceChanged(folder)
+                                 for n in range(10)])
+            finally:
+                Repository.findModificationTime = current
+            print('%8d %-10s %12.2f' % (size * 1000, name, elapsed * 100))
+
+
+@benchmark
+def bench_walk(args):
+    """_findModificationTime() of a folder of 1000 * size items, walking
+       the whole folder and stopping at the first change."""
+    from OFS.DTMLDocument import addDTMLDocument
+
+    from ..Utility import _findModificationTime
+    print('%8s %-10s %12s %10s %10s' % (
+        'items', 'walk', 'walk ms', 'records', 'KB'))
+    for size in args.sizes:
+        with Fixture() as f:
+            folder = f.folder2
+            for n in range(size * 1000):
+                addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+            transaction.commit()
+            mtime = folder._p_mtime
+            folder.item0.manage_edit('changed', '')
+            transaction.commit()
+            for name, newer_than in (('full', None), ('early', mtime)):
+                stats = {}
+                elapsed = timed(_findModificationTime, folder, newer_than,
+                                None, None, stats)
+                print('%8d %-10s %12.1f %10d %10d' % (
+                    size * 1000, name, elapsed * 1000, stats['records'],
+                    stats['bytes'] // 1024))
+
+
+@benchmark
+def bench_status(args):
+    """Status report (isResourceChanged and isResourceUpToDate) over a
+       versioned folder and 1000 * size versioned documents in it, one
+       resource at a time and in bulk."""
+    from OFS.DTMLDocument import addDTMLDocument
+
+    from ..MTimeIndex import getMTimeIndex
+    print('%8s %-10s %12s' % ('items', 'calls', 'report ms'))
+    for size in args.sizes:
+        with Fixture() as f:
+            repository = f.repository
+            folder = f.folder2
+            resources = [repository.applyVersionControl(folder)]
+            for n in range(size * 1000):
+                addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+                resources.append(repository.applyVersionControl(
+                    getattr(folder, 'item%d' % n)))
+            transaction.commit()
+            index = getMTimeIndex(f.connection.db())
+
+            def single():
+                for resource in resources:
+                    repository.isResourceChanged(resource)
+                    repository.isResourceUpToDate(resource)
+
+            def bulk():
+                repository.areResourcesChanged(resources)
+                repository.areResourcesUpToDate(resources)
+
+            for name, report in (('single', single), ('bulk', bulk)):
+                index.clear()
+                elapsed = timed(report)
+                print('%8d %-10s %12.1f' % (
+                    len(resources), name, elapsed * 1000))
+
+
+@benchmark
+def bench_scan(args):
+    """Detection of version-controlled records among the records of a
+       folder of 1000 * size documents, a tenth of them versioned: the
+       former substring scan and the opcode scan, with and without the
+       substring prefilter."""
+    from OFS.DTMLDocument import addDTMLDocument
+
+    from ..Utility import _VC_INFO
+    from ..Utility import _hasVersionInfo
+    print('%8s %-12s %10s %10s' % ('records', 'scan', 'scan ms', 'found'))
+    scans = (
+        ('substring', lambda p: p.find(b'U\x0b__vc_info__') != -1),
+        ('opcodes', _hasVersionInfo),
+        ('prefiltered', lambda p: _VC_INFO in p and _hasVersionInfo(p)),
+    )
+    for size in args.sizes:
+        with Fixture() as f:
+            folder = f.folder2
+            for n in range(size * 1000):
+                addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+                if not n % 10:
+                    f.repository.applyVersionControl(
+                        getattr(folder, 'item%d' % n))
+            transaction.commit()
+            load = f.connection._storage.load
+            records = [load(item._p_oid)[0] for item in folder.objectValues()]
+            for name, scan in scans:
+                start = time.perf_counter()
+                found = sum(1 for p in records if scan(p))
+                elapsed = time.perf_counter() - start
+                print('%8d %-12s %10.1f %10d' % (
+                    len(records), name, elapsed * 1000, found))
+
+
+@benchmark
+def bench_tree(args):
+    """Putting a folder of 1000 * size documents under version control,
+       one object at a time and with applyVersionControlTree()."""
+    from OFS.DTMLDocument import addDTMLDocument
+    print('%8s %-10s %12s %12s' % ('items', 'calls', 'apply s', 'peak MB'))
+    for size in args.sizes:
+        for name in ('single', 'tree'):
+            with Fixture() as f:
+                repository = f.repository
+                folder = f.folder2
+                for n in range(size * 1000):
+                    addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+                transaction.commit()
+                f.connection.cacheMinimize()
+
+                def single():
+                    repository.applyVersionControl(folder)
+                    for item in folder.objectValues():
+                        if repository.isAVersionableResource(item):
+                            repository.applyVersionControl(item)
+                    transaction.commit()
+
+                def tree():
+                    repository.applyVersionControlTree(folder)
+                    transaction.commit()
+
+                report = single if name == 'single' else tree
+                start = time.perf_counter()
+                memory = peak(report)
+                elapsed = time.perf_counter() - start
+                print('%8d %-10s %12.2f %12.1f' % (
+                    size * 1000, name, elapsed, memory / MB))
+
+
+@benchmark
+def bench_deploy(args):
+    """Updating a folder of 1000 * size documents, of which one in ten
+       is at an older version, to the mainline: one object at a time
+       with updateResource() and with updateTreeToSelector()."""
+    from OFS.DTMLDocument import addDTMLDocument
+    print('%8s %-10s %12s %12s' % ('items', 'calls', 'update s', 'peak MB'))
+    for size in args.sizes:
+        for name in ('single', 'tree'):
+            with Fixture() as f:
+                repository = f.repository
+                folder = f.folder2
+                for n in range(size * 1000):
+                    addDTMLDocument(folder, 'item%d' % n,
+                                    file='text %d ' % n * 100)
+                repository.applyVersionControlTree(folder)
+                transaction.commit()
+                items = [item for item in folder.objectValues()
+                         if repository.isUnderVersionControl(item)]
+                for item in items[::10]:
+                    repository.checkoutResource(item)
+                    item.manage_edit('changed', '')
+                    repository.checkinResource(item, '')
+                    repository.updateResource(item, '1')
+                transaction.commit()
+                f.connection.cacheMinimize()
+
+                def single():
+                    repository.updateResource(folder, 'mainline')
+                    for item in folder.objectValues():
+                        if repository.isUnderVersionControl(item):
+                            repository.updateResource(item, 'mainline')
+                    transaction.commit()
+
+                def tree():
+                    repository.updateTreeToSelector(folder, 'mainline')
+                    transaction.commit()
+
+                report = single if name == 'single' else tree
+                start = time.perf_counter()
+                memory = peak(report)
+                elapsed = time.perf_counter() - start
+                print('%8d %-10s %12.2f %12.1f' % (
+                    size * 1000, name, elapsed, memory / MB))
+
+
+@benchmark
+def bench_manifest(args):
+    """Listing the versions that carry a label, which one in ten of
+       1000 * size histories carry, from a cold cache: scanning the
+       histories and with the label index."""
+    from OFS.DTMLDocument import addDTMLDocument
+    print('%8s %-8s %12s %10s' % ('items', 'lookup', 'list ms', 'loads'))
+    for size in args.sizes:
+        with Fixture() as f:
+            repository = f.repository
+            folder = f.folder2
+            for n in range(size * 1000):
+                addDTMLDocument(folder, 'item%d' % n, file='text %d' % n)
+            repository.applyVersionControlTree(folder)
+            transaction.commit()
+            items = [item for item in folder.objectValues()
+                     if repository.isUnderVersionControl(item)]
+            for item in items[::10]:
+                repository.labelResource(item, 'release')
+            transaction.commit()
+            for name in ('scan', 'index'):
+                index = repository._label_index
+                if name == 'scan':
+                    repository._label_index = None
+                f.connection.cacheMinimize()
+                storage = f.connection._storage
+                loads = []
+
+                def load(oid, *args):
+                    loads.append(oid)
+                    return type(storage).load(storage, oid, *args)
+
+                storage.load = load
+                start = time.perf_counter()
+                repository.getLabeledVersions('release')
+                elapsed = time.perf_counter() - start
+                del storage.load
+                repository._label_index = index
+                transaction.abort()
+                print('%8d %-8s %12.1f %10d' % (
+                    size * 1000, name, elapsed * 1000, len(loads)))
+
+
+@benchmark
+def bench_version_labels(args):
+    """Listing the labels of every version of a history of 100 * size
+       versions, each with two labels, as the version control tab does:
+       scanning the labels of the history and with the version index."""
+    print('%8s %-8s %12s' % ('versions', 'lookup', 'list ms'))
+    for size in args.sizes:
+        with Fixture() as f:
+            repository = f.repository
+            document = f.document1
+            repository.applyVersionControl(document)
+            for n in range(size * 100):
+                repository.checkoutResource(document)
+                document.manage_edit('text %d' % n, '')
+                repository.checkinResource(document, '')
+                repository.labelResource(document, 'build-%d' % n)
+                repository.labelResource(document, 'tag-%d' % n)
+            transaction.commit()
+            info = repository.getVersionInfo(document)
+            history = repository.getVersionHistory(info.history_id)
+            version_ids = history.getVersionIds()
+            for name in ('scan', 'index'):
+                index = history._version_labels
+                if name == 'scan':
+                    history._version_labels = None
+                start = time.perf_counter()
+                for version_id in version_ids:
+                    repository.getLabelsForVersion(document, version_id)
+                elapsed = time.perf_counter() - start
+                history._version_labels = index
+                print('%8d %-8s %12.1f' % (
+                    len(version_ids), name, elapsed * 1000))
+
+
+class LatencyStorage:
+    """A stand-in for a remote (ZEO or RelStorage) storage: loads from
+       the wrapped storage take latency seconds, like a network round
+       trip, and can run concurrently."""
+
+    def __init__(self, base, latency=0):
+        self.base = base
+        self.latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def loadBefore(self, oid, tid):
+        time.sleep(self.latency)
+        return self.base.loadBefore(oid, tid)
+
+    def load(self, oid, version=''):
+        time.sleep(self.latency)
+        return self.base.load(oid, version)
+
+
+@benchmark
+def bench_parallel(args):
+    """_findModificationTime() of a tree of 100 * size records behind a
+       storage with 1 ms load latency, serial and with thread pools."""
+    from persistent.mapping import PersistentMapping
+    from ZODB import DB
+    from ZODB.DemoStorage import DemoStorage
+
+    from ..Utility import _findModificationTime
+    print('%8s %-10s %12s' % ('records', 'workers', 'walk ms'))
+    for size in args.sizes:
+        storage = LatencyStorage(DemoStorage())
+        db = DB(storage)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        try:
+            resource = conn.root()['resource'] = PersistentMapping()
+            for n in range(size * 10):
+                resource[n] = folder = PersistentMapping()
+                for m in range(9):
+                    folder[m] = PersistentMapping()
+            tm.commit()
+            storage.latency = 0.001
+            expected = None
+            for workers in (None, 4, 16, 64):
+                conn.cacheMinimize()
+                start = time.perf_counter()
+                mtime = _findModificationTime(resource, workers=workers)
+                elapsed = time.perf_counter() - start
+                assert expected is None or mtime == expected
+                expected = mtime
+                print('%8d %-10s %12.1f' % (
+                    size * 100 + 1, workers or 'serial', elapsed * 1000))
+        finally:
+            tm.abort()
+            conn.close()
+            db.close()
+
+
+@benchmark
+def bench_history(args):
+    """Checkin cost in a history of 1000 * size versions, with a cold
+       object cache, next to the cost of counting the versions and log
+       entries with len() on their BTrees as checkins used to do."""
+    print('%8s %12s %12s' % ('versions', 'checkin ms', 'len() ms'))
+    for size in args.sizes:
+        with Fixture() as f:
+            repository = f.repository
+            document = repository.applyVersionControl(f.document1)
+            transaction.commit()
+            info = repository.getVersionInfo(document)
+            history = repository.getVersionHistory(info.history_id)
+            for n in range(size * 1000 - 1):
+                repository.checkoutResource(document)
+                repository.checkinResource(document, '')
+                if not n % 500:
+                    transaction.commit()
+            transaction.commit()
+            jar = history._p_jar
+            jar.cacheMinimize()
+            elapsed = timed(lambda: [checkinCycle(repository, document)
+                                     for n in range(20)])
+            jar.cacheMinimize()
+            branch = history._branches['mainline']
+            log = history._eventLog
+            counted = timed(lambda: (len(branch.m_order), len(log._data)))
+            print('%8d %12.2f %12.2f' % (
+                len(branch), elapsed * 1000 / 20, counted * 1000))
+
+
+@benchmark
+def bench_async(args):
+    """Checkin latency of a File of size MB with the states of versions
+       saved during the checkin or queued for a CheckinWorker, and the
+       time the worker takes to save a queued state."""
+    from ..CheckinQueue import CheckinWorker
+    print('%6s %-6s %12s %12s' % ('MB', 'mode', 'checkin ms', 'worker ms'))
+    for size in args.sizes:
+        for async_checkin in (False, True):
+            with Fixture() as f:
+                repository = f.repository
+                obj = addFile(f, 'file', size * MB)
+                repository.applyVersionControl(obj)
+                repository.setAsyncCheckin(async_checkin)
+                transaction.commit()
+                worker = CheckinWorker(repository)
+                worker.processQueue()
+                checkin = drain = 0
+                for n in range(5):
+                    checkin += timed(checkinCycle, repository, obj)
+                    drain += timed(worker.processQueue)
+                assert worker.processed == (5 if async_checkin else 0)
+                print('%6d %-6s %12.1f %12.1f' % (
+                    size, 'async' if async_checkin else 'sync',
+                    checkin * 1000 / 5, drain * 1000 / 5))
+
+
+def legacyNextKey(mapping):
+    """EventLog.nextKey() as it was before keys were taken from slots."""
+    from ..EventLog import MAX32
+    return mapping.minKey() - 1 if len(mapping) else MAX32
+
+
+@benchmark
+def bench_conflicts(args):
+    """Conflict rate of threads that each label their own resource with
+       the same new label, and log an entry in one shared history, in a
+       transaction per round. Sizes are numbers of threads."""
+    import threading
+    from unittest import mock
+
+    from BTrees.OIBTree import OIBTree
+    from OFS.DTMLDocument import addDTMLDocument
+    from ZODB.POSException import ConflictError
+
+    from .. import EventLog
+    rounds = 50
+    print('%8s %-8s %10s %10s' % ('threads', 'keys', 'commits', 'conflicts'))
+    for threads in args.sizes:
+        for legacy in (True, False):
+            with Fixture() as fixture, mock.patch.object(
+                    EventLog, 'nextKey',
+                    legacyNextKey if legacy else EventLog.nextKey):
+                repository = fixture.repository
+                if legacy:
+                    repository._labels = OIBTree()
+                for n in range(threads):
+                    addDTMLDocument(fixture.folder2, 'doc%d' % n, file='x')
+                    repository.applyVersionControl(
+                        getattr(fixture.folder2, 'doc%d' % n))
+                repository.applyVersionControl(fixture.document1)
+                history_id = repository.getVersionInfo(
+                    fixture.document1).history_id
+                transaction.commit()
+                db = fixture.connection.db()
+                db.setPoolSize(threads + 1)
+                conflicts = []
+
+                def work(n):
+                    tm = transaction.TransactionManager()
+                    conn = db.open(tm)
+                    folder1 = conn.root()['Application'].folder1
+                    count = 0
+                    for round in range(rounds):
+                        while True:
+                            repository = folder1.repository
+                            history = repository.getVersionHistory(history_id)
+                            history.addLogEntry('1', 0, message=str(n))
+                            repository.labelResource(
+                                getattr(folder1.folder2, 'doc%d' % n),
+                                'round%d' % round)
+                            time.sleep(0.001)
+                            try:
+                                tm.commit()
+                                break
+                            except ConflictError:
+                                tm.abort()
+                                count += 1
+                    conn.close()
+                    conflicts.append(count)
+
+                workers = [threading.Thread(target=work, args=(n,))
+                           for n in range(threads)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                print('%8d %-8s %10d %10d' % (
+                    threads, 'legacy' if legacy else 'slotted',
+                    threads * rounds, sum(conflicts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50],
+                        help='object sizes: MB, or thousands of items')
+    args = parser.parse_args(argv)
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,9 @@ def common_setUp(self):
     from Testing.makerequest import makerequest
 
     import Products.ZopeVersionControl
+    from Products.ZopeVersionControl.StateCache import stateCache
     Products.ZopeVersionControl.install_hack()
+    stateCache.clear()
 
     from io import StringIO
 
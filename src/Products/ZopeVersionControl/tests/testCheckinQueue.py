@@ -0,0 +1,279 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the background saving of checked in states."""
+import time
+import unittest
+
+import transaction
+
+from Products.ZopeVersionControl.CheckinQueue import CheckinQueue
+from Products.ZopeVersionControl.CheckinQueue import CheckinWorker
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class ConflictResolutionTests(unittest.TestCase):
+
+    def testQueueCountsJobs(self):
+        queue = CheckinQueue()
+        queue.add(('a', '1'), None)
+        queue.add(('b', '1'), None)
+        queue.add(('a', '1'), None)
+        self.assertEqual(len(queue), 2)
+        queue.remove(('a', '1'))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.keys(), [('b', '1')])
+
+    def testVersionMergesDifferentAttributes(self):
+        from ZODB.POSException import ConflictError
+
+        from Products.ZopeVersionControl.Version import Version
+        version = Version('1', None)
+        old = {'id': '1', '_data': None, '_pending': True}
+        committed = {'id': '1', '_data': b'state'}
+        new = {'id': '1', '_data': None, '_pending': True, 'next': ('2',)}
+        self.assertEqual(version._p_resolveConflict(old, committed, new),
+                         {'id': '1', '_data': b'state', 'next': ('2',)})
+        self.assertRaises(ConflictError, version._p_resolveConflict,
+                          old, committed, {'id': '1', '_data': b'other'})
+
+
+class CheckinQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        repository = self.repository
+        self.document = repository.applyVersionControl(self.document1)
+        repository.setAsyncCheckin(True)
+        transaction.commit()
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def checkin(self, text):
+        repository = self.repository
+        repository.checkoutResource(self.document)
+        self.document.manage_edit(text, '')
+        repository.checkinResource(self.document, '')
+        return repository.getVersionInfo(self.document)
+
+    def getVersion(self, info, version_id=None):
+        history = self.repository.getVersionHistory(info.history_id)
+        return history.getVersionById(version_id or info.version_id)
+
+    def testQueuedCheckin(self):
+        repository = self.repository
+        info = self.checkin('checked in')
+        transaction.commit()
+        self.assertTrue(self.getVersion(info)._pending)
+        self.assertEqual(repository.listQueuedCheckins(),
+                         [(info.history_id, '2')])
+        self.assertEqual(repository.getCheckinQueueStatistics()['depth'], 1)
+
+        # Later changes to the resource do not leak into the version.
+        repository.checkoutResource(self.document)
+        self.document.manage_edit('edited later', '')
+        transaction.commit()
+
+        worker = CheckinWorker(repository)
+        self.assertEqual(worker.processQueue(), 1)
+        transaction.begin()
+        version = self.getVersion(info)
+        self.assertFalse(version._pending)
+        self.assertEqual(version.copyState().read(), 'checked in')
+        stats = worker.getStatistics()
+        self.assertEqual((stats['depth'], stats['processed'], stats['failed']),
+                         (0, 1, 0))
+
+    def testPackedCheckinState(self):
+        # Once the checked in state has been packed away, the current
+        # state is saved instead.
+        repository = self.repository
+        info = self.checkin('checked in')
+        transaction.commit()
+        repository.checkoutResource(self.document)
+        self.document.manage_edit('edited later', '')
+        transaction.commit()
+        self.connection.db().pack(time.time() + 1)
+
+        worker = CheckinWorker(repository)
+        with self.assertLogs('Products.ZopeVersionControl', 'WARNING'):
+            self.assertEqual(worker.processQueue(), 1)
+        transaction.begin()
+        version = self.getVersion(info)
+        self.assertFalse(version._pending)
+        self.assertEqual(version.copyState().read(), 'edited later')
+
+    def testReadingPendingVersionSavesIt(self):
+        repository = self.repository
+        self.checkin('checked in')
+        transaction.commit()
+        repository.checkoutResource(self.document)
+        self.document.manage_edit('edited later', '')
+        transaction.commit()
+        repository.uncheckoutResource(self.document)
+        self.assertEqual(self.document.read(), 'checked in')
+        self.assertEqual(repository.listQueuedCheckins(), [])
+
+    def testReadingInCheckinTransaction(self):
+        repository = self.repository
+        info = self.checkin('checked in')
+        obj = repository.getVersionOfResource(info.history_id, '2')
+        self.assertEqual(obj.read(), 'checked in')
+        self.assertEqual(repository.listQueuedCheckins(), [])
+
+    def testDeltaVersionsAreSavedInOrder(self):
+        repository = self.repository
+        repository.setVersionStorage('delta')
+        self.checkin('second')
+        transaction.commit()
+        info = self.checkin('third')
+        transaction.commit()
+        self.assertEqual(self.getVersion(info).copyState().read(), 'third')
+        self.assertFalse(self.getVersion(info, '2')._pending)
+        self.assertEqual(self.getVersion(info, '2').copyState().read(),
+                         'second')
+        self.assertEqual(self.getVersion(info)._format, 'delta')
+
+    def testFailingJobs(self):
+        repository = self.repository
+        info = self.checkin('checked in')
+        repository._checkin_queue.add(('missing', '1'), self.document)
+        transaction.commit()
+        worker = CheckinWorker(repository, max_attempts=2)
+        for n in range(3):
+            worker.processQueue()
+        stats = worker.getStatistics()
+        self.assertEqual(stats['depth'], 1)
+        self.assertEqual(stats['processed'], 1)
+        self.assertEqual(stats['failed'], 2)
+        self.assertEqual(stats['failing'], [('missing', '1')])
+        self.assertEqual(stats['last_error'][0], ('missing', '1'))
+        self.assertGreater(stats['lag'], 0)
+        transaction.begin()
+        self.assertFalse(self.getVersion(info)._pending)
+
+    def testConcurrentQueueing(self):
+        # Checkins and a worker add and remove jobs at the same time.
+        repository = self.repository
+        repository.applyVersionControl(self.document2)
+        transaction.commit()
+        info = self.checkin('first')
+        transaction.commit()
+        db = self.connection.db()
+        runs = []
+        for name, text in (('document1', 'second'), ('document2', 'other')):
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            folder1 = conn.root()['Application'].folder1
+            document = getattr(folder1.folder2, name)
+            folder1.repository.checkoutResource(document)
+            document.manage_edit(text, '')
+            folder1.repository.checkinResource(document, '')
+            runs.append((tm, conn))
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        conn.root()['Application'].folder1.repository.completeCheckin(
+            info.history_id, '2')
+        runs.append((tm, conn))
+        for tm, conn in runs:
+            tm.commit()
+            conn.close()
+        transaction.begin()
+        self.assertEqual(len(repository.listQueuedCheckins()), 2)
+        self.assertEqual(repository.getCheckinQueueStatistics()['depth'], 2)
+        self.assertEqual(
+            repository.getVersionOfResource(info.history_id, '2').read(),
+            'first')
+
+    def testOneNotifyHookPerTransaction(self):
+        from Products.ZopeVersionControl.CheckinQueue import notifyWorkers
+        repository = self.repository
+        document2 = repository.applyVersionControl(self.document2)
+        transaction.commit()
+        for document in (self.document, document2):
+            repository.checkoutResource(document)
+            repository.checkinResource(document, '')
+        self.assertEqual(len(repository.listQueuedCheckins()), 2)
+        hooks = [hook for hook, args, kws in
+                 transaction.get().getAfterCommitHooks()
+                 if hook is notifyWorkers]
+        self.assertEqual(len(hooks), 1)
+
+    def testWorkerThread(self):
+        repository = self.repository
+        worker = CheckinWorker(repository, interval=10)
+        worker.start()
+        try:
+            info = self.checkin('checked in')
+            transaction.commit()
+            deadline = time.time() + 10
+            while worker.processed < 1 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            worker.stop()
+        transaction.begin()
+        self.assertFalse(self.getVersion(info)._pending)
+
+    def testStartConfiguredWorkers(self):
+        import os
+        from unittest import mock
+
+        from zope.processlifetime import DatabaseOpenedWithRoot
+
+        from Products.ZopeVersionControl.CheckinQueue import getWorkers
+        from Products.ZopeVersionControl.CheckinQueue import \
+            startConfiguredWorkers
+        event = DatabaseOpenedWithRoot(self.connection.db())
+        paths = '/folder1/repository /folder1/missing /folder1'
+        with mock.patch.dict(os.environ, {'ZVC_CHECKIN_WORKERS': paths}):
+            startConfiguredWorkers(event)
+            # Handlers registered twice do not start a second worker.
+            startConfiguredWorkers(event)
+        workers = getWorkers(self.repository)
+        try:
+            self.assertEqual(len(workers), 1)
+            info = self.checkin('checked in')
+            transaction.commit()
+            deadline = time.time() + 10
+            while workers[0].processed < 1 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            for worker in workers:
+                worker.stop()
+        self.assertEqual(getWorkers(self.repository), [])
+        transaction.begin()
+        self.assertFalse(self.getVersion(info)._pending)
+
+    def testPropertiesTab(self):
+        repository = self.repository
+        self.checkin('checked in')
+        repository._checkin_queue.add(('missing', '1'), self.document)
+        transaction.commit()
+        worker = CheckinWorker(repository, interval=10)
+        worker.processQueue()
+        transaction.begin()
+        worker.start()
+        try:
+            status = repository.getCheckinQueueStatus()
+            self.assertEqual(status['depth'], 1)
+            self.assertEqual(len(status['workers']), 1)
+            self.assertEqual(status['workers'][0]['processed'], 1)
+            html = repository.manage_properties_form(
+                repository, self.app.REQUEST)
+        finally:
+            worker.stop()
+        self.assertIn('1 queued checkins', html)
+        self.assertIn('1 saved, 0 conflicts', html)
+        self.assertIn("Last error: KeyError: 'missing'", html)
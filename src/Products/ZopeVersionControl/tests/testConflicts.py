@@ -0,0 +1,230 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the resolution of conflicts in the version control bookkeeping."""
+import unittest
+
+import transaction
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from ZODB.DB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.POSException import ConflictError
+
+from Products.ZopeVersionControl.ContentStore import RefCount
+from Products.ZopeVersionControl.EventLog import MAX32
+from Products.ZopeVersionControl.EventLog import nextKey
+from Products.ZopeVersionControl.NameSet import NameSet
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class NameSetTests(unittest.TestCase):
+
+    def testAdd(self):
+        names = NameSet(['mainline'])
+        names.add('dev')
+        names.add('dev')
+        self.assertIn('dev', names)
+        self.assertEqual(names.keys(), ['dev', 'mainline'])
+        self.assertEqual(len(names), 2)
+
+    def testResolveConflict(self):
+        names = NameSet()
+
+        def state(*names):
+            return {'_names': frozenset(names)}
+
+        resolved = names._p_resolveConflict(
+            state('a', 'b'), state('a', 'b', 'c'), state('b', 'd', 'c'))
+        self.assertEqual(resolved['_names'], {'b', 'c', 'd'})
+
+
+class RefCountTests(unittest.TestCase):
+
+    def testConcurrentChangesAddUp(self):
+        refcount = RefCount()
+        self.assertEqual(refcount._p_resolveConflict(2, 3, 4), 5)
+        self.assertEqual(refcount._p_resolveConflict(2, 1, 3), 2)
+
+    def testReleasingTheLastReferenceConflicts(self):
+        # The record was removed by one side while the other shared it.
+        refcount = RefCount()
+        self.assertRaises(ConflictError,
+                          refcount._p_resolveConflict, 1, 0, 2)
+        self.assertRaises(ConflictError,
+                          refcount._p_resolveConflict, 1, 2, 0)
+
+
+class NextKeyTests(unittest.TestCase):
+
+    def testKeysDecrease(self):
+        mapping = IOBTree()
+        self.assertEqual(nextKey(mapping), MAX32)
+        for n in range(100):
+            key = nextKey(mapping)
+            self.assertTrue(len(mapping) == 0 or key < mapping.minKey())
+            mapping[key] = n
+        self.assertEqual(list(mapping.values()), list(range(99, -1, -1)))
+
+    def testKeysAreDense(self):
+        # Without a connection, entries take consecutive keys.
+        mapping = IOBTree()
+        for n in range(100):
+            mapping[nextKey(mapping)] = n
+        self.assertEqual(mapping.minKey(), MAX32 - 99)
+
+    def openConnections(self, count):
+        # Open connections of a new database once the connections of
+        # earlier tests are gone, so that they take distinct slots.
+        import gc
+        gc.collect()
+        db = DB(DemoStorage())
+        self.addCleanup(db.close)
+        return [db.open(transaction.TransactionManager())
+                for n in range(count)]
+
+    def testConnectionsTakeDifferentKeys(self):
+        from Products.ZopeVersionControl.EventLog import KEY_SLOTS
+        keys = set()
+        for conn in self.openConnections(8):
+            mapping = conn.root()['mapping'] = IOBTree()
+            mapping[MAX32] = 0
+            conn.transaction_manager.savepoint()
+            key = nextKey(mapping)
+            self.assertTrue(MAX32 - KEY_SLOTS <= key < MAX32)
+            # A connection keeps its slot.
+            self.assertEqual(nextKey(mapping), key)
+            keys.add(key)
+        self.assertEqual(len(keys), 8)
+
+    def testKeysStayInRange(self):
+        from Products.ZopeVersionControl.EventLog import _getSlot
+        from Products.ZopeVersionControl.Utility import VersionControlError
+        mapping = IOBTree()
+        mapping[-MAX32 + 2] = 0
+        for n in range(10):
+            key = nextKey(mapping)
+            self.assertTrue(-MAX32 - 1 <= key < -MAX32 + 2)
+        mapping[-MAX32 - 1] = 1
+        self.assertRaises(VersionControlError, nextKey, mapping)
+
+        # A connection whose slot would take a key below the range does
+        # not fall back to a key that other slots take as well.
+        conn = [conn for conn in self.openConnections(2)
+                if _getSlot(conn)][0]
+        mapping = conn.root()['mapping'] = IOBTree()
+        mapping[-MAX32 - 1 + _getSlot(conn)] = 0
+        conn.transaction_manager.savepoint()
+        self.assertRaises(VersionControlError, nextKey, mapping)
+
+
+class ConcurrentBookkeepingTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        repository = self.repository
+        for document in (self.document1, self.document2):
+            repository.applyVersionControl(document)
+        transaction.commit()
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def race(self, *actions):
+        # Run each action in a transaction of its own connection, all
+        # started before the first one commits, and commit them in turn.
+        db = self.connection.db()
+        runs = []
+        for action in actions:
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            action(conn.root()['Application'].folder1)
+            runs.append((tm, conn))
+        for tm, conn in runs:
+            tm.commit()
+            conn.close()
+        transaction.begin()
+
+    def testConcurrentLogAppends(self):
+        repository = self.repository
+        history_id = repository.getVersionInfo(self.document1).history_id
+
+        def append(message):
+            def action(folder1):
+                history = folder1.repository.getVersionHistory(history_id)
+                history.addLogEntry('1', 0, message=message)
+            return action
+
+        self.race(append('one'), append('two'), append('three'))
+        history = repository.getVersionHistory(history_id)
+        messages = [entry.message for entry in history.getLogEntries()]
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(sorted(messages[:3]), ['one', 'three', 'two'])
+
+    def testConcurrentLabels(self):
+        def label(name):
+            def action(folder1):
+                document = getattr(folder1.folder2, name)
+                folder1.repository.labelResource(document, 'release')
+            return action
+
+        self.race(label('document1'), label('document2'))
+        repository = self.repository
+        self.assertIn('release', repository._labels)
+        for document in (self.document1, self.document2):
+            self.assertIn('release', repository.getLabelsForResource(document))
+
+    def testConcurrentActivities(self):
+        def activity(name, branch_id):
+            def action(folder1):
+                document = getattr(folder1.folder2, name)
+                folder1.repository.makeActivity(document, branch_id)
+            return action
+
+        self.race(activity('document1', 'dev'), activity('document2', 'dev'),
+                  activity('document1', 'fix'))
+        self.assertEqual(self.repository._branches.keys(),
+                         ['dev', 'fix', 'mainline'])
+
+    def testOldNameRegistries(self):
+        repository = self.repository
+        repository._labels = OIBTree({'old': 1})
+        repository.labelResource(self.document1, 'new')
+        self.assertIsInstance(repository._labels, NameSet)
+        self.assertEqual(repository._labels.keys(), ['new', 'old'])
+
+    def testConcurrentDeduplicatedCheckins(self):
+        from persistent.list import PersistentList
+        repository = self.repository
+        repository.setVersionStorage('full', deduplicate=True)
+        for document in (self.document1, self.document2):
+            repository.checkoutResource(document)
+            document.extra = PersistentList(['shared'])
+        repository.checkinResource(self.document1, '')
+        repository.checkoutResource(self.document1)
+        transaction.commit()
+
+        def checkin(name):
+            def action(folder1):
+                document = getattr(folder1.folder2, name)
+                folder1.repository.checkinResource(document, '')
+            return action
+
+        # Both checkins share the record of the list, which was stored
+        # by the first checkin.
+        self.race(checkin('document1'), checkin('document2'))
+        store = repository.getContentStore()
+        self.assertEqual(len(store), 1)
+        key = list(store._records.keys())[0]
+        self.assertEqual(store.getRefCount(key), 3)
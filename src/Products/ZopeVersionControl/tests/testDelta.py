@@ -0,0 +1,88 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the binary delta encoding."""
+import random
+import unittest
+
+from Products.ZopeVersionControl.delta import applyDelta
+from Products.ZopeVersionControl.delta import computeDelta
+
+
+class DeltaTests(unittest.TestCase):
+
+    def roundtrip(self, source, target):
+        delta = computeDelta(source, target)
+        self.assertEqual(applyDelta(source, delta), target)
+        return delta
+
+    def testEmpty(self):
+        self.roundtrip(b'', b'')
+        self.roundtrip(b'', b'spam')
+        self.roundtrip(b'spam', b'')
+
+    def testSmallChangeGivesSmallDelta(self):
+        source = bytes(range(256)) * 400
+        target = source[:5000] + b'changed' + source[5010:]
+        delta = self.roundtrip(source, target)
+        self.assertLess(len(delta), 100)
+
+    def testMovedBlocks(self):
+        rnd = random.Random(42)
+        a = bytes(rnd.getrandbits(8) for i in range(4096))
+        b = bytes(rnd.getrandbits(8) for i in range(4096))
+        delta = self.roundtrip(a + b, b + b'new' + a)
+        self.assertLess(len(delta), 200)
+
+    def testRandomEdits(self):
+        rnd = random.Random(0)
+        for n in range(50):
+            source = bytes(rnd.getrandbits(8)
+                           for i in range(rnd.randint(0, 2000)))
+            target = bytearray(source)
+            for i in range(rnd.randint(0, 5)):
+                pos = rnd.randint(0, len(target))
+                if rnd.random() < 0.5:
+                    target[pos:pos] = b'x' * rnd.randint(1, 100)
+                else:
+                    del target[pos:pos + rnd.randint(1, 100)]
+            self.roundtrip(source, bytes(target))
+
+    def testLimit(self):
+        rnd = random.Random(1)
+        for n in range(50):
+            source = bytes(rnd.getrandbits(8)
+                           for i in range(rnd.randint(0, 2000)))
+            target = bytearray(source)
+            for i in range(rnd.randint(0, 5)):
+                pos = rnd.randint(0, len(target))
+                target[pos:pos] = b'x' * rnd.randint(1, 100)
+            target = bytes(target)
+            delta = computeDelta(source, target)
+            # Count the literal bytes of the unlimited delta.
+            inserted = 0
+            pos = 0
+            while pos < len(delta):
+                if delta[pos:pos + 1] == b'C':
+                    pos += 9
+                else:
+                    length = int.from_bytes(delta[pos + 1:pos + 5], 'big')
+                    inserted += length
+                    pos += 5 + length
+            self.assertEqual(computeDelta(source, target, limit=inserted),
+                             delta)
+            if inserted:
+                self.assertIsNone(
+                    computeDelta(source, target, limit=inserted - 1))
+
+    def testInvalidDelta(self):
+        self.assertRaises(ValueError, applyDelta, b'spam', b'X')
@@ -0,0 +1,118 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the placement of version histories in other databases."""
+import unittest
+
+import transaction
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+
+from Products.ZopeVersionControl.historyids import encodeCounter
+from Products.ZopeVersionControl.Utility import VersionControlError
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class HistoryDatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        databases = self.connection.db().databases
+        self.shards = [
+            DB(DemoStorage(), databases=databases, database_name=name)
+            for name in ('versions1', 'versions2')]
+
+    def tearDown(self):
+        common_tearDown(self)
+        for db in self.shards:
+            db.close()
+
+    def databaseOf(self, object):
+        return object._p_jar.db().database_name
+
+    def applyAndReload(self, *documents):
+        # Put the documents under version control and return the
+        # histories of the documents, as seen by a new connection.
+        repository = self.repository
+        for document in documents:
+            repository.applyVersionControl(document)
+        transaction.commit()
+        conn = self.connection.db().open()
+        self.addCleanup(conn.close)
+        repository = conn.root()['Application'].folder1.repository
+        return [repository.getVersionHistory(
+            self.repository.getVersionInfo(document).history_id)
+            for document in documents]
+
+    def testSetHistoryDatabases(self):
+        repository = self.repository
+        self.assertRaises(VersionControlError,
+                          repository.setHistoryDatabases, ['nowhere'])
+        self.assertRaises(VersionControlError,
+                          repository.setHistoryDatabases, ['versions1'],
+                          policy='random')
+        repository.setHistoryDatabases(['versions1', 'versions2'], 'last')
+        self.assertEqual(repository.history_databases,
+                         ('versions1', 'versions2'))
+        self.assertEqual(repository.getHistoryDatabase('a1'), 'versions2')
+        repository.setHistoryDatabases(())
+        self.assertIsNone(repository.getHistoryDatabase('a1'))
+
+    def testHashPolicy(self):
+        repository = self.repository
+        repository.setHistoryDatabases(['versions1', 'versions2'])
+        histories = self.applyAndReload(self.document1, self.document2)
+        for history in histories:
+            name = repository.getHistoryDatabase(history.getId())
+            self.assertEqual(self.databaseOf(history), name)
+            version = history.getVersionById('1')
+            self.assertEqual(self.databaseOf(version), name)
+            self.assertEqual(version.copyState().read(), 'some text')
+        self.assertEqual(
+            {repository.getHistoryDatabase(encodeCounter(n))
+             for n in range(1, 10)},
+            {'versions1', 'versions2'})
+
+    def testLastPolicy(self):
+        repository = self.repository
+        repository.setHistoryDatabases(['versions1', 'versions2'], 'last')
+        history, = self.applyAndReload(self.document1)
+        self.assertEqual(self.databaseOf(history), 'versions2')
+
+    def testPayloadsOnly(self):
+        repository = self.repository
+        repository.setHistoryDatabases(['versions1'], payloads_only=True)
+        history, = self.applyAndReload(self.document1)
+        self.assertEqual(self.databaseOf(history), 'unnamed')
+        self.assertEqual(self.databaseOf(history.getVersionById('1')),
+                         'versions1')
+
+    def testTransparentOperations(self):
+        repository = self.repository
+        repository.setHistoryDatabases(['versions1'])
+        document = repository.applyVersionControl(self.document1)
+        transaction.commit()
+        repository.checkoutResource(document)
+        document.manage_edit('changed', '')
+        repository.checkinResource(document, '')
+        repository.labelResource(document, 'release')
+        transaction.commit()
+        repository.updateResource(document, '1')
+        self.assertEqual(document.read(), 'some text')
+        repository.updateResource(document, 'release')
+        self.assertEqual(document.read(), 'changed')
+        self.assertEqual(len(repository.getLogEntries(document)), 5)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        self.assertEqual(self.databaseOf(history), 'versions1')
@@ -0,0 +1,219 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the allocation of history ids."""
+import unittest
+
+import transaction
+
+from Products.ZopeVersionControl import historyids
+from Products.ZopeVersionControl.historyids import HistoryIdAllocator
+from Products.ZopeVersionControl.historyids import encodeCounter
+from Products.ZopeVersionControl.historyids import getHistoryIdPrefix
+from Products.ZopeVersionControl.historyids import setHistoryIdPrefix
+from Products.ZopeVersionControl.Utility import VersionControlError
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class AllocatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.node_prefix = historyids._node_prefix
+
+    def tearDown(self):
+        setHistoryIdPrefix(None, thread=True)
+        setHistoryIdPrefix(self.node_prefix)
+
+    def testEncodedCountersSortInOrder(self):
+        values = [1, 9, 10, 35, 36, 1295, 1296, 10 ** 12]
+        encoded = [encodeCounter(value) for value in values]
+        self.assertEqual(encoded, sorted(encoded))
+        self.assertEqual(encoded[:3], ['a1', 'a9', 'aa'])
+        self.assertFalse(any(value.isdigit() for value in encoded))
+
+    def testAllocate(self):
+        allocator = HistoryIdAllocator()
+        self.assertEqual([allocator.allocate() for n in range(3)],
+                         ['a1', 'a2', 'a3'])
+        self.assertEqual(allocator.allocate('node1'), 'node1-a1')
+        self.assertEqual(allocator.allocate(), 'a4')
+
+    def testPrefixes(self):
+        from ZODB import DB
+        from ZODB.DemoStorage import DemoStorage
+
+        # Without ZVC_HISTORY_ID_PREFIX, processes take a random prefix.
+        self.assertEqual(len(getHistoryIdPrefix()), 4)
+        setHistoryIdPrefix('node1')
+        self.assertEqual(getHistoryIdPrefix(), 'node1')
+
+        # Each connection adds its number to the prefix of the process.
+        db = DB(DemoStorage())
+        conn1 = db.open()
+        conn2 = db.open()
+        prefixes = {getHistoryIdPrefix(conn1), getHistoryIdPrefix(conn2)}
+        self.assertEqual(len(prefixes), 2)
+        self.assertTrue(all(prefix.startswith('node1_')
+                            for prefix in prefixes))
+        self.assertEqual(getHistoryIdPrefix(conn1), getHistoryIdPrefix(conn1))
+
+        setHistoryIdPrefix('worker_2', thread=True)
+        self.assertEqual(getHistoryIdPrefix(), 'worker_2')
+        self.assertEqual(getHistoryIdPrefix(conn1), 'worker_2')
+        setHistoryIdPrefix(None, thread=True)
+        self.assertEqual(getHistoryIdPrefix(), 'node1')
+        self.assertRaises(VersionControlError, setHistoryIdPrefix, 'a-b')
+        db.close()
+
+
+class RepositoryHistoryIdTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        # Allocate ids without a prefix, so that they are known.
+        setHistoryIdPrefix('', thread=True)
+
+    def tearDown(self):
+        setHistoryIdPrefix(None, thread=True)
+        common_tearDown(self)
+
+    def testOrderedIds(self):
+        repository = self.repository
+        ids = []
+        for document in (self.document1, self.document2):
+            repository.applyVersionControl(document)
+            ids.append(repository.getVersionInfo(document).history_id)
+        self.assertEqual(ids, ['a1', 'a2'])
+        setHistoryIdPrefix('node1', thread=True)
+        repository.applyVersionControl(self.folder2)
+        self.assertEqual(repository.getVersionInfo(self.folder2).history_id,
+                         'node1-a1')
+
+    def testConcurrentAllocation(self):
+        # Connections allocate ids with prefixes of their own by default,
+        # so that concurrent transactions do not conflict.
+        from OFS.DTMLDocument import addDTMLDocument
+        setHistoryIdPrefix(None, thread=True)
+        for n in range(2):
+            addDTMLDocument(self.folder2, 'new%d' % n, file='text')
+        self.repository.applyVersionControl(self.document1)
+        transaction.commit()
+        db = self.connection.db()
+        runs = []
+        for name in ('new0', 'new1'):
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            folder1 = conn.root()['Application'].folder1
+            folder1.repository.applyVersionControl(
+                getattr(folder1.folder2, name))
+            runs.append((tm, conn))
+        for tm, conn in runs:
+            tm.commit()
+            conn.close()
+        transaction.begin()
+        self.assertEqual(len(self.repository._histories), 3)
+
+    def testConcurrentAllocationWithPrefixes(self):
+        from OFS.DTMLDocument import addDTMLDocument
+        from ZODB.POSException import ConflictError
+        for n in range(2):
+            addDTMLDocument(self.folder2, 'new%d' % n, file='text')
+        self.repository.applyVersionControl(self.document1)
+        transaction.commit()
+
+        def applyInOtherConnection(name, prefix):
+            tm = transaction.TransactionManager()
+            conn = self.connection.db().open(tm)
+            app = conn.root()['Application']
+            folder2 = app.folder1.folder2
+            setHistoryIdPrefix(prefix, thread=True)
+            app.folder1.repository.applyVersionControl(getattr(folder2, name))
+            return tm, conn
+
+        tm1, conn1 = applyInOtherConnection('new0', 'node1')
+        tm2, conn2 = applyInOtherConnection('new1', 'node2')
+        tm1.commit()
+        tm2.commit()
+        conn1.close()
+        conn2.close()
+        transaction.begin()
+        self.assertEqual(list(self.repository._histories.keys()),
+                         ['a1', 'node1-a1', 'node2-a1'])
+
+        # With the same prefix the second transaction is given the same
+        # id as the first, and conflicts.
+        tm1, conn1 = applyInOtherConnection('document2', '')
+        tm2, conn2 = applyInOtherConnection('folder2', '')
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        conn1.close()
+        conn2.close()
+
+    def makeRandomIds(self, *documents):
+        # Give the histories of the documents random ids, as they had
+        # before ids were allocated in order.
+        repository = self.repository
+        for n, document in enumerate(documents):
+            repository.applyVersionControl(document)
+            info = repository.getVersionInfo(document)
+            history = repository._histories[info.history_id]
+            del repository._histories[info.history_id]
+            history.id = info.history_id = str(1000 + n)
+            repository._histories[history.id] = history
+        repository._id_allocator = None
+        transaction.commit()
+
+    def testMigrateHistoryIds(self):
+        repository = self.repository
+        self.makeRandomIds(self.document1, self.document2)
+        repository.checkoutResource(self.document2)
+        transaction.commit()
+        self.document2.manage_edit('changed', '')
+        transaction.commit()
+
+        result = repository.migrateHistoryIds(self.folder2)
+        transaction.commit()
+        self.assertEqual(result, {'histories': 2, 'resources': 1})
+        self.assertEqual(list(repository._histories.keys()), ['a1', 'a2'])
+        self.assertEqual(repository.getVersionInfo(self.document1).history_id,
+                         'a1')
+        self.assertFalse(repository.isResourceChanged(self.document1))
+
+        # The changed document keeps its old id, which is an alias of
+        # the new one, and still looks changed.
+        info = repository.getVersionInfo(self.document2)
+        self.assertEqual(info.history_id, '1001')
+        self.assertTrue(repository.isResourceChanged(self.document2))
+        self.assertTrue(repository.isUnderVersionControl(self.document2))
+        self.assertEqual(repository.getVersionHistory('1001').getId(), 'a2')
+        self.assertEqual(repository['1001'].getId(), 'a2')
+        repository.checkinResource(self.document2, '')
+        transaction.commit()
+
+        # Migrating again updates the objects that were left behind.
+        result = repository.migrateHistoryIds(self.folder2)
+        self.assertEqual(result, {'histories': 0, 'resources': 1})
+        self.assertEqual(repository.getVersionInfo(self.document2).history_id,
+                         'a2')
+        self.assertRaises(KeyError, repository.getVersionHistory, '1002')
+
+    def testMigrationMovesIndexEntries(self):
+        repository = self.repository
+        self.makeRandomIds(self.document1)
+        repository.rebuildNameIndexes()
+        repository.labelResource(self.document1, 'release')
+        repository.migrateHistoryIds()
+        self.assertEqual(repository.getLabeledVersions('release'),
+                         [('a1', '1')])
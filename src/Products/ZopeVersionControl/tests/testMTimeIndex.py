@@ -0,0 +1,427 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the index of the modification times of resources."""
+import pickle
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+
+from Products.ZopeVersionControl.MTimeIndex import MTimeIndex
+from Products.ZopeVersionControl.MTimeIndex import getMTimeIndex
+from Products.ZopeVersionControl.Utility import _findModificationTime
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class RecordScanTests(unittest.TestCase):
+
+    def record(self, state, protocol):
+        return (pickle.dumps(('module', 'Class'), protocol) +
+                pickle.dumps(state, protocol))
+
+    def testVersionInfo(self):
+        from Products.ZopeVersionControl.Utility import _hasVersionInfo
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for state, versioned in (
+                    ({'title': 'x', '__vc_info__': None}, True),
+                    (({'__vc_info__': None}, {'slot': 1}), True),
+                    ({'title': '__vc_info__'}, False),
+                    ({'data': {'__vc_info__': None}}, False),
+                    ({'items': ['x', {'__vc_info__': None}]}, False),
+                    ({'__vc_info__': '__vc_info__'}, True)):
+                self.assertEqual(
+                    _hasVersionInfo(self.record(state, protocol)),
+                    versioned, (protocol, state))
+
+    def testScanRecord(self):
+        from Products.ZopeVersionControl.Utility import _scanRecord
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            root = conn.root()
+            root['resource'] = PersistentMapping()
+            root['child'] = PersistentMapping()
+            root['child'].__vc_info__ = None
+            transaction.commit()
+            load = conn._storage.load
+            references, versioned = _scanRecord(load(root._p_oid)[0])
+            self.assertEqual(
+                sorted(references),
+                sorted([root['resource']._p_oid, root['child']._p_oid]))
+            self.assertFalse(versioned)
+            self.assertEqual(_scanRecord(load(root['child']._p_oid)[0]),
+                             ([], True))
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+
+class ModificationTimeWalkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(DemoStorage())
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        # A resource with a chain of ten subobjects.
+        self.resource = node = PersistentMapping()
+        self.chain = []
+        for n in range(10):
+            node['next'] = PersistentMapping()
+            node = node['next']
+            self.chain.append(node)
+        self.conn.root()['resource'] = self.resource
+        self.tm.commit()
+        self.mtime = self.resource._p_mtime
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def change(self, n):
+        self.chain[n]['x'] = n
+        self.tm.commit()
+        return self.chain[n]._p_mtime
+
+    def testStatistics(self):
+        stats = {}
+        self.assertEqual(_findModificationTime(self.resource, stats=stats),
+                         self.mtime)
+        self.assertEqual(stats['records'], 11)
+        self.assertGreater(stats['bytes'], 0)
+        self.assertTrue(stats['complete'])
+        # Counters add up over walks.
+        _findModificationTime(self.resource, stats=stats)
+        self.assertEqual(stats['records'], 22)
+
+    def testEarlyExit(self):
+        mtime = self.change(2)
+        stats = {}
+        self.assertEqual(
+            _findModificationTime(self.resource, self.mtime, stats=stats),
+            mtime)
+        self.assertEqual(stats['records'], 4)
+        self.assertFalse(stats['complete'])
+        # Without a newer time, the whole subtree is walked.
+        self.assertEqual(
+            _findModificationTime(self.resource, mtime, stats=stats), mtime)
+        self.assertEqual(stats['records'], 15)
+        self.assertTrue(stats['complete'])
+
+    def testMaxDepth(self):
+        mtime = self.change(5)
+        stats = {}
+        self.assertEqual(
+            _findModificationTime(self.resource, max_depth=5, stats=stats),
+            self.mtime)
+        self.assertEqual(stats['records'], 6)
+        self.assertFalse(stats['complete'])
+        self.assertEqual(
+            _findModificationTime(self.resource, max_depth=6, stats=stats),
+            mtime)
+        stats = {}
+        _findModificationTime(self.resource, max_depth=10, stats=stats)
+        self.assertTrue(stats['complete'])
+
+    def testMaxRecords(self):
+        self.change(9)
+        stats = {}
+        self.assertEqual(
+            _findModificationTime(self.resource, max_records=3, stats=stats),
+            self.mtime)
+        self.assertEqual(stats['records'], 3)
+        self.assertFalse(stats['complete'])
+
+    def testPrefetch(self):
+        from Products.ZopeVersionControl import Utility
+        batches = []
+        self.conn.prefetch = lambda oids: batches.append(len(oids))
+        for n in range(250):
+            self.resource[n] = PersistentMapping()
+        self.tm.commit()
+        _findModificationTime(self.resource)
+        # 251 children and the first subobject of the chain below them;
+        # the rest of the chain is loaded one record at a time.
+        self.assertEqual(batches, [Utility.PREFETCH_BATCH] * 2 + [52])
+
+    def testSharedCache(self):
+        other = PersistentMapping()
+        other['shared'] = self.chain[4]
+        self.conn.root()['other'] = other
+        self.tm.commit()
+        mtime = self.change(6)
+        cache = {}
+        stats = {}
+        _findModificationTime(self.resource, stats=stats, cache=cache)
+        self.assertEqual(stats['records'], 11)
+        # Only the record of the other object needs to be loaded.
+        stats = {}
+        self.assertEqual(
+            _findModificationTime(other, stats=stats, cache=cache), mtime)
+        self.assertEqual(stats['records'], 1)
+        self.assertTrue(stats['complete'])
+
+    def testLoadPool(self):
+        from Products.ZopeVersionControl.Utility import _getLoadPool
+        from Products.ZopeVersionControl.Utility import _shutdownLoadPool
+        self.addCleanup(_shutdownLoadPool)
+        pool = _getLoadPool(2)
+        self.assertIs(_getLoadPool(2), pool)
+        # Another number of workers replaces the pool.
+        other = _getLoadPool(3)
+        self.assertIsNot(other, pool)
+        self.assertRaises(RuntimeError, pool.submit, int)
+        self.assertEqual(other.submit(int).result(), 0)
+        _shutdownLoadPool()
+        self.assertRaises(RuntimeError, other.submit, int)
+
+    def testParallelLoads(self):
+        from Products.ZopeVersionControl.Utility import _shutdownLoadPool
+        self.addCleanup(_shutdownLoadPool)
+        for n in range(250):
+            self.resource[n] = PersistentMapping()
+        # A reference to a record that does not exist.
+        missing = PersistentMapping()
+        missing._p_oid = self.db.storage.new_oid()
+        missing._p_jar = self.conn
+        self.resource[n]['x'] = missing
+        self.tm.commit()
+        self.change(7)
+        for args in ({}, {'newer_than': self.mtime}, {'max_depth': 4},
+                     {'max_records': 120}):
+            serial = {}
+            parallel = {}
+            self.assertEqual(
+                _findModificationTime(self.resource, stats=serial, **args),
+                _findModificationTime(self.resource, stats=parallel,
+                                      workers=4, **args))
+            self.assertEqual(serial, parallel)
+
+
+class MTimeIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(DemoStorage())
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        root = self.conn.root()
+        root['resource'] = PersistentMapping()
+        root['resource']['child'] = PersistentMapping()
+        root['other'] = PersistentMapping()
+        self.tm.commit()
+        self.resource = root['resource']
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def checkTime(self, index, newer_than=None):
+        mtime = index.getModificationTime(self.resource, newer_than)
+        self.assertEqual(mtime, _findModificationTime(self.resource))
+        return mtime
+
+    def testLookup(self):
+        index = MTimeIndex()
+        self.checkTime(index)
+        self.checkTime(index)
+        self.assertEqual((index.hits, index.misses), (1, 1))
+        # Changes elsewhere in the database keep the entry.
+        self.conn.root()['other']['x'] = 1
+        self.tm.commit()
+        self.checkTime(index)
+        self.assertEqual((index.hits, index.misses), (2, 1))
+        self.assertEqual(index.transactions, 1)
+
+    def testChangedSubobject(self):
+        index = MTimeIndex()
+        mtime = self.checkTime(index)
+        self.resource['child']['x'] = 1
+        self.tm.commit()
+        # The change is enough to tell that the resource is newer ...
+        self.assertGreater(index.getModificationTime(self.resource, mtime),
+                           mtime)
+        self.assertEqual((index.hits, index.misses), (1, 1))
+        # ... but the exact time needs a new walk.
+        self.checkTime(index)
+        self.assertEqual((index.hits, index.misses), (1, 2))
+        self.checkTime(index)
+        self.assertEqual((index.hits, index.misses), (2, 2))
+
+    def testAddedSubobject(self):
+        index = MTimeIndex()
+        self.checkTime(index)
+        self.resource['child']['new'] = PersistentMapping()
+        self.tm.commit()
+        self.checkTime(index)
+        self.resource['child']['new']['x'] = 1
+        self.tm.commit()
+        self.checkTime(index)
+        self.assertEqual(index.misses, 3)
+
+    def testCommitsOfOtherConnections(self):
+        index = MTimeIndex()
+        self.checkTime(index)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        try:
+            conn.root()['resource']['child']['x'] = 1
+            tm.commit()
+        finally:
+            conn.close()
+        self.tm.begin()
+        self.checkTime(index)
+        self.assertEqual(index.misses, 2)
+
+    def testIndexAheadOfConnection(self):
+        index = MTimeIndex()
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        try:
+            conn.root()['other']['x'] = 1
+            tm.commit()
+            index.getModificationTime(conn.root()['resource'])
+        finally:
+            conn.close()
+        # Our connection has not seen the last transaction yet.
+        self.checkTime(index)
+        self.checkTime(index)
+        self.assertEqual((index.hits, index.misses), (0, 3))
+
+    def testTooManyTransactions(self):
+        index = MTimeIndex(max_transactions=2)
+        self.checkTime(index)
+        for n in range(3):
+            self.conn.root()['other']['x'] = n
+            self.tm.commit()
+        self.checkTime(index)
+        self.assertEqual(index.misses, 2)
+        self.checkTime(index)
+        self.assertEqual(index.hits, 1)
+
+    def testStorageReadWithoutLock(self):
+        index = MTimeIndex()
+        self.checkTime(index)
+        start = index.last_tid
+        self.conn.root()['other']['x'] = 1
+        self.tm.commit()
+        locked = []
+        storage = self.db.storage
+
+        class Storage:
+            def iterator(self, start, stop):
+                locked.append(index._lock.locked())
+                return storage.iterator(start, stop)
+
+        self.tm.begin()
+        self.checkTime(index)
+        tid = index.last_tid
+        index.last_tid = start
+        self.assertTrue(index._sync(Storage(), tid))
+        self.assertEqual(locked, [False])
+        self.assertEqual(index.last_tid, tid)
+
+        # Transactions read while another thread moved the index are not
+        # noted again.
+        class Racing:
+            def iterator(self, start, stop):
+                index.last_tid = tid
+                return storage.iterator(start, stop)
+
+        transactions = index.transactions
+        index.last_tid = start
+        self.assertTrue(index._sync(Racing(), tid))
+        self.assertEqual(index.transactions, transactions)
+
+    def testEntryLimit(self):
+        index = MTimeIndex(max_entries=1)
+        self.checkTime(index)
+        index.getModificationTime(self.conn.root()['other'])
+        self.assertEqual(len(index), 1)
+        self.checkTime(index)
+        self.assertEqual(index.misses, 3)
+        self.assertEqual(len(index._owners), 2)
+
+    def testIndexesByDatabase(self):
+        self.assertIs(getMTimeIndex(self.db), getMTimeIndex(self.db))
+        db = DB(DemoStorage())
+        try:
+            self.assertIsNot(getMTimeIndex(db), getMTimeIndex(self.db))
+        finally:
+            db.close()
+
+
+class RepositoryMTimeIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def testIsResourceChangedUsesIndex(self):
+        repository = self.repository
+        folder = repository.applyVersionControl(self.folder2)
+        transaction.commit()
+        index = getMTimeIndex(self.connection.db())
+        for n in range(3):
+            self.assertFalse(repository.isResourceChanged(folder))
+        self.assertEqual((index.hits, index.misses), (2, 1))
+
+        folder.document1.manage_edit('spam spam', '')
+        transaction.commit()
+        self.assertTrue(repository.isResourceChanged(folder))
+        self.assertTrue(repository.isResourceChanged(folder))
+        self.assertEqual((index.hits, index.misses), (4, 1))
+
+    def testWalkBudget(self):
+        from Products.ZopeVersionControl.Utility import VersionControlError
+        repository = self.repository
+        self.assertRaises(VersionControlError,
+                          repository.setWalkBudget, max_records=-1)
+        repository.setWalkBudget(max_depth=0)
+        folder = repository.applyVersionControl(self.folder2)
+        transaction.commit()
+        folder.document1.manage_edit('spam spam', '')
+        transaction.commit()
+        # The change is too deep to be seen.
+        self.assertFalse(repository.isResourceChanged(folder))
+        repository.setWalkBudget()
+        self.assertTrue(repository.isResourceChanged(folder))
+
+    def testWalkWorkers(self):
+        from Products.ZopeVersionControl import Utility
+        from Products.ZopeVersionControl.Utility import VersionControlError
+        repository = self.repository
+        self.assertRaises(VersionControlError,
+                          repository.setWalkWorkers, -1)
+        repository.setWalkWorkers(2)
+        self.addCleanup(Utility._shutdownLoadPool)
+        folder = repository.applyVersionControl(self.folder2)
+        transaction.commit()
+        self.assertFalse(repository.isResourceChanged(folder))
+        folder.document1.manage_edit('spam spam', '')
+        transaction.commit()
+        getMTimeIndex(self.connection.db()).clear()
+        self.assertTrue(repository.isResourceChanged(folder))
+        self.assertEqual(Utility._load_workers, 2)
+        # Changing the number of workers takes effect for the next walk.
+        repository.setWalkWorkers(3)
+        getMTimeIndex(self.connection.db()).clear()
+        self.assertTrue(repository.isResourceChanged(folder))
+        self.assertEqual(Utility._load_workers, 3)
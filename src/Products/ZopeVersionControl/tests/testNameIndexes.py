@@ -0,0 +1,165 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the indexes of labels and branches."""
+import unittest
+
+import transaction
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class NameIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        repository = self.repository
+        repository.applyVersionControlTree(self.folder2)
+        transaction.commit()
+        self.ids = {}
+        for name in ('folder2', 'document1', 'document2'):
+            object = getattr(self, name)
+            self.ids[name] = repository.getVersionInfo(object).history_id
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def newVersion(self, object):
+        repository = self.repository
+        repository.checkoutResource(object)
+        object.manage_edit('changed', '')
+        repository.checkinResource(object, '')
+        transaction.commit()
+
+    def testLabeledVersions(self):
+        repository = self.repository
+        ids = self.ids
+        repository.labelResource(self.document1, 'release-1')
+        repository.labelResource(self.document2, 'release-1')
+        self.newVersion(self.document1)
+        self.assertEqual(repository.getLabeledVersions('release-1'),
+                         sorted([(ids['document1'], '1'),
+                                 (ids['document2'], '1')]))
+        self.assertEqual(repository.getLabeledVersions('release-2'), [])
+
+        # Moving a label moves it in the index.
+        repository.labelResource(self.document1, 'release-1', force=1)
+        self.assertIn((ids['document1'], '2'),
+                      repository.getLabeledVersions('release-1'))
+
+        # Ranges of history ids are scans of the index.
+        first = min(ids['document1'], ids['document2'])
+        self.assertEqual(
+            [history_id for history_id, version_id in
+             repository.getLabeledVersions('release-1', max=first)],
+            [first])
+
+    def testBranchHistoryIds(self):
+        repository = self.repository
+        ids = self.ids
+        repository.makeActivity(self.document1, 'feature')
+        self.assertEqual(repository.getBranchHistoryIds('feature'),
+                         [ids['document1']])
+        self.assertEqual(repository.getBranchHistoryIds('mainline'),
+                         sorted(ids.values()))
+        self.assertEqual(repository.getBranchHistoryIds('other'), [])
+
+    def testItemsOfBranchedContainersAreIndexed(self):
+        from OFS.DTMLDocument import addDTMLDocument
+        repository = self.repository
+        repository.makeActivity(self.folder2, 'feature')
+        repository.updateResource(self.folder2, 'feature')
+        transaction.commit()
+        addDTMLDocument(self.folder2, 'document3', file='text')
+        repository.applyVersionControlTree(self.folder2)
+        history_id = repository.getVersionInfo(
+            self.folder2.document3).history_id
+        self.assertEqual(repository.getBranchHistoryIds('feature'),
+                         sorted([self.ids['folder2'], history_id]))
+
+    def testUnindexedRepository(self):
+        repository = self.repository
+        repository.labelResource(self.document1, 'release-1')
+        repository.makeActivity(self.document2, 'feature')
+        expected = (repository.getLabeledVersions('release-1'),
+                    repository.getBranchHistoryIds('feature'))
+        # Repositories from before the indexes scan their histories
+        # until they are indexed.
+        repository._label_index = repository._branch_index = None
+        self.assertEqual((repository.getLabeledVersions('release-1'),
+                          repository.getBranchHistoryIds('feature')),
+                         expected)
+        repository.labelResource(self.document2, 'release-1')
+        self.assertEqual(repository.rebuildNameIndexes(), 3)
+        self.assertEqual(len(repository.getLabeledVersions('release-1')), 2)
+        self.assertEqual(repository.getBranchHistoryIds('feature'),
+                         expected[1])
+
+
+class VersionLabelTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        repository = self.repository
+        repository.applyVersionControl(self.document1)
+        transaction.commit()
+        repository.checkoutResource(self.document1)
+        self.document1.manage_edit('changed', '')
+        repository.checkinResource(self.document1, '')
+        transaction.commit()
+        info = repository.getVersionInfo(self.document1)
+        self.history = repository.getVersionHistory(info.history_id)
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def testLabelsForVersion(self):
+        repository = self.repository
+        document = self.document1
+        repository.labelResource(document, 'stable')
+        repository.labelResource(document, 'beta')
+        self.assertEqual(repository.getLabelsForVersion(document),
+                         ['beta', 'stable'])
+        self.assertEqual(repository.getLabelsForVersion(document, '1'), [])
+
+        # Moving a label with force moves it in the index.
+        repository.updateResource(document, '1')
+        repository.labelResource(document, 'stable', force=1)
+        self.assertEqual(repository.getLabelsForVersion(document, '1'),
+                         ['stable'])
+        self.assertEqual(repository.getLabelsForVersion(document, '2'),
+                         ['beta'])
+        self.assertEqual(repository.getLabelsForHistory(document),
+                         ['beta', 'stable'])
+
+    def testVersionIdsThatArePrefixes(self):
+        history = self.history
+        history.createBranch('1', '1')
+        history._versions['1.1'] = history._versions['2']
+        history.labelVersion('1', 'one')
+        history.labelVersion('1.1', 'branch')
+        self.assertEqual(history.getLabelsForVersion('1'), ['one'])
+        self.assertEqual(history.getLabelsForVersion('1.1'), ['branch'])
+
+    def testUnindexedHistory(self):
+        history = self.history
+        history.labelVersion('2', 'stable')
+        history.labelVersion('1', 'old')
+        # Histories from before the index scan their labels until they
+        # are labeled again.
+        history._version_labels = None
+        self.assertEqual(history.getLabelsForVersion('2'), ['stable'])
+        history.labelVersion('1', 'stable', force=1)
+        self.assertIsNotNone(history._version_labels)
+        self.assertEqual(history.getLabelsForVersion('1'), ['old', 'stable'])
+        self.assertEqual(history.getLabelsForVersion('2'), [])
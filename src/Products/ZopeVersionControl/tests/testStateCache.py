@@ -0,0 +1,125 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Test the cache of version states."""
+import unittest
+
+import transaction
+
+from Products.ZopeVersionControl.StateCache import StateCache
+
+from .common import common_setUp
+from .common import common_tearDown
+
+
+class FakeSnapshot:
+
+    def __init__(self, size):
+        self.size = size
+
+
+class StateCacheTests(unittest.TestCase):
+
+    def testGetAndSet(self):
+        cache = StateCache()
+        snapshot = FakeSnapshot(10)
+        self.assertIsNone(cache.get(('h', '1'), 'oid', 'serial'))
+        cache.set(('h', '1'), 'oid', 'serial', snapshot)
+        self.assertIs(cache.get(('h', '1'), 'oid', 'serial'), snapshot)
+        # A version of another database or a changed version misses.
+        self.assertIsNone(cache.get(('h', '1'), 'other', 'serial'))
+        self.assertIsNone(cache.get(('h', '1'), 'oid', 'changed'))
+        stats = cache.getStatistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['bytes'], 10)
+
+    def testEntryLimit(self):
+        cache = StateCache(max_entries=2)
+        for n in range(3):
+            cache.set(('h', str(n)), n, 's', FakeSnapshot(1))
+            # Using the first entry keeps it in the cache.
+            cache.get(('h', '0'), 0, 's')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get(('h', '0'), 0, 's'))
+        self.assertIsNone(cache.get(('h', '1'), 1, 's'))
+        self.assertEqual(cache.getStatistics()['evictions'], 1)
+
+    def testByteLimit(self):
+        cache = StateCache(max_bytes=100)
+        cache.set(('h', '1'), 1, 's', FakeSnapshot(60))
+        cache.set(('h', '2'), 2, 's', FakeSnapshot(60))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.getStatistics()['bytes'], 60)
+        # Snapshots larger than the cache are not cached at all.
+        cache.set(('h', '3'), 3, 's', FakeSnapshot(200))
+        self.assertEqual(len(cache), 1)
+        self.assertIsNotNone(cache.get(('h', '2'), 2, 's'))
+        cache.setLimits(max_bytes=10)
+        self.assertEqual(len(cache), 0)
+
+    def testInvalidate(self):
+        cache = StateCache()
+        for key in (('h', '1'), ('h', '2'), ('g', '1')):
+            cache.set(key, 'oid', 's', FakeSnapshot(1))
+        cache.invalidate('h', '1')
+        self.assertIsNone(cache.get(('h', '1'), 'oid', 's'))
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('h')
+        self.assertEqual(len(cache), 1)
+        self.assertIsNotNone(cache.get(('g', '1'), 'oid', 's'))
+
+
+class VersionStateCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+
+    def tearDown(self):
+        common_tearDown(self)
+
+    def checkCopies(self):
+        from Products.ZopeVersionControl.StateCache import stateCache
+        repository = self.repository
+        document = repository.applyVersionControl(self.document1)
+        transaction.commit()
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById(info.version_id)
+        first = version.copyState()
+        second = version.copyState()
+        self.assertIsNot(first, second)
+        first.manage_edit('changed', '')
+        self.assertEqual(second.read(), 'some text')
+        self.assertEqual(version.copyState().read(), 'some text')
+        stats = stateCache.getStatistics()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+        repository.getVersionOfResource(info.history_id, info.version_id)
+        self.assertEqual(stateCache.getStatistics()['hits'], 3)
+
+    def testCopiesFromCache(self):
+        self.checkCopies()
+
+    def testCopiesFromCacheWithDeduplication(self):
+        self.repository.setVersionStorage('delta', deduplicate=True)
+        self.checkCopies()
+
+    def testUncommittedVersionIsNotCached(self):
+        from Products.ZopeVersionControl.StateCache import stateCache
+        repository = self.repository
+        document = repository.applyVersionControl(self.document1)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        history.getVersionById(info.version_id).copyState()
+        self.assertEqual(len(stateCache), 0)
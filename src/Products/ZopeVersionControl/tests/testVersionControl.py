@@ -93,6 +93,49 @@ class VersionControlTests(unittest.TestCase):
         if self.do_commits:
             self.assertFalse(repository.isResourceChanged(document))
 
+    def testAreResourcesUpToDate(self):
+        # Test checking whether many versioned resources are up to date.
+        repository = self.repository
+        document1 = repository.applyVersionControl(self.document1)
+        document2 = repository.applyVersionControl(self.document2)
+        self.commit()
+        document2 = repository.checkoutResource(document2)
+        document2 = repository.checkinResource(document2, '')
+        self.commit()
+        document2 = repository.updateResource(document2, '1')
+        self.commit()
+        self.assertEqual(
+            repository.areResourcesUpToDate([document1, document2]),
+            [True, False])
+        self.assertEqual(
+            repository.areResourcesUpToDate([document1, document2], 1),
+            [True, 0])
+        # Resources at the same path are all reported.
+        self.assertEqual(
+            repository.areResourcesUpToDate([document2, document1,
+                                             document2]),
+            [False, True, False])
+
+    def testAreResourcesChanged(self):
+        # Test checking whether many versioned resources have changed.
+        repository = self.repository
+        folder = repository.applyVersionControl(self.folder2)
+        document1 = repository.applyVersionControl(self.document1)
+        document2 = repository.applyVersionControl(self.document2)
+        self.commit()
+        document1 = repository.checkoutResource(document1)
+        self.commit()
+        document1.manage_edit('change 1', '')
+        self.commit()
+        resources = [folder, document1, document2, document1]
+        expected = [repository.isResourceChanged(resource)
+                    for resource in resources]
+        self.assertEqual(repository.areResourcesChanged(resources),
+                         expected)
+        if self.do_commits:
+            self.assertTrue(expected[1])
+            self.assertFalse(expected[2])
+
     def testVersionBookkeeping(self):
         # Check the consistency of the version bookkeeping info.
         repository = self.repository
@@ -172,6 +215,156 @@ class VersionControlTests(unittest.TestCase):
         self.assertEqual(record.action, record.ACTION_CHECKIN)
         self.assertEqual(record.path, '/folder1/folder2/document1')
 
+    def testApplyVersionControlTree(self):
+        # Test placing a folder tree under version control.
+        repository = self.repository
+        repository.applyVersionControl(self.document2)
+        self.commit()
+        summary = repository.applyVersionControlTree(self.folder1,
+                                                     savepoint_interval=2)
+        self.commit()
+        # The non-versionable document and the document under version
+        # control are skipped; the repository itself is not walked.
+        self.assertEqual(summary, {'processed': 3, 'skipped': 2,
+                                   'errors': []})
+        for object in (self.folder1, self.folder2, self.document1):
+            self.assertTrue(repository.isUnderVersionControl(object))
+            info = repository.getVersionInfo(object)
+            entries = repository.getLogEntries(object)
+            self.assertEqual(len(entries), 1)
+            self.assertEqual(entries[0].path,
+                             '/'.join(object.getPhysicalPath()))
+            self.assertIsNone(info.sticky)
+        self.assertFalse(
+            repository.isUnderVersionControl(self.document_nonversion))
+
+    def testApplyVersionControlTreeOnBranch(self):
+        # Items of a container on a branch get their first version on the
+        # branch, as with applyVersionControl().
+        repository = self.repository
+        folder = repository.applyVersionControl(self.folder2)
+        self.commit()
+        repository.makeActivity(folder, 'activity')
+        self.commit()
+        repository.updateResource(folder, 'activity')
+        self.commit()
+        summary = repository.applyVersionControlTree(folder)
+        self.assertEqual(summary['processed'], 2)
+        info = repository.getVersionInfo(self.document1)
+        self.assertEqual(info.sticky, ('B', 'activity'))
+
+    def testCheckoutAndCheckinTree(self):
+        # Test checking out and checking in a folder tree.
+        repository = self.repository
+        repository.applyVersionControlTree(self.folder2)
+        self.commit()
+        document2 = repository.checkoutResource(self.document2)
+        self.commit()
+        repository.checkinResource(document2, '')
+        self.commit()
+        repository.updateResource(document2, '1')
+        self.commit()
+
+        summary = repository.checkoutTree(self.folder2)
+        self.commit()
+        path2 = '/'.join(self.document2.getPhysicalPath())
+        self.assertEqual(summary['processed'], 2)
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual([path for path, message in summary['errors']],
+                         [path2])
+        for object in (self.folder2, self.document1):
+            info = repository.getVersionInfo(object)
+            self.assertEqual(info.status, info.CHECKED_OUT)
+
+        self.document1.manage_edit('change 1', '')
+        summary = repository.checkinTree(self.folder2, 'tree checkin')
+        self.commit()
+        self.assertEqual(summary, {'processed': 2, 'skipped': 2,
+                                   'errors': []})
+        info = repository.getVersionInfo(self.document1)
+        self.assertEqual(info.status, info.CHECKED_IN)
+        self.assertEqual(info.version_id, '2')
+        self.assertEqual(
+            repository.getLogEntries(self.document1)[0].message,
+            'tree checkin')
+
+    def testUpdateTreeToSelector(self):
+        # Test updating a folder tree to a selector in bulk.
+        repository = self.repository
+        repository.applyVersionControlTree(self.folder2)
+        self.commit()
+        document1 = repository.checkoutResource(self.document1)
+        document1.manage_edit('change 1', '')
+        repository.checkinResource(document1, '')
+        self.commit()
+
+        calls = []
+        summary = repository.updateTreeToSelector(
+            self.folder2, '1', savepoint_interval=2,
+            progress=lambda done, total: calls.append((done, total)))
+        self.commit()
+        self.assertEqual(summary, {'updated': 1, 'retagged': 2,
+                                   'skipped': 0, 'errors': []})
+        self.assertEqual(calls, [(2, 3), (3, 3)])
+        self.assertEqual(self.document1.read(), 'some text')
+        for object in (self.folder2, self.document1, self.document2):
+            info = repository.getVersionInfo(object)
+            self.assertEqual(info.version_id, '1')
+            self.assertEqual(info.sticky, ('V', '1'))
+
+        summary = repository.updateTreeToSelector(self.folder2, 'mainline')
+        self.commit()
+        self.assertEqual(summary, {'updated': 1, 'retagged': 2,
+                                   'skipped': 0, 'errors': []})
+        self.assertEqual(self.document1.read(), 'change 1')
+        info = repository.getVersionInfo(self.document1)
+        self.assertEqual(info.version_id, '2')
+        self.assertEqual(info.sticky, None)
+        entry = repository.getLogEntries(self.document1)[0]
+        self.assertEqual(entry.action, entry.ACTION_UPDATE)
+
+        # Objects that are already at the selected version are skipped.
+        calls = []
+        summary = repository.updateTreeToSelector(
+            self.folder2, None,
+            progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(summary, {'updated': 0, 'retagged': 0,
+                                   'skipped': 3, 'errors': []})
+        self.assertEqual(calls, [])
+
+    def testTreeErrors(self):
+        # Any error of an object is recorded and the walk goes on, but
+        # conflict errors are raised.
+        from ZODB.POSException import ConflictError
+        repository = self.repository
+        path1 = '/'.join(self.document1.getPhysicalPath())
+        seen = []
+
+        def action(object, branch):
+            seen.append(object.getId())
+            if object.getId() == self.document1.getId():
+                raise KeyError('missing')
+
+        summary = repository._walkTree(self.folder2, lambda object: True,
+                                       action, 500)
+        self.assertEqual(summary['processed'], len(seen) - 1)
+        self.assertIn(self.document2.getId(), seen)
+        self.assertEqual(summary['errors'], [(path1, "KeyError: 'missing'")])
+
+        def conflict(object, branch):
+            raise ConflictError()
+
+        self.assertRaises(ConflictError, repository._walkTree, self.folder2,
+                          lambda object: True, conflict, 500)
+
+    def testUpdateTreeToInvalidSelector(self):
+        repository = self.repository
+        repository.applyVersionControlTree(self.folder2)
+        self.commit()
+        summary = repository.updateTreeToSelector(self.folder2, 'bogus')
+        self.assertEqual(len(summary['errors']), 3)
+        self.assertEqual(summary['updated'], 0)
+
     def testCheckoutResource(self):
         # Test checking out a version controlled resource.
         from Products.ZopeVersionControl.Utility import VersionControlError
@@ -261,6 +454,40 @@ class VersionControlTests(unittest.TestCase):
                           document, ''
                           )
 
+    def testSkipUnchangedCheckin(self):
+        # With skip_unchanged, a checkin that changes nothing only adds a
+        # log entry.
+        repository = self.repository
+        repository.setSkipUnchanged(True)
+        document = repository.applyVersionControl(self.document1)
+        self.commit()
+        info = repository.getVersionInfo(document)
+        first_version = info.version_id
+
+        repository.checkoutResource(document)
+        self.commit()
+        document = repository.checkinResource(document, 'no change')
+        self.commit()
+        info = repository.getVersionInfo(document)
+        self.assertEqual(info.version_id, first_version)
+        self.assertEqual(info.status, info.CHECKED_IN)
+        history = repository.getVersionHistory(info.history_id)
+        self.assertEqual(len(history.getVersionIds()), 1)
+        record = repository.getLogEntries(document)[0]
+        self.assertEqual(record.action, record.ACTION_CHECKIN_UNCHANGED)
+        self.assertEqual(record.version_id, first_version)
+        self.assertEqual(record.message, 'no change')
+
+        repository.checkoutResource(document)
+        document.manage_edit('changed', '')
+        self.commit()
+        document = repository.checkinResource(document, '')
+        self.commit()
+        info = repository.getVersionInfo(document)
+        self.assertNotEqual(info.version_id, first_version)
+        record = repository.getLogEntries(document)[0]
+        self.assertEqual(record.action, record.ACTION_CHECKIN)
+
     def testUncheckoutResource(self):
         # Test uncheckout of a version controlled resource.
         repository = self.repository
@@ -642,6 +869,21 @@ class VersionControlTests(unittest.TestCase):
 
         self.assertTrue(repository.isResourceChanged(folder2))
 
+    def testIgnoreVersionedSubObjectChange(self):
+        # Changes to persistent sub-objects that are version-controlled
+        # themselves do not change their container.
+        repository = self.repository
+        folder2 = repository.applyVersionControl(self.folder2)
+        document1 = repository.applyVersionControl(self.document1)
+        document1 = repository.checkoutResource(document1)
+        transaction.commit()
+
+        document1.manage_edit('spam spam', '')
+        transaction.commit()
+
+        self.assertTrue(repository.isResourceChanged(document1))
+        self.assertFalse(repository.isResourceChanged(folder2))
+
     def testContainerVersioning(self):
         from OFS.DTMLDocument import addDTMLDocument
 
@@ -745,9 +987,49 @@ class VersionControlTestsWithCommits(VersionControlTests):
     do_commits = 1
 
 
+class VersionControlTestsWithPickleStorage(VersionControlTestsWithCommits):
+    """Version control test suite with versions stored serialized."""
+
+    def setUp(self):
+        common_setUp(self)
+        self.repository.setVersionStorage('pickle')
+
+
+class VersionControlTestsWithDeltaStorage(VersionControlTestsWithCommits):
+    """Version control test suite with versions stored as deltas."""
+
+    def setUp(self):
+        common_setUp(self)
+        self.repository.setVersionStorage('delta', keyframe_interval=3)
+
+
+class VersionControlTestsWithDeduplication(VersionControlTestsWithCommits):
+    """Version control test suite with subobject states deduplicated."""
+
+    def setUp(self):
+        common_setUp(self)
+        self.repository.setVersionStorage('full', deduplicate=True)
+
+
+class VersionControlTestsWithSpooling(VersionControlTestsWithCommits):
+    """Version control test suite with all state copies spooled."""
+
+    def setUp(self):
+        common_setUp(self)
+        self.repository.setSpoolThreshold(0)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     loader = unittest.defaultTestLoader
     suite.addTest(loader.loadTestsFromTestCase(VersionControlTests))
     suite.addTest(loader.loadTestsFromTestCase(VersionControlTestsWithCommits))
+    suite.addTest(loader.loadTestsFromTestCase(
+        VersionControlTestsWithPickleStorage))
+    suite.addTest(loader.loadTestsFromTestCase(
+        VersionControlTestsWithDeltaStorage))
+    suite.addTest(loader.loadTestsFromTestCase(
+        VersionControlTestsWithDeduplication))
+    suite.addTest(loader.loadTestsFromTestCase(
+        VersionControlTestsWithSpooling))
     return suite
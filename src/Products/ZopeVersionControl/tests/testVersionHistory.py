@@ -13,6 +13,8 @@
 """Test the VersionHistory internals."""
 import unittest
 
+import transaction
+
 from .common import common_setUp
 from .common import common_tearDown
 
@@ -28,3 +30,636 @@ class VersionHistoryTests(unittest.TestCase):
         history = self.repository.getVersionHistory(info.history_id)
         branch = history.createBranch('foo', None)
         self.assertEqual(branch.getId(), 'foo')
+
+    def testLengthCounters(self):
+        repository = self.repository
+        document = repository.applyVersionControl(self.document1)
+        for n in range(3):
+            repository.checkoutResource(document)
+            repository.checkinResource(document, '')
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        branch = history._branches['mainline']
+        log = history._eventLog
+        self.assertEqual((len(branch), len(log)), (4, 7))
+        self.assertEqual(len(branch), len(branch.m_order))
+        self.assertEqual(len(log), len(log._data))
+
+        # Branches and logs from before the counters count their
+        # entries on their next append.
+        del branch._length
+        del log._length
+        self.assertEqual((len(branch), len(log)), (4, 7))
+        repository.checkoutResource(document)
+        repository.checkinResource(document, '')
+        self.assertEqual(repository.getVersionInfo(document).version_id, '5')
+        self.assertEqual((branch._length(), log._length()), (5, 9))
+
+    def testDeltaStorage(self):
+        repository = self.repository
+        repository.setVersionStorage('delta', keyframe_interval=3)
+        self.document1.manage_edit('x' * 1000, '')
+        document = repository.applyVersionControl(self.document1)
+        texts = []
+        for n in range(7):
+            repository.checkoutResource(document)
+            text = 'x' * 1000 + 'some text %d' % n
+            document.manage_edit(text, '')
+            repository.checkinResource(document, '')
+            texts.append(text)
+        transaction.commit()
+
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        formats = [history.getVersionById(str(n))._format
+                   for n in range(1, 9)]
+        self.assertEqual(formats, ['pickle', 'delta', 'delta',
+                                   'pickle', 'delta', 'delta',
+                                   'pickle', 'delta'])
+        for n, text in enumerate(texts):
+            state = history.getVersionById(str(n + 2)).copyState()
+            self.assertEqual(state.read(), text)
+            self.assertIsNone(state._p_jar)
+
+    def testPickleStorage(self):
+        from Products.ZopeVersionControl import Version
+        repository = self.repository
+        repository.setVersionStorage('pickle')
+        document = repository.applyVersionControl(self.document1)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById(info.version_id)
+        self.assertEqual(version._format, 'pickle')
+        self.assertIsInstance(version._payload.data, bytes)
+
+        # The state is only loaded when a copy is asked for.
+        loads = []
+        orig = Version.deserializeState
+
+        def deserializeState(*args, **kw):
+            loads.append(args)
+            return orig(*args, **kw)
+
+        Version.deserializeState = deserializeState
+        try:
+            repository.checkoutResource(document)
+            document.manage_edit('changed', '')
+            repository.checkinResource(document, '')
+            self.assertEqual(loads, [])
+            transaction.commit()
+            state = history.getVersionById('1').copyState()
+        finally:
+            Version.deserializeState = orig
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(state.read(), 'some text')
+
+    def checkBytesPerCheckin(self, storage):
+        repository = self.repository
+        repository.setVersionStorage(storage)
+        text = ''.join('line %d\n' % n for n in range(100000))
+        self.document1.manage_edit(text, '')
+        document = repository.applyVersionControl(self.document1)
+        transaction.commit()
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById(info.version_id)
+        repository.checkoutResource(document)
+        document.manage_edit(text + 'changed\n', '')
+        repository.checkinResource(document, '')
+        transaction.commit()
+
+        # Adding the successor rewrites the predecessor, but not its
+        # payload, so the state is written once for the new version and
+        # once for the working copy.
+        storage = self.app._p_jar.db().storage
+        tid = storage.lastTransaction()
+        records = {r.oid: len(r.data)
+                   for t in storage.iterator(tid, tid) for r in t}
+        self.assertLess(records[version._p_oid], 2000)
+        self.assertNotIn(version._payload._p_oid, records)
+        self.assertLess(sum(records.values()), len(text) * 2.5)
+
+    def testBytesPerCheckinWithPickleStorage(self):
+        self.checkBytesPerCheckin('pickle')
+
+    def testBytesPerCheckinWithDeltaStorage(self):
+        self.checkBytesPerCheckin('delta')
+
+    def checkLongSubobjectChain(self, storage, deduplicate=False,
+                                compression='none'):
+        from OFS.Image import File
+        from OFS.Image import Pdata
+        repository = self.repository
+        repository.setVersionStorage(storage, deduplicate=deduplicate)
+        repository.setCompression(compression, 0)
+        head = last = Pdata(b'0')
+        for n in range(1, 5000):
+            last.next = Pdata(b'%d' % n)
+            last = last.next
+        self.folder2._setObject('file', File('file', '', b''))
+        file = self.folder2.file
+        file.data = head
+        transaction.commit()
+        repository.applyVersionControl(file)
+        transaction.commit()
+        info = repository.getVersionInfo(file)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById(info.version_id)
+        self.assertEqual(version._format, 'pickle')
+        self.assertEqual(bytes(version.copyState().data), bytes(head))
+        return version
+
+    def testPickleStorageOfLongSubobjectChain(self):
+        self.checkLongSubobjectChain('pickle')
+
+    def testDeltaStorageOfLongSubobjectChain(self):
+        self.checkLongSubobjectChain('delta')
+
+    def testDeduplicatedStorageOfLongSubobjectChain(self):
+        version = self.checkLongSubobjectChain('full', deduplicate=True)
+        self.assertEqual(len(version._content_refs), 1)
+        self.assertEqual(len(self.repository.getContentStore()), 5000)
+
+    def testCompressedStorageOfLongSubobjectChain(self):
+        # A codec stores versions serialized even under the 'full'
+        # policy, which must cope with long chains as well.
+        version = self.checkLongSubobjectChain('full', compression='zlib')
+        self.assertEqual(version._codec, 'zlib')
+
+    def testManageEditKeepsDeduplication(self):
+        repository = self.repository
+        repository.manage_edit('', 'pickle', deduplicate=1)
+        repository.manage_edit('', 'delta')
+        self.assertEqual(repository.version_storage, 'delta')
+        self.assertTrue(repository.deduplicate)
+        repository.manage_edit('', deduplicate=0)
+        self.assertEqual(repository.version_storage, 'delta')
+        self.assertFalse(repository.deduplicate)
+
+    def testDeltaStorageAfterFullVersions(self):
+        # Versions stored as full copies keep working, and a delta is
+        # never made against them.
+        repository = self.repository
+        document = repository.applyVersionControl(self.document1)
+        transaction.commit()
+        repository.setVersionStorage('delta')
+        repository.checkoutResource(document)
+        document.manage_edit('changed', '')
+        repository.checkinResource(document, '')
+        transaction.commit()
+
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        first = history.getVersionById('1')
+        second = history.getVersionById('2')
+        self.assertIsNone(first._format)
+        self.assertEqual(second._format, 'pickle')
+        self.assertEqual(first.copyState().read(), 'some text')
+        self.assertEqual(second.copyState().read(), 'changed')
+
+    def testDeduplicatedStorage(self):
+        from persistent.list import PersistentList
+        from persistent.mapping import PersistentMapping
+        repository = self.repository
+        repository.setVersionStorage('full', deduplicate=True)
+        shared = PersistentList(['x' * 1000])
+        self.document1.extra = PersistentMapping({'a': shared, 'b': shared})
+        self.document2.extra = PersistentMapping({'a': shared, 'b': shared})
+        document = repository.applyVersionControl(self.document1)
+        repository.applyVersionControl(self.document2)
+        for n in range(3):
+            repository.checkoutResource(document)
+            document.manage_edit('text %d' % n, '')
+            repository.checkinResource(document, '')
+        transaction.commit()
+
+        # The mapping and the list are stored once for both histories.
+        store = repository.getContentStore()
+        self.assertEqual(len(store), 2)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById('2')
+        self.assertEqual(version._format, 'pickle')
+        self.assertEqual(store.getRefCount(version._content_refs[0]), 5)
+
+        state = version.copyState()
+        self.assertEqual(state.read(), 'text 0')
+        self.assertEqual(list(state.extra['a']), ['x' * 1000])
+        self.assertIs(state.extra['a'], state.extra['b'])
+        self.assertIsNot(state.extra['a'], shared)
+
+        # The statistics are counted at checkin, not from the versions.
+        for version in history._versions.values():
+            version._p_deactivate()
+        stats = history.getDeduplicationStatistics()
+        self.assertEqual(stats['versions'], 4)
+        self.assertGreater(stats['ratio'], 2.0)
+        for version_id in history.getVersionIds():
+            self.assertEqual(
+                history._versions[version_id]._p_changed, None)
+
+        # Releasing the references of all versions reclaims the records.
+        for history_id in repository._histories.keys():
+            history = repository.getVersionHistory(history_id)
+            for version_id in history.getVersionIds():
+                for key in history.getVersionById(version_id)._content_refs:
+                    store.decref(key)
+        self.assertEqual(len(store), 0)
+
+    def testDeduplicatedStorageKeepsDistinctObjects(self):
+        from persistent.list import PersistentList
+        repository = self.repository
+        repository.setVersionStorage('full', deduplicate=True)
+        self.document1.a = PersistentList([1])
+        self.document1.b = PersistentList([1])
+        document = repository.applyVersionControl(self.document1)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        state = history.getVersionById('1').copyState()
+        self.assertEqual(state.a, state.b)
+        self.assertIsNot(state.a, state.b)
+
+    def testCompressedStorage(self):
+        from Products.ZopeVersionControl.Version import codecs
+        repository = self.repository
+        for codec in sorted(codecs):
+            repository.setCompression(codec, 100)
+            self.document1.manage_edit('spam ' * 1000, '')
+            document = repository.applyVersionControl(self.document1)
+            repository.checkoutResource(document)
+            document.manage_edit('eggs ' * 1000, '')
+            repository.checkinResource(document, '')
+            transaction.commit()
+
+            info = repository.getVersionInfo(document)
+            history = repository.getVersionHistory(info.history_id)
+            version = history.getVersionById('1')
+            self.assertEqual(version._format, 'pickle')
+            self.assertEqual(version._codec, codec)
+            self.assertEqual(version.copyState().read(), 'spam ' * 1000)
+            self.assertEqual(history.getVersionById('2').copyState().read(),
+                             'eggs ' * 1000)
+            stats = history.getStorageStatistics()
+            self.assertGreater(stats['raw_size'], 10000)
+            self.assertLess(stats['stored_size'], stats['raw_size'] // 10)
+            del self.document1.__vc_info__
+
+    def testPropertiesFormOffersAvailableCodecs(self):
+        from Products.ZopeVersionControl import ZopeRepository
+        from Products.ZopeVersionControl.Version import codecs
+        form = ZopeRepository.ZopeRepository.manage_properties_form
+        self.assertEqual(form.globals['compression_codecs'],
+                         ('none',) + tuple(sorted(codecs)))
+
+    def testCompressionThreshold(self):
+        from Products.ZopeVersionControl.Utility import VersionControlError
+        repository = self.repository
+        self.assertRaises(VersionControlError,
+                          repository.setCompression, 'bogus')
+        repository.setCompression('zlib', 1000000)
+        document = repository.applyVersionControl(self.document1)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById('1')
+        self.assertEqual(version._format, 'pickle')
+        self.assertIsNone(version._codec)
+        stats = history.getStorageStatistics()
+        self.assertEqual(stats['raw_size'], stats['stored_size'])
+
+    def testCompressedDeltaStorage(self):
+        repository = self.repository
+        repository.setVersionStorage('delta')
+        repository.setCompression('zlib', 0)
+        self.document1.manage_edit('spam ' * 1000, '')
+        document = repository.applyVersionControl(self.document1)
+        for n in range(3):
+            repository.checkoutResource(document)
+            document.manage_edit('spam ' * 1000 + str(n), '')
+            repository.checkinResource(document, '')
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById('4')
+        self.assertEqual(version._format, 'delta')
+        self.assertEqual(version.copyState().read(), 'spam ' * 1000 + '2')
+
+    def testCloneSharesLargeStrings(self):
+        from OFS.Image import File
+        from persistent.mapping import PersistentMapping
+
+        from Products.ZopeVersionControl.Version import LARGE_VALUE
+        from Products.ZopeVersionControl.Version import cloneByPickle
+        data = b'x' * LARGE_VALUE
+        ob = PersistentMapping({'file': File('f', '', data),
+                                'buffer': bytearray(b'spam'),
+                                'small': b'y' * 10})
+        clone = cloneByPickle(ob)
+        self.assertIs(clone['file'].data.data, data)
+        self.assertIsNot(clone['file'].data, ob['file'].data)
+        self.assertEqual(clone['buffer'], bytearray(b'spam'))
+        self.assertIsNot(clone['buffer'], ob['buffer'])
+        self.assertEqual(clone['small'], b'y' * 10)
+
+    def testCloneLongSubobjectChain(self):
+        from OFS.Image import Pdata
+
+        from Products.ZopeVersionControl.Version import cloneByPickle
+        head = Pdata(b'0')
+        last = head
+        for n in range(1, 5000):
+            last.next = Pdata(b'%d' % n)
+            last = last.next
+        clone = cloneByPickle(head)
+        self.assertIsNot(clone, head)
+        self.assertEqual(bytes(clone), bytes(head))
+
+    def testSnapshotSize(self):
+        from persistent.mapping import PersistentMapping
+
+        from Products.ZopeVersionControl.Version import takeSnapshot
+        for value in (b'x' * (1 << 20), 'x' * (1 << 20),
+                      [bytes([n % 256]) * 1024 for n in range(1024)]):
+            # Large values are shared or passed out-of-band and small
+            # ones go through the pickle stream, but each is counted
+            # once.
+            snapshot = takeSnapshot(PersistentMapping({'value': value}))
+            self.assertGreater(snapshot.size, 1 << 20)
+            self.assertLess(snapshot.size, (1 << 20) * 1.1)
+
+    def testSpooledSnapshotMemoryCeiling(self):
+        # The memory that a spooled snapshot takes does not grow with the
+        # size of the object.
+        import tracemalloc
+
+        from persistent.mapping import PersistentMapping
+
+        from Products.ZopeVersionControl.Version import takeSnapshot
+        spool = 1 << 20
+        peaks = []
+        for size in (4, 16):
+            # Chunks below LARGE_VALUE go through the pickle stream.
+            chunks = [bytes([n % 256]) * (1 << 15) for n in range(size * 32)]
+            ob = PersistentMapping({'chunks': chunks})
+            tracemalloc.start()
+            try:
+                snapshot = takeSnapshot(ob, spool=spool)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            self.assertTrue(snapshot.spooled)
+            self.assertGreater(snapshot.size, size << 20)
+            self.assertEqual(snapshot.load()['chunks'], chunks)
+            snapshot.close()
+        self.assertLess(peaks[1], 2 * spool)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+        snapshot = takeSnapshot(PersistentMapping({'x': 1}), spool=spool)
+        self.assertFalse(snapshot.spooled)
+
+    def testProtocolOneStateIsLoadable(self):
+        from io import BytesIO
+
+        from ZODB._compat import Pickler
+
+        from Products.ZopeVersionControl.Version import deserializeState
+        stream = BytesIO()
+        Pickler(stream, 1).dump(self.document1.aq_base)
+        state = deserializeState(stream.getvalue())
+        self.assertEqual(state.read(), 'some text')
+
+    def checkBlobVersioning(self):
+        import os
+
+        from ZODB.blob import Blob
+        repository = self.repository
+        document = self.document1
+        document.blob = Blob(b'blob data')
+        transaction.commit()
+        repository.applyVersionControl(document)
+        transaction.commit()
+        history = repository.getVersionHistory(
+            repository.getVersionInfo(document).history_id)
+        first = history.getVersionById('1')
+        self.assertTrue(os.path.samefile(first._blobs[0].committed(),
+                                         document.blob.committed()))
+
+        # An unchanged blob is shared with the predecessor.
+        repository.checkoutResource(document)
+        document.manage_edit('changed', '')
+        repository.checkinResource(document, '')
+        transaction.commit()
+        second = history.getVersionById('2')
+        self.assertIs(second._blobs[0], first._blobs[0])
+
+        repository.checkoutResource(document)
+        with document.blob.open('w') as f:
+            f.write(b'new data')
+        repository.checkinResource(document, '')
+        transaction.commit()
+        third = history.getVersionById('3')
+        self.assertIsNot(third._blobs[0], first._blobs[0])
+        with third._blobs[0].open('r') as f:
+            self.assertEqual(f.read(), b'new data')
+
+        # Restoring links the committed file into a new blob.
+        repository.updateResource(document, '1')
+        transaction.commit()
+        self.assertIsNot(document.blob, first._blobs[0])
+        self.assertTrue(os.path.samefile(first._blobs[0].committed(),
+                                         document.blob.committed()))
+        with document.blob.open('r') as f:
+            self.assertEqual(f.read(), b'blob data')
+
+    def testBlobVersioning(self):
+        self.checkBlobVersioning()
+
+    def testBlobVersioningWithPickleStorage(self):
+        self.repository.setVersionStorage('pickle', deduplicate=True)
+        self.checkBlobVersioning()
+
+    def testBlobVersioningWithDeltaStorage(self):
+        self.repository.setVersionStorage('delta')
+        self.repository.setCompression('zlib', 0)
+        self.checkBlobVersioning()
+
+    def testCopyUncommittedBlob(self):
+        from ZODB.blob import Blob
+
+        from Products.ZopeVersionControl.Version import copyBlob
+        blob = Blob(b'blob data')
+        copy = copyBlob(blob)
+        self.assertIsNot(copy, blob)
+        with copy.open('r') as f:
+            self.assertEqual(f.read(), b'blob data')
+
+    def testFingerprintState(self):
+        from persistent.mapping import PersistentMapping
+
+        from Products.ZopeVersionControl.Version import fingerprintState
+        document = self.document1
+        fingerprint = fingerprintState(document.aq_base)
+        # Attribute order and version control bookkeeping do not count.
+        state = document.__dict__.copy()
+        document.__dict__.clear()
+        document.__dict__.update(reversed(list(state.items())))
+        document.__vc_info__ = 'info'
+        self.assertEqual(fingerprintState(document.aq_base), fingerprint)
+        document.manage_edit('changed', '')
+        self.assertNotEqual(fingerprintState(document.aq_base), fingerprint)
+
+        # Subobjects are hashed by their state, and cycles are allowed.
+        a = PersistentMapping({'sub': PersistentMapping({'x': 1})})
+        b = PersistentMapping({'sub': PersistentMapping({'x': 1})})
+        self.assertEqual(fingerprintState(a), fingerprintState(b))
+        b['sub']['x'] = 2
+        self.assertNotEqual(fingerprintState(a), fingerprintState(b))
+        a['sub']['parent'] = a
+        self.assertNotEqual(fingerprintState(a), fingerprintState(b))
+
+    def testVersionFingerprint(self):
+        repository = self.repository
+        document = repository.applyVersionControl(self.document1)
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        version = history.getVersionById(info.version_id)
+        # Without skip_unchanged the fingerprint is computed on demand.
+        self.assertIsNone(version._fingerprint)
+        fingerprint = version.getFingerprint()
+        repository.setSkipUnchanged(True)
+        repository.checkoutResource(document)
+        document.manage_edit('changed', '')
+        repository.checkinResource(document, '')
+        version = history.getVersionById('2')
+        self.assertIsNotNone(version._fingerprint)
+        self.assertNotEqual(version.getFingerprint(), fingerprint)
+
+    def checkVersionAttributes(self):
+        from OFS.Image import manage_addFile
+        repository = self.repository
+        manage_addFile(self.folder2, 'file', b'x' * (1 << 17), 'File 1')
+        transaction.commit()
+        document = repository.applyVersionControl(self.folder2.file)
+        for n in range(2, 4):
+            repository.checkoutResource(document)
+            document.manage_edit('File %d' % n, 'text/plain')
+            repository.checkinResource(document, '')
+        transaction.commit()
+        info = repository.getVersionInfo(document)
+        history = repository.getVersionHistory(info.history_id)
+        self.connection.cacheMinimize()
+
+        attributes = history.getVersionAttributes(['title', 'content_type'])
+        self.assertEqual(attributes['1'], {
+            'title': 'File 1', 'content_type': 'application/octet-stream'})
+        self.assertEqual(attributes['3'], {
+            'title': 'File 3', 'content_type': 'text/plain'})
+        version = history.getVersionById('2')
+        self.assertEqual(version.getAttributes(['size']), {'size': 1 << 17})
+        # Attributes that refer to subobjects are left out.
+        self.assertEqual(version.getAttributes(['data', 'precondition']),
+                         {'precondition': ''})
+        return version
+
+    def testVersionAttributes(self):
+        version = self.checkVersionAttributes()
+        # Reading attributes leaves the file data alone.
+        self.assertIsNone(version._data.__dict__['data']._p_changed)
+
+    def testVersionAttributesWithPickleStorage(self):
+        from Products.ZopeVersionControl import Version
+        self.repository.setVersionStorage('pickle')
+        loads = []
+        orig = Version.deserializeState
+
+        def deserializeState(*args, **kw):
+            loads.append(args)
+            return orig(*args, **kw)
+
+        Version.deserializeState = deserializeState
+        try:
+            version = self.checkVersionAttributes()
+        finally:
+            Version.deserializeState = orig
+        # Only the top-level state is read for the precondition attribute.
+        self.assertEqual(loads, [])
+
+        # The title, content type and size are captured as metadata, and
+        # reading them leaves the payload alone.
+        self.connection.cacheMinimize()
+        self.assertEqual(version.getAttributes(['title', 'size']),
+                         {'title': 'File 2', 'size': 1 << 17})
+        self.assertIsNone(version._payload._p_changed)
+        version.getAttributes(['precondition'])
+        self.assertIs(version._payload._p_changed, False)
+
+    def testVersionAttributesWithDeduplication(self):
+        self.repository.setVersionStorage('delta', deduplicate=True)
+        self.checkVersionAttributes()
+
+    def testVersionAttributesWithoutMetadata(self):
+        self.repository.setMetadataAttributes(())
+        version = self.checkVersionAttributes()
+        self.assertEqual(version.getMetadata(), {})
+
+    def checkDiffVersions(self):
+        from OFS.DTMLDocument import addDTMLDocument
+        repository = self.repository
+        folder = repository.applyVersionControl(self.folder2)
+        repository.checkoutResource(folder)
+        folder.manage_changeProperties(title='changed')
+        folder.document_nonversion.manage_edit('changed', '')
+        folder.document1.manage_edit('not versioned with the folder', '')
+        addDTMLDocument(folder, 'extra', file='extra')
+        folder.extra.__non_versionable__ = 1
+        repository.checkinResource(folder, '')
+        transaction.commit()
+        info = repository.getVersionInfo(folder)
+        history = repository.getVersionHistory(info.history_id)
+        diff = history.diffVersions('1', '2')
+        self.assertEqual(diff['items'], {'document_nonversion': 'changed',
+                                         'extra': 'added'})
+        self.assertEqual(diff['attributes']['title'], 'changed')
+        self.assertNotIn('document1', diff['attributes'])
+        self.assertEqual(history.diffVersions('2', '1')['items']['extra'],
+                         'removed')
+        self.assertEqual(history.diffVersions('2', '2'),
+                         {'attributes': {}, 'items': {}})
+        return history
+
+    def testDiffVersions(self):
+        from Products.ZopeVersionControl.Version import Version
+        from Products.ZopeVersionControl.Version import fingerprintGraph
+        self.repository.setRecordFingerprints(True)
+        copies = []
+        orig = Version.copyState
+
+        def copyState(self):
+            copies.append(self)
+            return orig(self)
+
+        Version.copyState = copyState
+        try:
+            history = self.checkDiffVersions()
+        finally:
+            Version.copyState = orig
+        self.assertEqual(copies, [])
+
+        # The recorded hashes are those of the stored state.
+        version = history.getVersionById('2')
+        copy = version.copyState()
+        recorded = version.getFingerprints()
+        self.assertEqual(fingerprintGraph(copy)[0], recorded[0])
+        self.assertEqual(dict(recorded[2]), fingerprintGraph(copy)[2])
+
+    def testDiffVersionsWithoutRecordedFingerprints(self):
+        self.checkDiffVersions()
+
+    def testSetVersionStorage(self):
+        from Products.ZopeVersionControl.Utility import VersionControlError
+        repository = self.repository
+        self.assertRaises(VersionControlError,
+                          repository.setVersionStorage, 'bogus')
+        self.assertRaises(VersionControlError,
+                          repository.setVersionStorage, 'delta', 0)
+        repository.setVersionStorage('delta', 5)
+        self.assertEqual(repository.version_storage, 'delta')
+        self.assertEqual(repository.keyframe_interval, 5)
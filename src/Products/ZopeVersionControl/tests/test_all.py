@@ -16,7 +16,16 @@
 
 import unittest
 
+from Products.ZopeVersionControl.tests import testCheckinQueue
+from Products.ZopeVersionControl.tests import testConflicts
+from Products.ZopeVersionControl.tests import testDelta
+from Products.ZopeVersionControl.tests import testHistoryDatabases
+from Products.ZopeVersionControl.tests import testHistoryIds
+from Products.ZopeVersionControl.tests import testMTimeIndex
+from Products.ZopeVersionControl.tests import testNameIndexes
+from Products.ZopeVersionControl.tests import testStateCache
 from Products.ZopeVersionControl.tests import testVersionControl
+from Products.ZopeVersionControl.tests import testVersionHistory
 
 
 try:
@@ -33,6 +42,11 @@ else:
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(testVersionControl.test_suite())
+    loader = unittest.defaultTestLoader
+    for module in (testVersionHistory, testDelta, testStateCache,
+                   testMTimeIndex, testConflicts, testHistoryIds,
+                   testHistoryDatabases, testCheckinQueue, testNameIndexes):
+        suite.addTest(loader.loadTestsFromModule(module))
     if testReferenceVersioning is not None:
         suite.addTest(testReferenceVersioning.test_suite())
     return suite